@@ -0,0 +1,245 @@
+"""Data-scale benchmark for the message_handler history operations.
+
+Usage:
+    python -m benchmarks.bench_history --uri mongodb://localhost:27017 [--sizes 1000,100000,10000000]
+    python -m benchmarks.bench_history --store mongomock [--sizes 1000,10000]
+
+Grows one synthetic room through each size and, at every size, times
+get_recent_messages, get_messages_before (shallow and deep cursors), the
+admin inbox page and sanitize_for_json. For each operation it reports the
+median and p95 latency, the tracemalloc peak and, on a real mongod, the
+documents and index keys examined (explain executionStats of the queries
+the operation issued).
+
+The run fails (exit 1) when a limit in --thresholds is exceeded, or with
+--compare when an operation got slower than the saved baseline by more
+than --tolerance. --save writes the results for use as a baseline.
+
+It writes into the 'messages' database of the given server: point it at a
+throwaway local mongod, never at a shared cluster. mongomock keeps
+everything in memory and scans in Python without indexes, so its numbers
+only compare against a mongomock baseline; --thresholds applies to mongod.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pymongo import monitoring
+
+ROOM = 'bench'
+ADMIN = 'dtanh'
+BATCH = 10000
+DEFAULT_THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history_thresholds.json')
+
+SAMPLE_TEXTS = [
+    "Chào buổi sáng! Hôm nay bạn thế nào?",
+    "Mình vừa xem xong bộ phim đó, hay lắm luôn 😄",
+    "ok",
+    "Tối nay đi ăn phở không?",
+    "![image](/api/images/65f0c0ffee0000000000beef)",
+    "Đừng quên mang theo ô nhé, trời sắp mưa rồi.",
+]
+
+
+def configure_store(args):
+    """Point MongoDBClient at the benchmark store; must run before importing scripts modules"""
+    if args.store == 'mongomock':
+        import mongomock
+        import scripts.mongo_client as mongo_client_module
+        mongo_client_module.MongoClient = lambda uri, **kwargs: mongomock.MongoClient()
+        os.environ['MONGODB_URI'] = 'mongodb://mongomock'
+        return
+    if args.uri.startswith('mongodb+srv://') and not args.allow_remote:
+        sys.exit("Refusing to write benchmark data to a cluster; use a local mongod or --allow-remote")
+    os.environ['MONGODB_URI'] = args.uri
+
+
+def message_id(i):
+    return f"{i:016x}"
+
+
+def generate(mongo_client, start, stop, index_terms):
+    """Append messages start..stop-1 to the benchmark room, one second apart"""
+    base = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for batch_start in range(start, stop, BATCH):
+        batch = []
+        for i in range(batch_start, min(batch_start + BATCH, stop)):
+            username = ROOM if i % 2 else ADMIN
+            text = SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]
+            message = {
+                'id': message_id(i),
+                'username': username,
+                'message': text,
+                'timestamp': (base + timedelta(seconds=i)).isoformat(),
+                'room': ROOM,
+                'terms': index_terms(text)
+            }
+            if username != ADMIN:
+                message['inbox'] = True
+            batch.append(message)
+        mongo_client.messages_collection.insert_many(batch, ordered=False)
+
+
+class QueryRecorder(monitoring.CommandListener):
+    """Command listener collecting the find/aggregate commands an operation issues"""
+
+    def __init__(self):
+        self.recording = False
+        self.commands = []
+
+    def started(self, event):
+        if self.recording and event.command_name in ('find', 'aggregate'):
+            command = {k: v for k, v in event.command.items()
+                       if k not in ('lsid', '$clusterTime', '$db', '$readPreference',
+                                    'apiVersion', 'apiStrict', 'apiDeprecationErrors')}
+            self.commands.append((event.database_name, command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def examined(mongo_client, commands):
+    """Total (docs, keys) examined by the recorded commands, via explain executionStats"""
+    docs = keys = 0
+    for database, command in commands:
+        plan = mongo_client.client[database].command({'explain': command, 'verbosity': 'executionStats'})
+        stats = plan.get('executionStats', {})
+        docs += stats.get('totalDocsExamined', 0)
+        keys += stats.get('totalKeysExamined', 0)
+    return docs, keys
+
+
+def measure(fn, repeat):
+    """(median ms, p95 ms, peak KiB) of fn over repeat runs"""
+    fn()  # warm caches and connections
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return statistics.median(timings), p95, peak / 1024
+
+
+def operations(handler, size):
+    newest = handler.get_recent_messages(ROOM, 50)
+    page = handler.get_recent_messages(ROOM, 100)
+    shallow_anchor = newest[0]['id']
+    deep_anchor = message_id(min(size - 1, 100))
+    return {
+        'get_recent_messages': lambda: handler.get_recent_messages(ROOM, 30),
+        'get_messages_before_shallow': lambda: handler.get_messages_before(ROOM, shallow_anchor, 50),
+        'get_messages_before_deep': lambda: handler.get_messages_before(ROOM, deep_anchor, 50),
+        'get_recent_messages_inbox': lambda: handler.get_recent_messages(ADMIN, 30),
+        'sanitize_for_json_100': lambda: handler.sanitize_for_json(page),
+    }
+
+
+def check(results, thresholds, baseline, tolerance):
+    """Return human-readable threshold and baseline violations"""
+    failures = []
+    for result in results:
+        limits = thresholds.get(result['operation'], {})
+        label = f"{result['operation']} @ {result['size']}"
+        if 'max_ms' in limits and result['p95_ms'] > limits['max_ms']:
+            failures.append(f"{label}: p95 {result['p95_ms']:.2f}ms > {limits['max_ms']}ms")
+        if 'max_peak_kb' in limits and result['peak_kb'] > limits['max_peak_kb']:
+            failures.append(f"{label}: peak {result['peak_kb']:.0f}KiB > {limits['max_peak_kb']}KiB")
+        if result['docs_examined'] is not None and 'max_docs_examined' in limits \
+                and result['docs_examined'] > limits['max_docs_examined']:
+            failures.append(f"{label}: {result['docs_examined']} docs examined > {limits['max_docs_examined']}")
+        previous = baseline.get((result['operation'], result['size']))
+        if previous and result['median_ms'] > previous['median_ms'] * (1 + tolerance):
+            failures.append(f"{label}: median {result['median_ms']:.2f}ms vs baseline {previous['median_ms']:.2f}ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--store', choices=('mongo', 'mongomock'), default='mongo')
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--allow-remote', action='store_true')
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--thresholds', default=DEFAULT_THRESHOLDS)
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+    sizes = sorted(int(s) for s in args.sizes.split(','))
+
+    configure_store(args)
+    real_mongo = args.store == 'mongo'
+    recorder = QueryRecorder()
+    if real_mongo:
+        monitoring.register(recorder)
+    # Imported late: the store has to be configured first
+    from scripts import message_handler as handler
+    from scripts.search_index import index_terms
+    mongo_client = handler.mongo_client
+
+    mongo_client.messages_collection.delete_many({'room': ROOM})
+    if real_mongo:
+        # mongomock ignores indexes for queries and re-checks unique ones on every insert
+        mongo_client.ensure_message_indexes()
+
+    results = []
+    generated = 0
+    print(f"{'operation':<30}{'size':>10}{'median ms':>11}{'p95 ms':>9}{'peak KiB':>10}{'docs':>8}{'keys':>8}")
+    for size in sizes:
+        start = time.perf_counter()
+        generate(mongo_client, generated, size, index_terms)
+        generated = size
+        print(f"-- {size} messages ({time.perf_counter() - start:.1f}s to generate)")
+        for name, fn in operations(handler, size).items():
+            median_ms, p95_ms, peak_kb = measure(fn, args.repeat)
+            docs = keys = None
+            if real_mongo and not name.startswith('sanitize'):
+                recorder.commands, recorder.recording = [], True
+                fn()
+                recorder.recording = False
+                docs, keys = examined(mongo_client, recorder.commands)
+            results.append({'operation': name, 'size': size, 'median_ms': round(median_ms, 3),
+                            'p95_ms': round(p95_ms, 3), 'peak_kb': round(peak_kb, 1),
+                            'docs_examined': docs, 'keys_examined': keys})
+            print(f"{name:<30}{size:>10}{median_ms:>11.2f}{p95_ms:>9.2f}{peak_kb:>10.0f}"
+                  f"{docs if docs is not None else '-':>8}{keys if keys is not None else '-':>8}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'store': args.store, 'results': results}, f, indent=2)
+    thresholds = {}
+    if real_mongo and args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        if saved['store'] != args.store:
+            sys.exit(f"Baseline was recorded on {saved['store']}, not {args.store}")
+        baseline = {(r['operation'], r['size']): r for r in saved['results']}
+    failures = check(results, thresholds, baseline, args.tolerance)
+    mongo_client.messages_collection.delete_many({'room': ROOM})
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nAll history operations within thresholds")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Compare the JSON and MessagePack Socket.IO wire formats on history pages.
+
+Usage: python -m benchmarks.bench_serializer [--pages 200] [--page-size 50]
+
+For a synthetic older_messages / recent_messages page it reports the
+packet size on the wire, the size after deflating each page on its own
+(HTTP compression of a long-polling response), the size of the websocket
+frame the server sends (permessage-deflate with the connection's shared
+window, above SOCKETIO_COMPRESSION_THRESHOLD, see scripts.ws_compression)
+and the CPU time spent encoding one page.
+"""
+import argparse
+import secrets
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from socketio import packet, msgpack_packet
+
+from scripts.ws_compression import SOCKETIO_COMPRESSION_THRESHOLD
+
+SAMPLE_TEXTS = [
+    "Chào buổi sáng! Hôm nay bạn thế nào?",
+    "Mình vừa xem xong bộ phim đó, hay lắm luôn 😄",
+    "ok",
+    "Tối nay đi ăn phở không?",
+    "![image](/api/images/65f0c0ffee0000000000beef)",
+    "Đừng quên mang theo ô nhé, trời sắp mưa rồi.",
+]
+
+
+def make_page(page_size, room='user'):
+    """Build one history page shaped like sanitize_for_json(get_messages_before(...))"""
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    messages = []
+    for i in range(page_size):
+        messages.append({
+            '_id': secrets.token_hex(12),
+            'id': secrets.token_hex(8),
+            'username': room if i % 2 else 'dtanh',
+            'message': SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)],
+            'timestamp': (start + timedelta(seconds=37 * i)).isoformat(),
+            'room': room,
+            'inbox': True
+        })
+    return {'messages': messages, 'count': len(messages)}
+
+
+def encode_json(page):
+    return packet.Packet(packet.EVENT, data=['older_messages', page]).encode()
+
+
+def encode_msgpack(page):
+    return msgpack_packet.MsgPackPacket(packet.EVENT, data=['older_messages', page]).encode()
+
+
+def websocket_frames(payloads, threshold=SOCKETIO_COMPRESSION_THRESHOLD):
+    """Payload sizes as sent over one websocket with permessage-deflate (RFC 7692)"""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    sizes = []
+    for payload in payloads:
+        if len(payload) < threshold:
+            sizes.append(len(payload))
+            continue
+        # Sync flush keeps the window for the next message; its 4-byte tail is not sent
+        sizes.append(len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4)
+    return sizes
+
+
+def measure(encoder, pages):
+    """Return (mean bytes, mean deflated bytes, mean websocket frame bytes, CPU microseconds per page)"""
+    start = time.process_time()
+    encoded = [encoder(page) for page in pages]
+    cpu = time.process_time() - start
+    payloads = [e.encode('utf-8') if isinstance(e, str) else e for e in encoded]
+    raw = [len(p) for p in payloads]
+    deflated = [len(zlib.compress(p)) for p in payloads]
+    frames = websocket_frames(payloads)
+    return sum(raw) / len(raw), sum(deflated) / len(deflated), sum(frames) / len(frames), cpu / len(pages) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=50)
+    args = parser.parse_args()
+
+    pages = [make_page(args.page_size) for _ in range(args.pages)]
+    print(f"{args.pages} pages x {args.page_size} messages")
+    print(f"{'format':<10}{'bytes':>10}{'deflated':>12}{'ws frame':>12}{'encode us':>12}")
+    for name, encoder in (('json', encode_json), ('msgpack', encode_msgpack)):
+        raw, deflated, frame, cpu_us = measure(encoder, pages)
+        print(f"{name:<10}{raw:>10.0f}{deflated:>12.0f}{frame:>12.0f}{cpu_us:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
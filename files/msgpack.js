@@ -0,0 +1,229 @@
+// ============================================================================
+// MessagePack codec
+// ============================================================================
+// Small self-contained encoder/decoder for the types the chat exchanges:
+// nil, booleans, integers (up to 64 bit), floats, strings, binary, arrays
+// and maps. Exposes the global `MessagePack` with the same encode/decode
+// calls as the @msgpack/msgpack UMD build, so socket-msgpack-parser.js can
+// use either. Served from /files so no third-party script is loaded.
+
+(function () {
+  const textEncoder = new TextEncoder();
+  const textDecoder = new TextDecoder();
+
+  class Writer {
+    constructor() {
+      this.bytes = new Uint8Array(256);
+      this.view = new DataView(this.bytes.buffer);
+      this.pos = 0;
+    }
+
+    reserve(size) {
+      if (this.pos + size <= this.bytes.length) return;
+      let length = this.bytes.length * 2;
+      while (length < this.pos + size) length *= 2;
+      const bytes = new Uint8Array(length);
+      bytes.set(this.bytes);
+      this.bytes = bytes;
+      this.view = new DataView(bytes.buffer);
+    }
+
+    u8(value) { this.reserve(1); this.view.setUint8(this.pos, value); this.pos += 1; }
+    u16(value) { this.reserve(2); this.view.setUint16(this.pos, value); this.pos += 2; }
+    u32(value) { this.reserve(4); this.view.setUint32(this.pos, value); this.pos += 4; }
+    i8(value) { this.reserve(1); this.view.setInt8(this.pos, value); this.pos += 1; }
+    i16(value) { this.reserve(2); this.view.setInt16(this.pos, value); this.pos += 2; }
+    i32(value) { this.reserve(4); this.view.setInt32(this.pos, value); this.pos += 4; }
+    u64(value) { this.reserve(8); this.view.setBigUint64(this.pos, BigInt(value)); this.pos += 8; }
+    i64(value) { this.reserve(8); this.view.setBigInt64(this.pos, BigInt(value)); this.pos += 8; }
+    f64(value) { this.reserve(8); this.view.setFloat64(this.pos, value); this.pos += 8; }
+
+    raw(bytes) {
+      this.reserve(bytes.length);
+      this.bytes.set(bytes, this.pos);
+      this.pos += bytes.length;
+    }
+
+    // Header for str/bin/array/map: fix form when small, then 8/16/32-bit lengths
+    header(length, fix, fixMax, codes) {
+      if (fix !== null && length <= fixMax) return this.u8(fix | length);
+      if (codes[0] !== null && length < 0x100) { this.u8(codes[0]); return this.u8(length); }
+      if (length < 0x10000) { this.u8(codes[1]); return this.u16(length); }
+      this.u8(codes[2]);
+      this.u32(length);
+    }
+
+    int(value) {
+      if (value >= 0) {
+        if (value < 0x80) return this.u8(value);
+        if (value < 0x100) { this.u8(0xcc); return this.u8(value); }
+        if (value < 0x10000) { this.u8(0xcd); return this.u16(value); }
+        if (value < 0x100000000) { this.u8(0xce); return this.u32(value); }
+        this.u8(0xcf);
+        return this.u64(value);
+      }
+      if (value >= -0x20) return this.i8(value);
+      if (value >= -0x80) { this.u8(0xd0); return this.i8(value); }
+      if (value >= -0x8000) { this.u8(0xd1); return this.i16(value); }
+      if (value >= -0x80000000) { this.u8(0xd2); return this.i32(value); }
+      this.u8(0xd3);
+      this.i64(value);
+    }
+
+    value(value) {
+      if (value === null || value === undefined) return this.u8(0xc0);
+      if (value === false) return this.u8(0xc2);
+      if (value === true) return this.u8(0xc3);
+      if (typeof value === 'number') {
+        if (Number.isSafeInteger(value)) return this.int(value);
+        this.u8(0xcb);
+        return this.f64(value);
+      }
+      if (typeof value === 'bigint') {
+        if (value >= BigInt(Number.MIN_SAFE_INTEGER) && value <= BigInt(Number.MAX_SAFE_INTEGER)) {
+          return this.int(Number(value));
+        }
+        this.u8(value >= 0n ? 0xcf : 0xd3);
+        return value >= 0n ? this.u64(value) : this.i64(value);
+      }
+      if (typeof value === 'string') {
+        const bytes = textEncoder.encode(value);
+        this.header(bytes.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+        return this.raw(bytes);
+      }
+      if (value instanceof ArrayBuffer || ArrayBuffer.isView(value)) {
+        const bytes = value instanceof ArrayBuffer
+          ? new Uint8Array(value)
+          : new Uint8Array(value.buffer, value.byteOffset, value.byteLength);
+        this.header(bytes.length, null, -1, [0xc4, 0xc5, 0xc6]);
+        return this.raw(bytes);
+      }
+      if (Array.isArray(value)) {
+        this.header(value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+        return value.forEach((item) => this.value(item));
+      }
+      if (value instanceof Date) return this.value(value.toISOString());
+      const keys = Object.keys(value);
+      this.header(keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+      keys.forEach((key) => {
+        this.value(key);
+        this.value(value[key]);
+      });
+    }
+  }
+
+  class Reader {
+    constructor(data) {
+      this.bytes = data instanceof ArrayBuffer
+        ? new Uint8Array(data)
+        : new Uint8Array(data.buffer, data.byteOffset, data.byteLength);
+      this.view = new DataView(this.bytes.buffer, this.bytes.byteOffset, this.bytes.byteLength);
+      this.pos = 0;
+    }
+
+    take(size) {
+      if (this.pos + size > this.bytes.length) throw new RangeError('MessagePack: unexpected end of data');
+      const start = this.pos;
+      this.pos += size;
+      return start;
+    }
+
+    u8() { return this.view.getUint8(this.take(1)); }
+    u16() { return this.view.getUint16(this.take(2)); }
+    u32() { return this.view.getUint32(this.take(4)); }
+
+    // 64-bit integers beyond Number's safe range are returned as BigInt
+    big(value) {
+      return value <= BigInt(Number.MAX_SAFE_INTEGER) && value >= BigInt(Number.MIN_SAFE_INTEGER)
+        ? Number(value) : value;
+    }
+
+    str(length) {
+      const start = this.take(length);
+      return textDecoder.decode(this.bytes.subarray(start, start + length));
+    }
+
+    bin(length) {
+      const start = this.take(length);
+      return this.bytes.slice(start, start + length);
+    }
+
+    array(length) {
+      const out = new Array(length);
+      for (let i = 0; i < length; i++) out[i] = this.value();
+      return out;
+    }
+
+    map(length) {
+      const out = {};
+      for (let i = 0; i < length; i++) {
+        const key = this.value();
+        out[key] = this.value();
+      }
+      return out;
+    }
+
+    ext(length) {
+      const type = this.view.getInt8(this.take(1));
+      return { type, data: this.bin(length) };
+    }
+
+    value() {
+      const code = this.u8();
+      if (code < 0x80) return code;
+      if (code < 0x90) return this.map(code & 0x0f);
+      if (code < 0xa0) return this.array(code & 0x0f);
+      if (code < 0xc0) return this.str(code & 0x1f);
+      if (code >= 0xe0) return code - 0x100;
+      switch (code) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: return this.bin(this.u8());
+        case 0xc5: return this.bin(this.u16());
+        case 0xc6: return this.bin(this.u32());
+        case 0xc7: return this.ext(this.u8());
+        case 0xc8: return this.ext(this.u16());
+        case 0xc9: return this.ext(this.u32());
+        case 0xca: return this.view.getFloat32(this.take(4));
+        case 0xcb: return this.view.getFloat64(this.take(8));
+        case 0xcc: return this.u8();
+        case 0xcd: return this.u16();
+        case 0xce: return this.u32();
+        case 0xcf: return this.big(this.view.getBigUint64(this.take(8)));
+        case 0xd0: return this.view.getInt8(this.take(1));
+        case 0xd1: return this.view.getInt16(this.take(2));
+        case 0xd2: return this.view.getInt32(this.take(4));
+        case 0xd3: return this.big(this.view.getBigInt64(this.take(8)));
+        case 0xd4: return this.ext(1);
+        case 0xd5: return this.ext(2);
+        case 0xd6: return this.ext(4);
+        case 0xd7: return this.ext(8);
+        case 0xd8: return this.ext(16);
+        case 0xd9: return this.str(this.u8());
+        case 0xda: return this.str(this.u16());
+        case 0xdb: return this.str(this.u32());
+        case 0xdc: return this.array(this.u16());
+        case 0xdd: return this.array(this.u32());
+        case 0xde: return this.map(this.u16());
+        case 0xdf: return this.map(this.u32());
+        default: throw new RangeError(`MessagePack: unknown type 0x${code.toString(16)}`);
+      }
+    }
+  }
+
+  function encode(value) {
+    const writer = new Writer();
+    writer.value(value);
+    return writer.bytes.slice(0, writer.pos);
+  }
+
+  function decode(data) {
+    const reader = new Reader(data);
+    const value = reader.value();
+    if (reader.pos !== reader.bytes.length) throw new RangeError('MessagePack: trailing bytes');
+    return value;
+  }
+
+  window.MessagePack = { encode, decode };
+})();
@@ -19,16 +19,48 @@ const logoutBtn = document.getElementById('logout-btn');
 const roomInfo = document.getElementById('room-info');
 const roomnameDisplay = document.getElementById('roomname-display');
 const imageUploadInput = document.getElementById('image-upload');
+const roomSwitcher = document.getElementById('room-switcher');
 
 // Message state
 let oldestMessageId = null;
 let newestMessageId = null;
 let isLoadingOlderMessages = false;
 let scrollDebounceTimeout = null;
+// Server clock of the last history read; reconnect sync asks for edits/deletes after it
+let lastSyncTime = null;
+// Room history version: history pages fetched at it may come from the browser cache;
+// null after an edit/delete or a reconnect, until the next page reports the new one
+let historyVersion = null;
 
 // Socket state
 let socket = null;
 let isConnected = false;
+let reconnectJitterMs = 5000;
+
+// Sends awaiting their message_sent ack, by client-generated idempotency key
+const pendingSends = new Map();
+const SEND_RETRY_MS = 4000;
+const SEND_MAX_ATTEMPTS = 5;
+let drainReconnect = false;
+
+// Room state (admin sockets are subscribed to every room and switch views locally)
+let currentRoom = null;
+let inboxRoom = null;
+let availableRooms = [];
+let unreadCounts = {};
+let markReadTimeout = null;
+
+// Receipts: other users' "read/delivered up to" message ids in the current room
+let roomReceipts = {};
+const lastSentReceipt = {};
+let deliveredTimeout = null;
+
+// Presence & typing state
+let onlineUsers = new Set();
+let lastTypingSentAt = 0;
+const typingTimers = {};
+const TYPING_SEND_INTERVAL_MS = 2000;
+const TYPING_DISPLAY_MS = 3500;
 
 // ============================================================================
 // UTILITIES & HELPERS
@@ -242,12 +274,15 @@ function applyMessageSpacing(messageDiv) {
 // MESSAGE ELEMENT BUILDER
 // ============================================================================
 
-function newMessageElement(message, isOutgoing, id = null, timestamp = null) {
+function newMessageElement(message, isOutgoing, id = null, timestamp = null, meta = null) {
   const messageDiv = document.createElement('div');
   messageDiv.classList.add('message', isOutgoing ? 'outgoing' : 'incoming');
 
-  // Check if message is markdown image: ![alt](url)
-  if (message.startsWith('![') && message.includes('](') && message.endsWith(')')) {
+  if (meta?.deleted) {
+    // Tombstone: the message was deleted after it was sent
+    messageDiv.classList.add('deleted');
+    messageDiv.innerHTML = `<p><em>Tin nhắn đã bị xoá</em></p>`;
+  } else if (message.startsWith('![') && message.includes('](') && message.endsWith(')')) {
     const altStart = message.indexOf('![') + 2;
     const altEnd = message.indexOf(']', altStart);
     const urlStart = message.indexOf('](', altEnd) + 2;
@@ -299,10 +334,25 @@ function newMessageElement(message, isOutgoing, id = null, timestamp = null) {
   } else {
     messageDiv.innerHTML = `<p>${escapeHTML(message)}</p>`;
   }
+  if (meta?.edited_at && !meta.deleted) {
+    const mark = document.createElement('span');
+    mark.className = 'edited-mark';
+    mark.textContent = '(đã sửa)';
+    messageDiv.appendChild(mark);
+  }
 
   // Attach metadata
   if (id) messageDiv.dataset.messageId = id;
   if (timestamp) messageDiv.dataset.timestamp = timestamp;
+  messageDiv.dataset.version = meta?.version || 1;
+  if (isOutgoing && id && !meta?.deleted) {
+    messageDiv.dataset.text = message;
+    // Right click (long press on touch screens) edits or deletes your own message
+    messageDiv.addEventListener('contextmenu', (e) => {
+      e.preventDefault();
+      changeOwnMessage(messageDiv);
+    });
+  }
 
   // Track newest message ID
   if (timestamp) {
@@ -321,54 +371,79 @@ function newMessageElement(message, isOutgoing, id = null, timestamp = null) {
 // OLDER MESSAGES LOADER (PULL-TO-REFRESH)
 // ============================================================================
 
+function removeOlderMessageLoaders(loaderDiv, blankDiv) {
+  if (blankDiv?.parentNode) {
+    blankDiv.classList.add('removing');
+    setTimeout(() => blankDiv.parentNode?.removeChild(blankDiv), 200);
+  }
+  if (loaderDiv?.parentNode) {
+    loaderDiv.classList.add('pop-out');
+    setTimeout(() => loaderDiv.parentNode?.removeChild(loaderDiv), 300);
+  }
+}
+
+function renderOlderMessages(data, loaderDiv, blankDiv) {
+  setTimeout(() => {
+    const messages = (data.messages || []).slice().reverse();
+    if (messages.length > 0) {
+      const currentUser = JSON.parse(localStorage.getItem('user_info') || '{}').username;
+      messages.forEach((message) => {
+        const messageElement = newMessageElement(
+          message.message,
+          message.username === currentUser,
+          message.id,
+          message.timestamp,
+          message
+        );
+        messageArea.insertBefore(messageElement, messageArea.firstChild);
+        applyMessageSpacing(messageElement);
+      });
+      oldestMessageId = messages[messages.length - 1].id || oldestMessageId;
+    }
+    removeOlderMessageLoaders(loaderDiv, blankDiv);
+    isLoadingOlderMessages = false;
+  }, 500);
+}
+
+// History pages are fetched over HTTP so the browser cache can answer scroll-back.
+// The URL carries the room's history version: pages at the current version are
+// cached outright, and any edit or delete moves the room to new URLs
+function fetchHistoryPage(room, beforeMessageId) {
+  let url = `/api/history/${encodeURIComponent(room)}?before=${encodeURIComponent(beforeMessageId)}&limit=50`;
+  if (historyVersion !== null) url += `&v=${historyVersion}`;
+  return fetch(url, { credentials: 'same-origin' }).then((response) => {
+    if (!response.ok) throw new Error(`History request failed: ${response.status}`);
+    return response.json();
+  }).then((data) => {
+    if (room === currentRoom && data.data) historyVersion = data.data.history_version ?? historyVersion;
+    return data;
+  });
+}
+
 function loadOlderMessages(beforeMessageId, loaderDiv, blankDiv) {
   if (!beforeMessageId || isLoadingOlderMessages) return;
 
   isLoadingOlderMessages = true;
+  if (currentRoom) {
+    fetchHistoryPage(currentRoom, beforeMessageId)
+      .then((data) => renderOlderMessages(data.data, loaderDiv, blankDiv))
+      .catch((err) => {
+        console.error('loadOlderMessages', err);
+        removeOlderMessageLoaders(loaderDiv, blankDiv);
+        isLoadingOlderMessages = false;
+      });
+    return;
+  }
+
   socket.emit('get_older_messages', { before_message_id: beforeMessageId });
 
   socket.once('older_messages', function(data) {
-    setTimeout(() => {
-      data.messages.reverse();
-      if (data.messages?.length > 0) {
-        data.messages.forEach((message) => {
-          const currentUser = JSON.parse(localStorage.getItem('user_info') || '{}').username;
-          const messageElement = newMessageElement(
-            message.message,
-            message.username === currentUser,
-            message.id,
-            message.timestamp
-          );
-          messageArea.insertBefore(messageElement, messageArea.firstChild);
-          applyMessageSpacing(messageElement);
-        });
-        oldestMessageId = data.messages[data.messages.length - 1].id || oldestMessageId;
-      }
-
-      // Remove loaders with animation
-      if (blankDiv?.parentNode) {
-        blankDiv.classList.add('removing');
-        setTimeout(() => blankDiv.parentNode?.removeChild(blankDiv), 200);
-      }
-      if (loaderDiv?.parentNode) {
-        loaderDiv.classList.add('pop-out');
-        setTimeout(() => loaderDiv.parentNode?.removeChild(loaderDiv), 300);
-      }
-
-      isLoadingOlderMessages = false;
-    }, 500);
+    renderOlderMessages(data, loaderDiv, blankDiv);
   });
 
   socket.once('error', function(data) {
     if (data.message?.includes('older messages')) isLoadingOlderMessages = false;
-    if (blankDiv?.parentNode) {
-      blankDiv.classList.add('removing');
-      setTimeout(() => blankDiv.parentNode?.removeChild(blankDiv), 200);
-    }
-    if (loaderDiv?.parentNode) {
-      loaderDiv.classList.add('pop-out');
-      setTimeout(() => loaderDiv.parentNode?.removeChild(loaderDiv), 200);
-    }
+    removeOlderMessageLoaders(loaderDiv, blankDiv);
   });
 }
 
@@ -425,37 +500,94 @@ function playNotificationSound(soundFilePath) {
 // SEND MESSAGE
 // ============================================================================
 
+function newClientId() {
+  if (window.crypto?.randomUUID) return crypto.randomUUID();
+  return Date.now().toString(36) + Math.random().toString(36).slice(2, 12);
+}
+
 function sendMessage() {
   const messageText = messageInputField.value.trim();
   if (!messageText) return;
-  if (!socket || !isConnected) {
+  if (!socket) {
     console.error('Socket.IO not connected');
     return;
   }
 
-  const nowTs = new Date().toISOString();
   messageInputField.value = '';
   messageArea.scrollTop = messageArea.scrollHeight;
 
-  socket.emit('send_message', {
-    message: messageText,
-    timestamp: new Date().toISOString()
-  });
-
-  const sendTimeout = setTimeout(() => {
-    outgoingMessage.classList.add('message-failed');
-  }, 4000);
+  // The key stays the same across retries, so the server stores the message once
+  const clientId = newClientId();
+  pendingSends.set(clientId, { message: messageText, attempts: 0, timer: null });
+  emitPendingSend(clientId);
+}
 
-  socket.once('message_sent', function(data) {
-    clearTimeout(sendTimeout);
-    if (data.success) {
-      outgoingMessage.classList.remove('message-failed');
-      if (data.id) outgoingMessage.dataset.messageId = data.id;
-    } else {
-      console.error('Failed to send message:', data);
-      outgoingMessage.classList.add('message-failed');
+function emitPendingSend(clientId) {
+  const pending = pendingSends.get(clientId);
+  if (!pending) return;
+  clearTimeout(pending.timer);
+  pending.attempts += 1;
+  if (isConnected) {
+    socket.emit('send_message', {
+      message: pending.message,
+      client_id: clientId,
+      timestamp: new Date().toISOString()
+    });
+  }
+  // No ack yet: resend with backoff; a duplicate is answered with the original ack
+  pending.timer = setTimeout(() => {
+    if (pending.attempts >= SEND_MAX_ATTEMPTS) {
+      pendingSends.delete(clientId);
+      showSendFailed(pending.message);
+      return;
     }
-  });
+    emitPendingSend(clientId);
+  }, SEND_RETRY_MS * pending.attempts);
+}
+
+function resendPendingMessages() {
+  pendingSends.forEach((_, clientId) => emitPendingSend(clientId));
+}
+
+function showSendFailed(messageText) {
+  const notice = document.createElement('div');
+  notice.classList.add('message', 'system', 'error', 'message-failed');
+  notice.innerHTML = `<p><em>Không gửi được: ${escapeHTML(messageText)}</em></p>`;
+  messageArea.appendChild(notice);
+  messageArea.scrollTop = messageArea.scrollHeight;
+}
+
+// ============================================================================
+// EDIT / DELETE
+// ============================================================================
+
+function changeOwnMessage(messageDiv) {
+  if (!socket || !isConnected) return;
+  const text = prompt('Sửa tin nhắn (để trống để xoá):', messageDiv.dataset.text || '');
+  if (text === null) return;
+  // The version lets the server reject an edit based on an outdated copy
+  const change = { message_id: messageDiv.dataset.messageId, version: Number(messageDiv.dataset.version) };
+  if (!text.trim()) {
+    if (confirm('Xoá tin nhắn này?')) socket.emit('delete_message', change);
+  } else if (text.trim() !== messageDiv.dataset.text) {
+    socket.emit('edit_message', { ...change, message: text.trim() });
+  }
+}
+
+// Re-render a message from an edit/delete, ignoring versions we already show
+function applyMessageChange(change) {
+  const old = messageArea.querySelector(`[data-message-id="${CSS.escape(change.id)}"]`);
+  if (!old || Number(old.dataset.version || 1) >= change.version) return;
+  const updated = newMessageElement(
+    change.message,
+    old.classList.contains('outgoing'),
+    change.id,
+    old.dataset.timestamp,
+    change
+  );
+  old.replaceWith(updated);
+  applyMessageSpacing(updated);
+  renderReceipts();
 }
 
 // ============================================================================
@@ -640,27 +772,91 @@ async function handlePastedImage(file) {
 // SOCKET.IO SETUP
 // ============================================================================
 
-function connectSocketIO() {
+// Opt-in binary protocol: the MessagePack codec and parser are only fetched when
+// the server announces SOCKETIO_SERIALIZER=msgpack through /socket-config.js
+
+function loadScript(src) {
+  return new Promise((resolve, reject) => {
+    const el = document.createElement('script');
+    el.src = src;
+    el.onload = resolve;
+    el.onerror = reject;
+    document.head.appendChild(el);
+  });
+}
+
+async function socketParserOptions() {
+  if (window.SOCKET_CONFIG?.serializer !== 'msgpack') return {};
+  await loadScript('/files/msgpack.js');
+  await loadScript('/files/socket-msgpack-parser.js');
+  return { parser: window.socketMsgpackParser };
+}
+
+// Spread manual reconnects so a restarting server is not hit by every client at once
+function reconnectDelay() {
+  const base = drainReconnect ? 0 : 5000;
+  return base + Math.random() * reconnectJitterMs;
+}
+
+// Load history once connected; catch-up reads after a reconnect are spread over the server's hint
+function syncHistory(hint) {
+  if (hint?.jitter_ms) reconnectJitterMs = hint.jitter_ms;
+  if (!newestMessageId) {
+    socket.emit('get_recent_messages');
+    return;
+  }
+  const delay = Math.random() * (hint?.sync_jitter_ms || 0);
+  setTimeout(() => {
+    if (isConnected) {
+      socket.emit('get_messages_since_reconnect', { last_message_id: newestMessageId, since: lastSyncTime });
+    }
+  }, delay);
+}
+
+// Too many changes (or nothing to sync from): start the room over from the newest page
+function reloadRoom() {
+  messageArea.innerHTML = '';
+  oldestMessageId = null;
+  newestMessageId = null;
+  lastSyncTime = null;
+  historyVersion = null;
+  isLoadingOlderMessages = false;
+  socket.emit('get_recent_messages');
+}
+
+async function connectSocketIO() {
+  const parserOptions = await socketParserOptions();
   socket = io({
+    ...parserOptions,
+    ...(window.SOCKET_CONFIG?.transports ? { transports: window.SOCKET_CONFIG.transports } : {}),
+    // Resend the room being viewed so a reconnect keeps the admin's current view
+    auth: (cb) => cb(currentRoom ? { room: currentRoom } : {}),
     reconnection: true,
     reconnectionDelay: 1000,
     reconnectionDelayMax: 5000,
     reconnectionAttempts: Infinity,
+    randomizationFactor: 0.5,  // Jitter automatic reconnects so clients do not return in lockstep
     pingInterval: 15000,  // Send ping every 15 seconds (like messenger)
     pingTimeout: 10000,   // Wait 10 seconds for pong response
   });
 
   socket.on('connect', function() {
     isConnected = true;
-    if (newestMessageId) {
-      socket.emit('get_messages_since_reconnect', { last_message_id: newestMessageId });
-    } else {
-      socket.emit('get_recent_messages');
-    }
   });
 
   socket.on('status', function(data) {
     if (data.type === 'connected') {
+      currentRoom = data.data?.room || currentRoom;
+      onlineUsers = new Set(data.data?.online || []);
+      renderPresence();
+      if (data.data?.rooms) {
+        inboxRoom = data.data.inbox || null;
+        availableRooms = data.data.rooms;
+        unreadCounts = data.data.unread || {};
+        renderRoomSwitcher();
+      }
+      syncHistory(data.data?.reconnect);
+      resendPendingMessages();
       const statusMessage = document.createElement('div');
       statusMessage.classList.add('message', 'system');
       statusMessage.innerHTML = `<p><em>${data.message}</em></p>`;
@@ -673,24 +869,74 @@ function connectSocketIO() {
   });
 
   socket.on('new_message', function(data) {
+    if (data.view && currentRoom && data.view !== currentRoom) {
+      // Update for a conversation this (admin) socket is subscribed to but not viewing
+      if (data.view === inboxRoom && data.room !== currentRoom) {
+        unreadCounts[data.room] = (unreadCounts[data.room] || 0) + 1;
+        renderRoomSwitcher();
+        playNotificationSound('/files/newmsg.mp3');
+      }
+      return;
+    }
+    hideTyping(data.username);
     const currentUser = JSON.parse(localStorage.getItem('user_info') || '{}').username;
     const willScroll = messageArea.scrollTop - messageArea.scrollHeight + messageArea.clientHeight > -300;
     const incomingMessage = newMessageElement(
       data.message,
       data.username === currentUser,
       data.id,
-      data.timestamp
+      data.timestamp,
+      data
     );
     messageArea.appendChild(incomingMessage);
     applyMessageSpacing(incomingMessage);
     if (willScroll) messageArea.scrollTop = messageArea.scrollHeight;
     if (data.username !== currentUser) {
       playNotificationSound('/files/newmsg.mp3');
+      scheduleDelivered();
+      scheduleMarkRead();
     }
     newestMessageId = data.id || newestMessageId;
+    renderReceipts();
+  });
+
+  socket.on('receipts', function(data) {
+    if (data.room !== currentRoom) return;
+    Object.entries(data.receipts || {}).forEach(([user, markers]) => {
+      roomReceipts[user] = { ...roomReceipts[user], ...markers };
+    });
+    renderReceipts();
+  });
+
+  socket.on('message_changed', function(data) {
+    // Admin sockets get one copy per view; apply the one formatted for the open conversation
+    if (data.view && currentRoom && data.view !== currentRoom) return;
+    historyVersion = null;
+    applyMessageChange(data);
+  });
+
+  socket.on('room_switched', function(data) {
+    currentRoom = data.room;
+    onlineUsers = new Set(data.online || []);
+    renderPresence();
+    Object.keys(typingTimers).forEach(hideTyping);
+    unreadCounts[data.room] = 0;
+    renderRoomSwitcher();
+    messageArea.innerHTML = '';
+    oldestMessageId = null;
+    newestMessageId = null;
+    lastSyncTime = null;
+    roomReceipts = {};
+    isLoadingOlderMessages = false;
+    socket.emit('get_recent_messages');
+    loadCurrentRoomName();
+    updateDisplayedNicknames();
   });
 
   socket.on('recent_messages', function(data) {
+    lastSyncTime = data.server_time || lastSyncTime;
+    historyVersion = data.history_version ?? null;
+    roomReceipts = data.receipts || roomReceipts;
     if (data.messages?.length > 0) {
       const currentUser = JSON.parse(localStorage.getItem('user_info') || '{}').username;
       data.messages.forEach((message) => {
@@ -698,7 +944,8 @@ function connectSocketIO() {
           message.message,
           message.username === currentUser,
           message.id,
-          message.timestamp
+          message.timestamp,
+          message
         );
         messageArea.appendChild(msgEl);
         applyMessageSpacing(msgEl);
@@ -707,10 +954,44 @@ function connectSocketIO() {
       oldestMessageId = data.messages[0].id || null;
       newestMessageId = data.messages[data.messages.length - 1].id || null;
     }
+    renderReceipts();
+    scheduleDelivered();
+    scheduleMarkRead();
   });
 
   socket.on('message_sent', function(data) {
-    if (data.success) newestMessageId = data.id || newestMessageId;
+    const pending = pendingSends.get(data.client_id);
+    if (!pending) return;
+    clearTimeout(pending.timer);
+    pendingSends.delete(data.client_id);
+  });
+
+  socket.on('presence', function(data) {
+    if (data.room !== currentRoom) return;
+    if (data.online) onlineUsers.add(data.user);
+    else onlineUsers.delete(data.user);
+    if (!data.online) hideTyping(data.user);
+    renderPresence();
+  });
+
+  socket.on('typing', function(data) {
+    if (data.room !== currentRoom || data.user === currentUsername()) return;
+    showTyping(data.user);
+  });
+
+  // Server-side send limiter: hold the send button until the bucket refills
+  socket.on('rate_limited', function(data) {
+    const waitMs = Math.ceil((data.retry_after || 1) * 1000);
+    const notice = document.createElement('div');
+    notice.classList.add('message', 'system', 'error');
+    notice.innerHTML = `<p><em>Gửi chậm lại chút nhé! Thử lại sau ${Math.ceil(waitMs / 1000)}s</em></p>`;
+    messageArea.appendChild(notice);
+    messageArea.scrollTop = messageArea.scrollHeight;
+    if (sendButton) {
+      sendButton.disabled = true;
+      setTimeout(() => { sendButton.disabled = false; }, waitMs);
+    }
+    setTimeout(() => notice.remove(), waitMs + 1000);
   });
 
   socket.on('error', function(data) {
@@ -733,8 +1014,22 @@ function connectSocketIO() {
       statusMessage.remove();
     }, 1000);
     setTimeout(() => {
+      drainReconnect = false;
       if (!isConnected) socket.connect();
-    }, 5000);
+    }, reconnectDelay());
+  });
+
+  socket.on('server_draining', function(data) {
+    // The server is restarting: leave now and come back at a random moment
+    drainReconnect = true;
+    reconnectJitterMs = data?.reconnect_jitter_ms || reconnectJitterMs;
+    socket.disconnect();
+  });
+
+  socket.on('resync_required', function(data) {
+    // We fell too far behind; the server drops us and history fills the gap after reconnecting
+    drainReconnect = true;
+    reconnectJitterMs = data?.reconnect_jitter_ms || reconnectJitterMs;
   });
 
   socket.on('reconnect', function() {
@@ -744,10 +1039,18 @@ function connectSocketIO() {
     statusMessage.innerHTML = `<p><em>Reconnected</em></p>`;
     messageArea.appendChild(statusMessage);
     messageArea.scrollTop = messageArea.scrollHeight;
-    socket.emit('get_messages_since_reconnect', { last_message_id: newestMessageId });
+    socket.emit('get_messages_since_reconnect', { last_message_id: newestMessageId, since: lastSyncTime });
   });
 
   socket.on('messages_since_reconnect', function(data) {
+    // History may have changed while disconnected; the next page reports the version
+    historyVersion = null;
+    if (!data.changes_complete) {
+      reloadRoom();
+      return;
+    }
+    lastSyncTime = data.server_time || lastSyncTime;
+    (data.changes || []).forEach(applyMessageChange);
     if (data.messages?.length > 0) {
       const currentUser = JSON.parse(localStorage.getItem('user_info') || '{}').username;
       let hasNewMessages = false;
@@ -757,7 +1060,8 @@ function connectSocketIO() {
             message.message,
             message.username === currentUser,
             message.id,
-            message.timestamp
+            message.timestamp,
+            message
           );
           messageArea.appendChild(msgEl);
           applyMessageSpacing(msgEl);
@@ -768,7 +1072,10 @@ function connectSocketIO() {
       });
       if (hasNewMessages) {
         playNotificationSound('/files/newmsg.mp3');
+        scheduleDelivered();
+        scheduleMarkRead();
       }
+      renderReceipts();
       messageArea.scrollTop = messageArea.scrollHeight;
     }
   });
@@ -1022,6 +1329,7 @@ if (messageArea) {
 
 // Input event listeners
 sendButton?.addEventListener('click', sendMessage);
+messageInputField?.addEventListener('input', notifyTyping);
 messageInputField?.addEventListener('keydown', (e) => {
   if (e.key === 'Enter') {
     e.preventDefault();
@@ -1143,8 +1451,9 @@ if (switchThemeToggle) {
 }
 
 // Load current room
-if (roomInfo && roomnameDisplay) {
-  fetch('/api/get-current-room', {
+function loadCurrentRoomName() {
+  if (!roomInfo || !roomnameDisplay) return;
+  fetch('/api/get-current-room' + roomQueryString(), {
     method: 'GET',
     credentials: 'same-origin'
   })
@@ -1152,10 +1461,148 @@ if (roomInfo && roomnameDisplay) {
     .then((data) => {
       if (data.success && data.data) {
         roomnameDisplay.textContent = data.data.room;
+        roomnameDisplay.removeAttribute('data-original-roomname');
       }
     });
 }
 
+loadCurrentRoomName();
+
+// ============================================================================
+// PRESENCE & TYPING INDICATOR
+// ============================================================================
+
+function currentUsername() {
+  return JSON.parse(localStorage.getItem('user_info') || '{}').username;
+}
+
+function renderPresence() {
+  const me = currentUsername();
+  const othersOnline = Array.from(onlineUsers).some((user) => user !== me);
+  roomInfo?.classList.toggle('peer-online', othersOnline);
+}
+
+function renderTypingIndicator() {
+  let indicator = document.getElementById('typing-indicator');
+  const typers = Object.keys(typingTimers);
+  if (!typers.length) {
+    indicator?.remove();
+    return;
+  }
+  if (!indicator) {
+    indicator = document.createElement('div');
+    indicator.id = 'typing-indicator';
+    indicator.classList.add('typing-indicator');
+    document.querySelector('.message-input')?.before(indicator);
+  }
+  indicator.textContent = `${typers.join(', ')} đang nhập...`;
+}
+
+function showTyping(user) {
+  clearTimeout(typingTimers[user]);
+  typingTimers[user] = setTimeout(() => hideTyping(user), TYPING_DISPLAY_MS);
+  renderTypingIndicator();
+}
+
+function hideTyping(user) {
+  clearTimeout(typingTimers[user]);
+  delete typingTimers[user];
+  renderTypingIndicator();
+}
+
+// Keystrokes are throttled here too; the server coalesces anything that slips through
+function notifyTyping() {
+  const now = Date.now();
+  if (!socket || !isConnected || now - lastTypingSentAt < TYPING_SEND_INTERVAL_MS) return;
+  if (!messageInputField.value.trim()) return;
+  lastTypingSentAt = now;
+  socket.emit('typing', { room: currentRoom });
+}
+
+// ============================================================================
+// ROOM SWITCHER & UNREAD COUNTERS
+// ============================================================================
+
+// Admin API calls act on the room being viewed rather than the stored room
+function roomQueryString() {
+  return availableRooms.length && currentRoom ? `?room=${encodeURIComponent(currentRoom)}` : '';
+}
+
+function renderRoomSwitcher() {
+  if (!roomSwitcher) return;
+  roomSwitcher.innerHTML = '';
+  availableRooms.forEach((room) => {
+    const option = document.createElement('option');
+    const unread = unreadCounts[room] || 0;
+    option.value = room;
+    option.textContent = unread > 0 ? `${room} (${unread})` : room;
+    option.selected = room === currentRoom;
+    roomSwitcher.appendChild(option);
+  });
+  roomSwitcher.classList.toggle('hidden', availableRooms.length === 0);
+}
+
+function switchRoom(room) {
+  if (!socket || !isConnected || !room || room === currentRoom) return;
+  socket.emit('switch_room', { room });
+}
+
+// Tell the server the current room has been seen (debounced, only while visible);
+// the read receipt also clears the unread counter
+function scheduleMarkRead() {
+  if (document.visibilityState !== 'visible') return;
+  clearTimeout(markReadTimeout);
+  markReadTimeout = setTimeout(() => sendReceipt('read'), 1000);
+}
+
+function scheduleDelivered() {
+  clearTimeout(deliveredTimeout);
+  deliveredTimeout = setTimeout(() => sendReceipt('delivered'), 1000);
+}
+
+// One cumulative marker for the newest message shown, only when it moved
+function sendReceipt(kind) {
+  if (!socket || !isConnected) return;
+  const newest = Array.from(messageArea.querySelectorAll('.message[data-message-id][data-timestamp]')).pop();
+  if (!newest || lastSentReceipt[kind] === newest.dataset.messageId) return;
+  lastSentReceipt[kind] = newest.dataset.messageId;
+  socket.emit('receipt', { kind, up_to: newest.dataset.messageId });
+}
+
+// Mark the latest of our messages each other participant has read (or only received)
+function renderReceipts() {
+  messageArea.querySelectorAll('.receipt-mark').forEach((el) => el.remove());
+  const me = currentUsername();
+  const marks = new Map();
+  Object.entries(roomReceipts).forEach(([user, markers]) => {
+    if (user === me) return;
+    [['delivered', 'Đã nhận'], ['read', 'Đã xem']].forEach(([kind, label]) => {
+      const target = lastOutgoingUpTo(markers[kind]);
+      // Read wins over delivered on the same message
+      if (target && (kind === 'read' || !marks.has(target))) marks.set(target, label);
+    });
+  });
+  marks.forEach((label, el) => {
+    const mark = document.createElement('span');
+    mark.className = 'receipt-mark';
+    mark.textContent = label;
+    el.appendChild(mark);
+  });
+}
+
+function lastOutgoingUpTo(messageId) {
+  if (!messageId) return null;
+  let last = null;
+  for (const el of messageArea.querySelectorAll('.message[data-message-id]')) {
+    if (el.classList.contains('outgoing')) last = el;
+    if (el.dataset.messageId === messageId) return last;
+  }
+  return null;
+}
+
+roomSwitcher?.addEventListener('change', () => switchRoom(roomSwitcher.value));
+document.addEventListener('visibilitychange', scheduleMarkRead);
+
 // ============================================================================
 // APP INITIALIZATION
 // ============================================================================
@@ -1271,7 +1718,12 @@ function setupMobileDropdown() {
   if (mobileChangeRoomBtn) {
     mobileChangeRoomBtn.addEventListener('click', () => {
       closeMobileDropdown();
-      location.href = '/change';
+      if (roomSwitcher && availableRooms.length) {
+        roomSwitcher.focus();
+        roomSwitcher.showPicker?.();
+      } else {
+        location.href = '/change';
+      }
     });
   }
 
@@ -1372,7 +1824,7 @@ const theirNicknameInput = document.getElementById('their-nickname-input');
 // Load nicknames from API
 async function loadNicknames() {
   try {
-    const response = await fetch('/api/get-nicknames', {
+    const response = await fetch('/api/get-nicknames' + roomQueryString(), {
       method: 'GET',
       credentials: 'same-origin'
     });
@@ -1409,7 +1861,8 @@ async function saveNicknames() {
       credentials: 'same-origin',
       body: JSON.stringify({
         me_nickname: myNickname,
-        their_nickname: theirNickname
+        their_nickname: theirNickname,
+        room: roomQueryString() ? currentRoom : undefined
       })
     });
     
@@ -1439,7 +1892,7 @@ async function saveNicknames() {
 // Update the displayed usernames with nicknames from API
 async function updateDisplayedNicknames() {
   try {
-    const response = await fetch('/api/get-nicknames', {
+    const response = await fetch('/api/get-nicknames' + roomQueryString(), {
       method: 'GET',
       credentials: 'same-origin'
     });
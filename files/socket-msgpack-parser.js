@@ -0,0 +1,67 @@
+// ============================================================================
+// Socket.IO MessagePack parser
+// ============================================================================
+// Client half of the server's SOCKETIO_SERIALIZER=msgpack mode. Mirrors
+// python-socketio's MsgPackPacket: each packet is one MessagePack map
+// {type, data, nsp, id?} sent as a binary frame. Needs files/msgpack.js
+// (global `MessagePack`) to be loaded first.
+
+(function () {
+  const PacketType = {
+    CONNECT: 0,
+    DISCONNECT: 1,
+    EVENT: 2,
+    ACK: 3,
+    CONNECT_ERROR: 4,
+    BINARY_EVENT: 5,
+    BINARY_ACK: 6
+  };
+
+  class Encoder {
+    encode(packet) {
+      const out = { type: packet.type, data: packet.data, nsp: packet.nsp || '/' };
+      if (packet.id !== undefined && packet.id !== null) out.id = packet.id;
+      return [MessagePack.encode(out)];
+    }
+  }
+
+  class Decoder {
+    constructor() {
+      this.listeners = {};
+    }
+
+    on(event, fn) {
+      (this.listeners[event] = this.listeners[event] || []).push(fn);
+      return this;
+    }
+
+    off(event, fn) {
+      if (!event) this.listeners = {};
+      else if (!fn) delete this.listeners[event];
+      else this.listeners[event] = (this.listeners[event] || []).filter((f) => f !== fn);
+      return this;
+    }
+
+    emit(event, ...args) {
+      (this.listeners[event] || []).slice().forEach((fn) => fn.apply(this, args));
+      return this;
+    }
+
+    add(chunk) {
+      if (typeof chunk === 'string') throw new Error('Unexpected text frame in msgpack mode');
+      const packet = MessagePack.decode(chunk instanceof ArrayBuffer ? new Uint8Array(chunk) : chunk);
+      if (typeof packet?.type !== 'number' || packet.type < PacketType.CONNECT || packet.type > PacketType.BINARY_ACK) {
+        throw new Error('Invalid msgpack packet');
+      }
+      if (packet.nsp === undefined || packet.nsp === null) packet.nsp = '/';
+      if (packet.id === null) delete packet.id;
+      this.emit('decoded', packet);
+    }
+
+    destroy() {
+      this.off();
+    }
+  }
+
+  window.socketMsgpackParser = { protocol: 5, PacketType, Encoder, Decoder };
+})();
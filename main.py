@@ -1,29 +1,62 @@
-from flask import Flask, redirect, session, request
+import os
+# STARTUP_PROFILE=1 reports import and init cost per module once the app is set up
+STARTUP_PROFILE = os.getenv('STARTUP_PROFILE') == '1'
+if STARTUP_PROFILE:
+    from scripts import startup_profile
+    startup_profile.install()
+
+from flask import Flask, redirect, session, request, make_response
 from flask_socketio import SocketIO
 from datetime import timedelta
-import os
+from contextlib import nullcontext
+import json
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
 # Import our modules
-from scripts.auth import require_login, is_logged_in, require_dtanh
-from scripts.user_manager import load_users
+from scripts.auth import require_login, is_logged_in, require_dtanh, is_me
 from scripts.socket_handlers import (
     handle_connect, handle_disconnect, handle_send_message,
     handle_get_older_messages, handle_get_recent_messages,
-    handle_get_messages_since_reconnect, handle_nickname_changed_notify
+    handle_get_messages_since_reconnect, handle_nickname_changed_notify,
+    handle_switch_room, handle_mark_read, handle_typing,
+    handle_edit_message, handle_delete_message, handle_receipt
 )
 from scripts.api_routes import register_api_routes
+from scripts.metrics import init_app as init_metrics, track_event
+from scripts.tracing import init_app as init_tracing, TRACE_EXPORTER, TRACE_FILE
+from scripts import archiver, receipts, backpressure, ws_compression
+from scripts.message_handler import mongo_client, replay_journal_forever
+from scripts.journal import JOURNAL_ENABLED, JOURNAL_DIR
+from scripts.data_dir import ensure_not_served
+from scripts.assets import send_asset, send_page
+from scripts.server import backoff_delay, RESTART_BACKOFF_RESET
 
 # Flask and SocketIO setup
 app = Flask(__name__, static_folder='.', static_url_path='')
 app.secret_key = os.getenv('FLASK_SECRET_KEY')
+# The static folder is the app root; never let private server files land in it
+if JOURNAL_ENABLED:
+    ensure_not_served('JOURNAL_DIR', JOURNAL_DIR, app.static_folder)
+if TRACE_EXPORTER == 'file':
+    ensure_not_served('TRACE_FILE', TRACE_FILE, app.static_folder)
+if archiver.ARCHIVE_STORAGE == 'disk':
+    ensure_not_served('ARCHIVE_DIR', archiver.ARCHIVE_DIR, app.static_folder)
+# Wire format: 'default' (JSON text) or 'msgpack' (binary, needs the msgpack package)
+SOCKETIO_SERIALIZER = os.getenv('SOCKETIO_SERIALIZER', 'default')
+# Set by scripts.server; several workers share emits through SOCKETIO_MESSAGE_QUEUE
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
 socketio = SocketIO(
     app,
     cors_allowed_origins="*",
     ping_timeout=10,      # Server waits 10 seconds for client pong
     ping_interval=15,     # Server sends ping every 15 seconds
-    max_http_buffer_size=1e6  # 1MB for image uploads
+    max_http_buffer_size=1e6,  # 1MB for image uploads
+    serializer=SOCKETIO_SERIALIZER,
+    http_compression=ws_compression.SOCKETIO_COMPRESSION,  # Long-polling responses
+    compression_threshold=ws_compression.SOCKETIO_COMPRESSION_THRESHOLD,
+    message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE')
 )
 
 # Session configuration
@@ -32,11 +65,25 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True  # Prevents XSS attacks
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # CSRF protection
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)  # Session expires in 7 days
 
-# Load users at startup
-users = load_users()
+def _phase(name):
+    return startup_profile.phase(name) if STARTUP_PROFILE else nullcontext()
 
 # Register API routes
-register_api_routes(app)
+with _phase('register_api_routes'):
+    register_api_routes(app)
+
+# Prometheus metrics: HTTP route timing, emit fan-out and the /metrics endpoint
+with _phase('init_metrics'):
+    init_metrics(app, socketio)
+
+# permessage-deflate for websocket messages above SOCKETIO_COMPRESSION_THRESHOLD
+ws_compression.init_app(socketio)
+
+# Cap the packets queued per connection; slow clients are told to resync from history
+backpressure.init_app(socketio)
+
+# Tracing: a root span per HTTP request; Socket.IO events are traced by track_event
+init_tracing(app)
 
 # Static file routes
 @app.route('/')
@@ -46,24 +93,41 @@ def index():
     """Serve the main page"""
     if is_logged_in():
         if session.get('user_id') == 'dtanh':
-            return app.send_static_file('site/index2.html')
-    return app.send_static_file('site/index.html')
+            return send_page('index2.html')
+    return send_page('index.html')
 
 @app.route('/login')
 def login_page():
     """Serve the login page"""
-    return app.send_static_file('site/login.html')
+    return send_page('login.html')
 
 @app.route('/change')
 @require_dtanh
 def change():
     """Serve the change page"""
-    return app.send_static_file('site/change.html')
+    return send_page('change.html')
 
 @app.route('/what')
 def what_page():
     """Serve the what page"""
-    return app.send_static_file('site/what.html')
+    return send_page('what.html')
+
+@app.route('/socket-config.js')
+def socket_config():
+    """Tell the client which Socket.IO parser and transports to use"""
+    config = {'serializer': SOCKETIO_SERIALIZER}
+    if WEB_CONCURRENCY > 1:
+        # Long-polling requests could land on any worker; a websocket stays on one
+        config['transports'] = ['websocket']
+    response = make_response(f"window.SOCKET_CONFIG = {json.dumps(config)};\n")
+    response.headers['Content-Type'] = 'application/javascript'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/files/<path:filename>')
+def asset_files(filename):
+    """Serve fingerprinted, precompressed assets (see scripts/assets.py)"""
+    return send_asset(filename)
 
 @app.route('/<path:filename>')
 def static_files(filename):
@@ -72,74 +136,134 @@ def static_files(filename):
 
 # Socket.IO event handlers
 @socketio.on('connect')
-def on_connect():
+def on_connect(auth=None):
     """Handle client connection"""
-    handle_connect(request, socketio)
+    handle_connect(request, socketio, auth)
 
 @socketio.on('disconnect')
 def on_disconnect():
     """Handle client disconnection"""
-    handle_disconnect(request)
+    handle_disconnect(request, socketio)
 
 @socketio.on('send_message')
+@track_event('send_message')
 @require_login
 def on_send_message(data):
     """Handle real-time message sending via Socket.IO"""
     handle_send_message(data, socketio)
 
+@socketio.on('edit_message')
+@track_event('edit_message')
+@require_login
+def on_edit_message(data):
+    """Edit one of your own messages"""
+    handle_edit_message(data, socketio)
+
+@socketio.on('delete_message')
+@track_event('delete_message')
+@require_login
+def on_delete_message(data):
+    """Delete a message, leaving a tombstone"""
+    handle_delete_message(data, socketio)
+
 @socketio.on('get_older_messages')
+@track_event('get_older_messages')
 @require_login
 def on_get_older_messages(data):
     """Load older messages"""
     handle_get_older_messages(data)
 
 @socketio.on('get_recent_messages')
+@track_event('get_recent_messages')
 @require_login
 def on_get_recent_messages():
     """Get recent messages"""
     handle_get_recent_messages()
 
 @socketio.on('get_messages_since_reconnect')
+@track_event('get_messages_since_reconnect')
 @require_login
 def on_get_messages_since_reconnect(data):
     """Get messages since last known message ID after reconnect"""
     handle_get_messages_since_reconnect(data)
 
+@socketio.on('switch_room')
+@track_event('switch_room')
+@is_me
+def on_switch_room(data):
+    """Switch the admin's view to another room"""
+    handle_switch_room(data, socketio)
+
+@socketio.on('mark_read')
+@track_event('mark_read')
+@require_login
+def on_mark_read(data=None):
+    """Reset the unread counter for the current room"""
+    handle_mark_read(data)
+
+@socketio.on('receipt')
+@track_event('receipt')
+@require_login
+def on_receipt(data):
+    """Cumulative read/delivered marker for the current room"""
+    handle_receipt(data)
+
+@socketio.on('typing')
+@track_event('typing')
+@require_login
+def on_typing(data=None):
+    """Relay a typing indicator to the room"""
+    handle_typing(data, socketio)
+
 @socketio.on('nickname_changed_notify')
+@track_event('nickname_changed_notify')
 @require_login
 def on_nickname_changed_notify(data):
     """Broadcast nickname change to all clients"""
     handle_nickname_changed_notify(data, socketio)
 
+if STARTUP_PROFILE:
+    startup_profile.report()
+
+def _warm_up():
+    try:
+        mongo_client.ensure_ready()
+    except Exception as e:
+        print(f"MongoDB not reachable yet: {e}")
+
+def start_background_tasks(primary=True):
+    """Per-process background work; singleton jobs only run in the primary worker"""
+    # Connect and create indexes off the boot path; /readyz reports the outcome
+    socketio.start_background_task(_warm_up)
+    # Receipts are buffered per worker and flushed in batches
+    socketio.start_background_task(receipts.run_forever, socketio)
+    # Every worker replays its own journal of sends accepted during a MongoDB outage,
+    # and adopts the journals of workers that have exited
+    if JOURNAL_ENABLED:
+        socketio.start_background_task(replay_journal_forever, socketio.sleep)
+    # Seal old messages into cold archive segments in the background
+    if primary and archiver.ARCHIVE_AFTER_DAYS > 0:
+        socketio.start_background_task(archiver.run_forever, socketio.sleep)
+
 def run_server():
+    """Single-process development server; production uses python -m scripts.server"""
+    start_background_tasks()
+    failures = 0
     while True:
-        #PRODUCTION
-        # try:
-        #     port = int(os.environ.get('PORT', 13882))
-        #     print(f"Starting server on port {port}...")
-        #     # Flask-SocketIO will auto-detect the best async mode
-        #     print(f"Using async mode: {socketio.async_mode}")
-        #     socketio.run(app, host='0.0.0.0', port=port, debug=False)
-        #     break  # If we get here, server stopped normally
-        # except Exception as e:
-        #     print(f"Server crashed: {e}")
-        #     print("Restarting in 3 seconds...")
-        #     import time
-        #     time.sleep(3)
-        #DEBUG
+        started = time.monotonic()
         try:
             port = int(os.environ.get('PORT', 13882))
             print(f"Starting server on port {port}...")
             # Flask-SocketIO will auto-detect the best async mode
             print(f"Using async mode: {socketio.async_mode}")
-            socketio.run(app, host='0.0.0.0', port=port, debug=True)
+            socketio.run(app, host='0.0.0.0', port=port, debug=os.getenv('FLASK_DEBUG') == '1')
             break  # If we get here, server stopped normally
         except Exception as e:
+            failures = 1 if time.monotonic() - started > RESTART_BACKOFF_RESET else failures + 1
+            delay = backoff_delay(failures)
             print(f"Server crashed: {e}")
-            print("Restarting in 3 seconds...")
-            import time
-            time.sleep(3)
-        
+            print(f"Restarting in {delay:.1f} seconds...")
+            time.sleep(delay)
 
 if __name__ == '__main__':
     run_server()
\ No newline at end of file
@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta, timezone
-from flask import request, jsonify, make_response, session, redirect
-from gridfs import GridFS
+import hashlib
+import json
+import os
+from flask import request, jsonify, make_response, session, redirect, Response, stream_with_context
 from bson import ObjectId
 import imghdr
 from io import BytesIO
@@ -9,10 +11,22 @@ from scripts.auth import (hash_password, generate_session_token, store_session,
                   get_session, delete_session, get_active_sessions_count,
                   save_login_history, get_login_history, is_logged_in)
 from scripts.user_manager import save_user
+from scripts.message_handler import (get_rooms_page, get_history_page, get_recent_messages, get_history_version,
+                                     sanitize_for_json, search_messages)
 from scripts.mongo_client import MongoDBClient
+from scripts.db_profiler import get_profile_snapshot, reset_profile
+from scripts.tracing import log_error
+from scripts.room_transfer import export_room, import_room, InvalidImportLine
+
+# Allowed page sizes keep history URLs (and so cache keys) canonical
+HISTORY_PAGE_SIZES = (10, 30, 50, 100)
+# 'private' keeps pages in the browser cache only; 'public' also lets a reverse
+# proxy store them (responses vary on Cookie, so each session gets its own entry)
+HISTORY_CACHE_SCOPE = os.getenv('HISTORY_CACHE_SCOPE', 'private')
+# Freshness of cursor pages requested at the room's current history version
+HISTORY_PAGE_MAX_AGE = int(os.getenv('HISTORY_PAGE_MAX_AGE', '86400'))
 
 mongo_client = MongoDBClient()
-fs = GridFS(mongo_client.client["file_storage"])
 
 
 def api_login():
@@ -141,7 +155,7 @@ def api_login():
         return response
         
     except Exception as e:
-        print(f"Login error: {e}")
+        log_error("Login error", e)
         return jsonify({
             "success": False,
             "message": "Internal server error"
@@ -193,7 +207,7 @@ def api_logout():
         return response
         
     except Exception as e:
-        print(f"Logout error: {e}")
+        log_error("Logout error", e)
         return jsonify({
             "success": False,
             "message": "Internal server error"
@@ -232,7 +246,7 @@ def api_verify():
         }), 401
         
     except Exception as e:
-        print(f"Verify error: {e}")
+        log_error("Verify error", e)
         return jsonify({
             "success": False,
             "message": "Internal server error"
@@ -253,12 +267,45 @@ def api_login_history():
         }), 200
         
     except Exception as e:
-        print(f"Login history error: {e}")
+        log_error("Login history error", e)
+        return jsonify({
+            "success": False,
+            "message": "Internal server error"
+        }), 500
+
+def api_db_profile():
+    """Get MongoDB call latency histograms and slow-query log (admin only)"""
+    try:
+        snapshot = get_profile_snapshot()
+        if request.args.get('reset') == '1':
+            reset_profile()
+        return jsonify({
+            "success": True,
+            "data": snapshot
+        }), 200
+
+    except Exception as e:
+        log_error("DB profile error", e)
         return jsonify({
             "success": False,
             "message": "Internal server error"
         }), 500
 
+def api_ready():
+    """Readiness probe: 200 once MongoDB answers a ping, 503 otherwise"""
+    try:
+        mongo_client.ensure_ready()
+        return jsonify({
+            "success": True,
+            "message": "Ready"
+        }), 200
+    except Exception as e:
+        log_error("Readiness check failed", e)
+        return jsonify({
+            "success": False,
+            "message": "Database unavailable"
+        }), 503
+
 def api_check_session():
     """Check if user has valid session cookie"""
     if is_logged_in():
@@ -278,6 +325,15 @@ def api_check_session():
             "message": "No valid session"
         }), 401
 
+def _admin_room(username):
+    """Room the admin is acting on: the client's current view if given, else the stored room"""
+    room = request.args.get('room')
+    if not room and request.is_json:
+        room = (request.get_json(silent=True) or {}).get('room')
+    if room:
+        return room
+    return mongo_client.user_collection.find_one({'username': username}).get('room', username)
+
 def api_get_current_room():
     """Get the current chat room of the logged-in user"""
     if not is_logged_in():
@@ -293,7 +349,7 @@ def api_get_current_room():
                 "room": mongo_client.user_collection.find_one({'username': username}).get('me_nickname', "DTAnh")
             }
         }), 200
-    room = mongo_client.user_collection.find_one({'username': username}).get('room')
+    room = _admin_room(username)
     return jsonify({
         "success": True,
         "data": {
@@ -302,20 +358,20 @@ def api_get_current_room():
     }), 200
     
 def api_get_chat_rooms():
-    """Get available chat rooms"""
+    """Get available chat rooms, most recently active first"""
     try:
-        # Get all users from MongoDB
-        all_users = mongo_client.user_collection.find({}, {'username': 1})
-        user_ids = [user['username'] for user in all_users]
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        rooms, next_cursor = get_rooms_page(session.get('user_id'), request.args.get('cursor'), limit)
         
         return jsonify({
             "success": True,
             "data": {
-                "rooms": user_ids
+                "rooms": rooms,
+                "next_cursor": next_cursor
             }
         }), 200
     except Exception as e:
-        print(f"Chat rooms error: {e}")
+        log_error("Chat rooms error", e)
         return jsonify({
             "success": False,
             "message": "Internal server error"
@@ -348,7 +404,7 @@ def api_change_nickname(new_me_nickname, new_their_nickname):
     try:
         # Update nicknames in MongoDB
         if username == 'dtanh':
-            room = mongo_client.user_collection.find_one({'username': username}).get('room', username)
+            room = _admin_room(username)
             username = room
         mongo_client.change_me_nickname(username, new_me_nickname)
         mongo_client.change_their_nickname(username, new_their_nickname)
@@ -358,7 +414,7 @@ def api_change_nickname(new_me_nickname, new_their_nickname):
             "message": "Nickname changed successfully"
         }), 200
     except Exception as e:
-        print(f"Change nickname error: {e}")
+        log_error("Change nickname error", e)
         return jsonify({
             "success": False,
             "message": "Internal server error"
@@ -375,7 +431,7 @@ def api_get_nicknames():
     try:
         room=None
         if username == 'dtanh':
-            room = mongo_client.user_collection.find_one({'username': username}).get('room', username)
+            room = _admin_room(username)
             username = room
         me_nickname, their_nickname = mongo_client.get_nicknames(username)
         if me_nickname is None or me_nickname.strip() == "":
@@ -390,7 +446,180 @@ def api_get_nicknames():
             }
         }), 200
     except Exception as e:
-        print(f"Get nicknames error: {e}")
+        log_error("Get nicknames error", e)
+        return jsonify({
+            "success": False,
+            "message": "Internal server error"
+        }), 500
+
+def _history_etag(room, before, messages):
+    """Strong validator derived from the page's identity and contents"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([room, before], separators=(',', ':')).encode())
+    for message in messages:
+        # Edits and deletes bump the version, so they change the validator too
+        digest.update(json.dumps([message.get('id'), message.get('timestamp'), message.get('message'),
+                                  message.get('version', 1), bool(message.get('deleted'))],
+                                 separators=(',', ':'), ensure_ascii=False).encode())
+    return digest.hexdigest()[:32]
+
+def _cursor_etag(room, before, limit, version):
+    """Validator of a cursor page at a history version, known without reading the page"""
+    key = json.dumps([room, before, limit, version], separators=(',', ':'))
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def _cache_history_headers(response, cacheable):
+    response.headers['Vary'] = 'Cookie'
+    if cacheable:
+        response.headers['Cache-Control'] = f'{HISTORY_CACHE_SCOPE}, max-age={HISTORY_PAGE_MAX_AGE}'
+    else:
+        # The newest page grows with every send and an old version's page may have changed:
+        # revalidate with the content ETag each time (a 304 skips the body)
+        response.headers['Cache-Control'] = f'{HISTORY_CACHE_SCOPE}, no-cache'
+    return response
+
+def api_history_page(room):
+    """Serve a page of room history addressed by cursor.
+
+    Edits, deletes and late inserts bump the room's history version. A
+    cursor page requested with the current version (v=) is cached for
+    HISTORY_PAGE_MAX_AGE: its URL changes with the next bump, and its ETag
+    is derived from the URL, so a revalidation is answered without reading
+    the page. The newest page, and pages asked for at an old version, are
+    revalidated every time against an ETag of their contents.
+    """
+    username = session.get('user_id')
+    if username != 'dtanh' and room != username:
+        return jsonify({
+            "success": False,
+            "message": "Not authorized"
+        }), 403
+    limit = request.args.get('limit', 50, type=int)
+    if limit not in HISTORY_PAGE_SIZES:
+        return jsonify({
+            "success": False,
+            "message": f"limit must be one of {list(HISTORY_PAGE_SIZES)}"
+        }), 400
+    before = request.args.get('before')
+    requested_version = request.args.get('v', type=int)
+    try:
+        # Read before the page, so a change made meanwhile cannot be cached under this version
+        version = get_history_version(room)
+        cacheable = bool(before) and requested_version == version
+        if cacheable:
+            etag = _cursor_etag(room, before, limit, version)
+            if request.if_none_match.contains(etag):
+                response = _cache_history_headers(make_response('', 304), True)
+                response.set_etag(etag)
+                return response
+        if before:
+            messages = get_history_page(room, before, limit)
+            if messages is None:
+                response = jsonify({
+                    "success": False,
+                    "message": "Message not found"
+                })
+                response.status_code = 404
+                response.headers['Cache-Control'] = 'no-store'
+                return response
+        else:
+            messages = get_recent_messages(room, limit)
+        
+        messages = sanitize_for_json(messages)
+        response = jsonify({
+            "success": True,
+            "data": {
+                "room": room,
+                "messages": messages,
+                "count": len(messages),
+                "next_before": messages[0]['id'] if len(messages) == limit else None,
+                "history_version": version
+            }
+        })
+        response.set_etag(_cursor_etag(room, before, limit, version) if cacheable
+                          else _history_etag(room, before, messages))
+        _cache_history_headers(response, cacheable)
+        return response.make_conditional(request)
+    
+    except Exception as e:
+        log_error("History page error", e)
+        return jsonify({
+            "success": False,
+            "message": "Internal server error"
+        }), 500
+
+def api_search_messages(room):
+    """Full-text search within a room (diacritic-insensitive, exact diacritics rank higher)"""
+    username = session.get('user_id')
+    if username != 'dtanh' and room != username:
+        return jsonify({
+            "success": False,
+            "message": "Not authorized"
+        }), 403
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({
+            "success": False,
+            "message": "Search query required"
+        }), 400
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = min(max(request.args.get('page_size', 20, type=int), 1), 50)
+    try:
+        results, has_more = search_messages(room, query, page, page_size)
+        return jsonify({
+            "success": True,
+            "data": {
+                "results": results,
+                "page": page,
+                "has_more": has_more
+            }
+        }), 200
+    except Exception as e:
+        log_error("Search error", e)
+        return jsonify({
+            "success": False,
+            "message": "Internal server error"
+        }), 500
+
+def api_export_room(room):
+    """Stream a room's full history as gzip-compressed NDJSON (admin only)"""
+    response = Response(stream_with_context(export_room(room)), mimetype='application/gzip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{room}.ndjson.gz"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def api_import_room(room):
+    """Bulk-load a gzip NDJSON export into a room; resend with the same import_id to resume (admin only)"""
+    # One id per file: a shared default would let an old checkpoint skip the start of a new file
+    import_id = request.args.get('import_id', '')
+    if not 0 < len(import_id) <= 128:
+        return jsonify({
+            "success": False,
+            "message": "import_id required (unique per file, reused only to resume)"
+        }), 400
+    try:
+        inserted, lines = import_room(room, request.stream, f"{room}:{import_id}")
+        return jsonify({
+            "success": True,
+            "data": {
+                "inserted": inserted,
+                "lines": lines
+            }
+        }), 200
+    except InvalidImportLine as e:
+        return jsonify({
+            "success": False,
+            "message": f"Invalid import file ({e}); fix it and resend with the same import_id to resume",
+            "line": e.line
+        }), 400
+    except (OSError, EOFError, ValueError) as e:
+        log_error(f"Import error in room {room}", e)
+        return jsonify({
+            "success": False,
+            "message": "Invalid or truncated export file, resend it to resume"
+        }), 400
+    except Exception as e:
+        log_error(f"Import error in room {room}", e)
         return jsonify({
             "success": False,
             "message": "Internal server error"
@@ -428,22 +657,22 @@ def upload_image(file):
         img.save(compressed, format='JPEG', quality=85, optimize=True)
         compressed.seek(0)
         
-        file_id = fs.put(compressed, filename=file.filename, content_type='image/jpeg', chunk_size=65536)
+        file_id = mongo_client.get_gridfs().put(compressed, filename=file.filename, content_type='image/jpeg', chunk_size=65536)
         return str(file_id), None
     except Exception as e:
-        print(f"Image upload error: {e}")
+        log_error("Image upload error", e)
         return None, "Internal server error"
     
 def serve_image(file_id):
     """Serve an image file from GridFS by its ID"""
     try:
-        grid_out = fs.get(ObjectId(file_id))
+        grid_out = mongo_client.get_gridfs().get(ObjectId(file_id))
         response = make_response(grid_out.read())
         response.headers.set('Content-Type', grid_out.content_type)
         response.headers.set('Content-Disposition', 'inline', filename=grid_out.filename)
         return response
     except Exception as e:
-        print(f"Serve image error: {e}")
+        log_error("Serve image error", e)
         return "Image not found", 404
 
 def register_api_routes(app):
@@ -456,10 +685,16 @@ def register_api_routes(app):
     app.add_url_rule('/api/logout', 'api_logout', require_login_api()(api_logout), methods=['POST'])
     app.add_url_rule('/api/verify', 'api_verify', api_verify, methods=['GET'])
     app.add_url_rule('/api/login-history', 'api_login_history', is_me_api()(api_login_history), methods=['GET'])
+    app.add_url_rule('/api/db-profile', 'api_db_profile', is_me_api()(api_db_profile), methods=['GET'])
+    app.add_url_rule('/readyz', 'api_ready', api_ready, methods=['GET'])
     app.add_url_rule('/api/check-session', 'api_check_session', api_check_session, methods=['GET'])
     app.add_url_rule('/api/get-current-room', 'api_get_current_room', require_login_api()(api_get_current_room), methods=['GET'])
     app.add_url_rule('/api/get-chat-rooms', 'api_get_chat_rooms', is_me_api()(api_get_chat_rooms), methods=['GET'])
     app.add_url_rule('/api/join-room/<room>', 'api_join_room', is_me_api()(lambda room: join_room(room)), methods=['POST'])
+    app.add_url_rule('/api/history/<room>', 'api_history_page', require_login_api()(api_history_page), methods=['GET'])
+    app.add_url_rule('/api/search/<room>', 'api_search_messages', require_login_api()(api_search_messages), methods=['GET'])
+    app.add_url_rule('/api/export/<room>', 'api_export_room', is_me_api()(api_export_room), methods=['GET'])
+    app.add_url_rule('/api/import/<room>', 'api_import_room', is_me_api()(api_import_room), methods=['POST'])
     app.add_url_rule('/api/upload-image', 'api_upload_image', require_login_api()(lambda: upload_image(request.files['image'])), methods=['POST'])
     app.add_url_rule('/api/images/<file_id>', 'api_serve_image', serve_image, methods=['GET'])
     app.add_url_rule('/api/change-nickname', 'api_change_nickname', require_login_api()(lambda: api_change_nickname(
@@ -0,0 +1,220 @@
+"""Hot/cold tiering: seal old messages into compressed, append-only archive segments.
+
+Each segment holds ARCHIVE_SEGMENT_SIZE consecutive messages of one room as
+zlib-compressed NDJSON, stored in GridFS (bucket 'archive') or under
+ARCHIVE_DIR. A small index document per segment (time range, count, message
+ids) lives in messages.archive_segments so readers can find it. Until
+archiving is enabled or a segment exists, readers skip that lookup; a
+server notices segments sealed by another process's --once run within
+ARCHIVE_PROBE_INTERVAL.
+
+Search terms are not kept in segments: archived messages still appear in
+history but are no longer found by search_messages.
+
+Usage: python -m scripts.archiver [--once]
+"""
+import json
+import os
+import secrets
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from scripts.data_dir import data_path
+from scripts.mongo_client import MongoDBClient
+from scripts.tracing import log_error
+
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', '0'))  # 0 disables the archiver
+ARCHIVE_SEGMENT_SIZE = int(os.getenv('ARCHIVE_SEGMENT_SIZE', '1000'))
+ARCHIVE_STORAGE = os.getenv('ARCHIVE_STORAGE', 'gridfs')  # 'gridfs' or 'disk'
+# Disk segments hold whole conversations: keep them out of the served tree (checked by main.py)
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR') or data_path('archive')
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+SEGMENT_CACHE_SIZE = int(os.getenv('ARCHIVE_SEGMENT_CACHE_SIZE', '32'))
+# With the archiver off, how often readers look for segments sealed by a manual --once run
+ARCHIVE_PROBE_INTERVAL = float(os.getenv('ARCHIVE_PROBE_INTERVAL', '60'))
+
+mongo_client = MongoDBClient()
+_segment_cache = OrderedDict()
+_probe = {'checked': None, 'found': False}
+
+
+def encode_segment(messages):
+    lines = [json.dumps(message, ensure_ascii=False, separators=(',', ':')) for message in messages]
+    return zlib.compress('\n'.join(lines).encode('utf-8'), 9)
+
+
+def decode_segment(blob):
+    return [json.loads(line) for line in zlib.decompress(blob).decode('utf-8').split('\n') if line]
+
+
+def _write_blob(room, segment_id, blob):
+    """Store a sealed segment and return its location"""
+    if ARCHIVE_STORAGE == 'disk':
+        directory = os.path.join(ARCHIVE_DIR, room)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{segment_id}.ndjson.z")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return path
+    file_id = mongo_client.get_gridfs('archive').put(blob, filename=f"{room}/{segment_id}.ndjson.z",
+                                    content_type='application/x-ndjson+zlib')
+    return str(file_id)
+
+
+def _read_blob(segment):
+    if segment['storage'] == 'disk':
+        with open(segment['location'], 'rb') as f:
+            return f.read()
+    return mongo_client.get_gridfs('archive').get(ObjectId(segment['location'])).read()
+
+
+def read_segment(segment):
+    """Decoded messages of a segment, oldest first, bypassing the cache"""
+    return decode_segment(_read_blob(segment))
+
+
+def load_segment(segment):
+    """Decoded messages of a segment, oldest first (small LRU cache, segments are immutable)"""
+    segment_id = segment['segment_id']
+    messages = _segment_cache.get(segment_id)
+    if messages is not None:
+        _segment_cache.move_to_end(segment_id)
+        return messages
+    messages = read_segment(segment)
+    _segment_cache[segment_id] = messages
+    if len(_segment_cache) > SEGMENT_CACHE_SIZE:
+        _segment_cache.popitem(last=False)
+    return messages
+
+
+def seal_segment(room, messages):
+    """Write one segment, index it, then drop its messages from the hot tier"""
+    for message in messages:
+        message.pop('_id', None)
+    segment_id = secrets.token_hex(8)
+    blob = encode_segment(messages)
+    location = _write_blob(room, segment_id, blob)
+    mongo_client.insert_archive_segment({
+        'segment_id': segment_id,
+        'room': room,
+        'first_timestamp': messages[0].get('timestamp', ''),
+        'last_timestamp': messages[-1].get('timestamp', ''),
+        'count': len(messages),
+        'ids': [message.get('id') for message in messages],
+        'storage': ARCHIVE_STORAGE,
+        'location': location,
+        'bytes': len(blob),
+        'created_at': datetime.now(timezone.utc).isoformat()
+    })
+    _probe['found'] = True
+    # Readers skip hot copies of archived ids, so a crash before this delete only leaves duplicates behind
+    mongo_client.delete_messages({'room': room, 'id': {'$in': [message.get('id') for message in messages]}})
+    return segment_id
+
+
+def archive_room(room, cutoff):
+    """Seal every full segment of messages older than cutoff; return the number sealed"""
+    sealed = 0
+    while True:
+        messages = mongo_client.find_messages(
+            {'room': room, 'timestamp': {'$lt': cutoff}},
+            sort=[('timestamp', 1)],
+            limit=ARCHIVE_SEGMENT_SIZE
+        )
+        # Only full segments are sealed; the remainder waits for the next run
+        if len(messages) < ARCHIVE_SEGMENT_SIZE:
+            return sealed
+        seal_segment(room, messages)
+        sealed += 1
+
+
+def archive_all(age_days=None):
+    age_days = ARCHIVE_AFTER_DAYS if age_days is None else age_days
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=age_days)).isoformat()
+    total = 0
+    for room in mongo_client.rooms_collection.distinct('room'):
+        try:
+            sealed = archive_room(room, cutoff)
+        except Exception as e:
+            log_error(f"Archive error in room {room}", e)
+            continue
+        if sealed:
+            print(f"Archived {sealed} segment(s) of room {room}")
+        total += sealed
+    return total
+
+
+def run_forever(sleep=time.sleep):
+    """Background loop; pass socketio.sleep when running inside the server"""
+    while True:
+        try:
+            archive_all()
+        except Exception as e:
+            log_error("Archiver error", e)
+        sleep(ARCHIVE_INTERVAL)
+
+
+def archive_in_use():
+    """Whether history reads need to consult the cold tier at all"""
+    if ARCHIVE_AFTER_DAYS > 0 or _probe['found']:
+        return True
+    now = time.monotonic()
+    if _probe['checked'] is None or now - _probe['checked'] >= ARCHIVE_PROBE_INTERVAL:
+        _probe['checked'] = now
+        _probe['found'] = mongo_client.has_archive_segments()
+    return _probe['found']
+
+
+def find_cold_anchor(segment_query, message_id):
+    """Locate an archived message by id, returning it or None"""
+    if not archive_in_use():
+        return None
+    segment = mongo_client.find_archive_segment(dict(segment_query, ids=message_id))
+    if segment is None:
+        return None
+    for message in load_segment(segment):
+        if message.get('id') == message_id:
+            return message
+    return None
+
+
+def cold_messages_between(segment_query, message_filter, newer_than, older_than, limit):
+    """Up to limit archived messages with newer_than < timestamp < older_than, newest first"""
+    if not archive_in_use():
+        return []
+    segments = mongo_client.find_archive_segments(
+        dict(segment_query, first_timestamp={'$lt': older_than}, last_timestamp={'$gt': newer_than}),
+        sort=[('last_timestamp', -1)]
+    )
+    collected = []
+    for segment in segments:
+        # Segments are ordered by their newest message; stop once none can beat what we hold
+        if len(collected) >= limit and segment['last_timestamp'] <= collected[limit - 1].get('timestamp', ''):
+            break
+        for message in load_segment(segment):
+            timestamp = message.get('timestamp', '')
+            if newer_than < timestamp < older_than and message_filter(message):
+                collected.append(message)
+        collected.sort(key=lambda m: m.get('timestamp', ''), reverse=True)
+    return collected[:limit]
+
+
+def main(argv):
+    if '--once' in argv:
+        print(f"{archive_all(ARCHIVE_AFTER_DAYS or 90)} segment(s) sealed")
+        return
+    if ARCHIVE_AFTER_DAYS <= 0:
+        print("Set ARCHIVE_AFTER_DAYS to enable the archiver")
+        return
+    run_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,216 @@
+"""Fingerprinted, precompressed static assets.
+
+Build step (run on deploy, after changing anything in files/ or site/):
+
+    python -m scripts.assets
+
+Every file in files/ is copied to build/files/<name>.<hash>.<ext>, text
+assets minified first, and gets .gz and .br siblings (brotli only when the
+Brotli package is installed). References to /files/<name> inside assets and
+the site/*.html pages are rewritten to the hashed names; the pages land in
+build/site and the mapping in build/manifest.json. Old hashed files are kept
+so pages cached before a deploy still resolve.
+
+At runtime hashed assets are served immutable for a year, picking the .br
+or .gz variant from Accept-Encoding; pages and unhashed assets revalidate
+with ETags.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+from flask import request, send_file, abort
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+    import rcssmin
+except ImportError:
+    rjsmin = rcssmin = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIR = os.path.join(ROOT, 'files')
+PAGES_DIR = os.path.join(ROOT, 'site')
+BUILD_DIR = os.path.join(ROOT, os.getenv('ASSET_BUILD_DIR', 'build'))
+HTML_MAX_AGE = int(os.getenv('HTML_MAX_AGE', '0'))  # seconds a page may be reused before revalidating
+
+TEXT_TYPES = {'.js', '.css', '.webmanifest', '.html', '.svg', '.json'}
+COMPRESSIBLE = TEXT_TYPES | {'.ico'}
+_REFERENCE = re.compile(r'/files/([\w.-]+)')
+_HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.DOTALL)
+
+_manifest = None
+
+
+def minify(name, text):
+    """Minify JS/CSS with rjsmin/rcssmin (requirements.txt); without them CSS only loses comments and blank lines"""
+    ext = os.path.splitext(name)[1]
+    if ext == '.js':
+        return rjsmin.jsmin(text) if rjsmin else text
+    if ext == '.css':
+        if rcssmin:
+            return rcssmin.cssmin(text)
+        lines = (line.strip() for line in _CSS_COMMENT.sub('', text).splitlines())
+        return '\n'.join(line for line in lines if line) + '\n'
+    return text
+
+
+def _rewrite(text, manifest):
+    return _REFERENCE.sub(lambda m: manifest.get(f"/files/{m.group(1)}", m.group(0)), text)
+
+
+def _write_variants(path, data):
+    """Write data plus .gz/.br siblings, skipping files that already exist (names are content hashes)"""
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(data)
+    if os.path.splitext(path)[1] not in COMPRESSIBLE:
+        return
+    if not os.path.exists(path + '.gz'):
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, 9, mtime=0))
+    if brotli and not os.path.exists(path + '.br'):
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def _fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def build():
+    """Hash, minify and precompress files/, then rewrite site/ pages; returns the manifest"""
+    if rjsmin is None:
+        print("rjsmin/rcssmin not installed (see requirements.txt): JS is built unminified")
+    os.makedirs(os.path.join(BUILD_DIR, 'files'), exist_ok=True)
+    os.makedirs(os.path.join(BUILD_DIR, 'site'), exist_ok=True)
+    manifest = {}
+    pending = {}
+    for name in sorted(os.listdir(SOURCE_DIR)):
+        with open(os.path.join(SOURCE_DIR, name), 'rb') as f:
+            data = f.read()
+        if os.path.splitext(name)[1] in TEXT_TYPES:
+            pending[name] = data.decode('utf-8')
+        else:
+            hashed = _fingerprint(name, data)
+            _write_variants(os.path.join(BUILD_DIR, 'files', hashed), data)
+            manifest[f"/files/{name}"] = f"/files/{hashed}"
+
+    # Text assets reference each other (script.js loads socket-msgpack-parser.js),
+    # so hash an asset only once everything it points at has its final name
+    while pending:
+        ready = [name for name, text in pending.items()
+                 if all(ref == name or ref not in pending for ref in _REFERENCE.findall(text))]
+        if not ready:
+            raise RuntimeError(f"Circular asset references between {sorted(pending)}")
+        for name in ready:
+            data = minify(name, _rewrite(pending.pop(name), manifest)).encode('utf-8')
+            hashed = _fingerprint(name, data)
+            _write_variants(os.path.join(BUILD_DIR, 'files', hashed), data)
+            manifest[f"/files/{name}"] = f"/files/{hashed}"
+
+    for name in sorted(os.listdir(PAGES_DIR)):
+        with open(os.path.join(PAGES_DIR, name), encoding='utf-8') as f:
+            html = _rewrite(f.read(), manifest)
+        path = os.path.join(BUILD_DIR, 'site', name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        for suffix in ('.gz', '.br'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        _write_variants(path, html.encode('utf-8'))
+
+    with open(os.path.join(BUILD_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def get_manifest():
+    """Built asset map, or an empty one when the build step has not been run"""
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(os.path.join(BUILD_DIR, 'manifest.json')) as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = {}
+    return _manifest
+
+
+def accepted_encodings(header):
+    """{coding: q} from an Accept-Encoding header; '*' covers codings not listed"""
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def _negotiate(path):
+    """Pick the best precompressed sibling of path the client accepts: (path, encoding)"""
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+    best = None
+    # On equal q, brotli wins: it is listed first and only a higher q replaces it
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[0]) and os.path.isfile(path + suffix):
+            best = (q, path + suffix, encoding)
+    return (best[1], best[2]) if best else (path, None)
+
+
+def _send(path, cache_control):
+    served, encoding = _negotiate(path)
+    # download_name keeps the mimetype of the uncompressed file
+    response = send_file(served, download_name=os.path.basename(path), conditional=True, etag=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def send_asset(filename):
+    """Serve /files/<filename>: hashed names are immutable, source names revalidate"""
+    if '/' in filename or filename.startswith('.'):
+        abort(404)
+    if _HASHED_NAME.search(filename):
+        path = os.path.join(BUILD_DIR, 'files', filename)
+        if not os.path.isfile(path):
+            abort(404)
+        return _send(path, 'public, max-age=31536000, immutable')
+    path = os.path.join(SOURCE_DIR, filename)
+    if not os.path.isfile(path):
+        abort(404)
+    return _send(path, 'public, no-cache')
+
+
+def send_page(name):
+    """Serve an HTML page from the build when present, with a short-lived, ETag-validated cache"""
+    path = os.path.join(BUILD_DIR, 'site', name) if get_manifest() else os.path.join(PAGES_DIR, name)
+    if not os.path.isfile(path):
+        path = os.path.join(PAGES_DIR, name)
+    # Pages differ per login state and user, so keep them out of shared caches
+    return _send(path, f'private, max-age={HTML_MAX_AGE}, must-revalidate')
+
+
+if __name__ == '__main__':
+    manifest = build()
+    print(f"Built {len(manifest)} assets into {BUILD_DIR}" + ('' if brotli else ' (install Brotli for .br variants)'))
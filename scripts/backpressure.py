@@ -0,0 +1,131 @@
+"""Slow-consumer protection: a cap on the packets queued for each connection.
+
+Engine.IO keeps an in-memory queue per connection that the websocket writer
+(or the next long-poll) drains. A client on a stalled network stops draining,
+and every room broadcast adds to its queue. Once a connection has
+OUTBOUND_QUEUE_LIMIT packets waiting, its backlog is discarded, it is sent a
+'resync_required' event and closed. The client reconnects and catches up
+through get_messages_since_reconnect, which tells it to reload the room when
+it is more than a page behind, so nothing is lost that history holds;
+typing and presence updates are simply not replayed.
+"""
+import os
+from functools import wraps
+from scripts.metrics import Counter, register_collector, render_histogram
+from scripts.tracing import log_error
+
+OUTBOUND_QUEUE_LIMIT = int(os.getenv('OUTBOUND_QUEUE_LIMIT', '500'))
+# Spread the reconnects of clients evicted by the same burst
+RESYNC_JITTER_MS = int(os.getenv('RESYNC_JITTER_MS', '3000'))
+QUEUE_DEPTH_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+slow_consumers_total = Counter(
+    'socketio_slow_consumers_total', 'Connections closed for exceeding OUTBOUND_QUEUE_LIMIT')
+outbound_packets_shed_total = Counter(
+    'socketio_outbound_packets_shed_total', 'Queued packets discarded from slow connections')
+
+
+def _resync_packet(server):
+    """Engine.IO message carrying a 'resync_required' event, encoded like any emit"""
+    from engineio import packet as eio_packet
+    from socketio import packet as sio_packet
+    pkt = server.packet_class(sio_packet.EVENT, namespace='/',
+                              data=['resync_required', {'reason': 'slow_consumer',
+                                                        'reconnect_jitter_ms': RESYNC_JITTER_MS}])
+    return eio_packet.Packet(eio_packet.MESSAGE, data=pkt.encode())
+
+
+class OutboundGuard:
+    """Wraps the Engine.IO server's send_packet to enforce the per-connection budget"""
+
+    def __init__(self, socketio, limit=OUTBOUND_QUEUE_LIMIT):
+        self.socketio = socketio
+        self.limit = limit
+        self.evicting = set()
+
+    def install(self):
+        eio = self.socketio.server.eio
+        original = eio.send_packet
+
+        @wraps(original)
+        def send_packet(sid, pkt):
+            if sid in self.evicting:
+                outbound_packets_shed_total.inc()
+                return
+            connection = eio.sockets.get(sid)
+            if connection is not None and connection.queue.qsize() >= self.limit:
+                self.evict(sid, connection)
+                return
+            return original(sid, pkt)
+
+        eio.send_packet = send_packet
+        register_collector(self.collect)
+
+    def evict(self, sid, connection):
+        """Drop the backlog, tell the client to resync and close the connection"""
+        self.evicting.add(sid)
+        shed = 0
+        empty = self.socketio.server.eio.get_queue_empty_exception()
+        while True:
+            try:
+                pending = connection.queue.get(block=False)
+            except empty:
+                break
+            connection.queue.task_done()
+            if pending is None:
+                # The connection is already closing; let its writer see the sentinel
+                connection.queue.put(None)
+                break
+            shed += 1
+        outbound_packets_shed_total.inc(amount=shed + 1)
+        slow_consumers_total.inc()
+        log_error("Closing slow connection", f"{sid}: {shed} queued packets discarded")
+        connection.queue.put(_resync_packet(self.socketio.server))
+        # Closing runs the disconnect handler, which edits the room table; the emit
+        # that got us here may still be iterating it, so close from a separate task
+        self.socketio.start_background_task(self._close, sid, connection)
+
+    def _close(self, sid, connection):
+        try:
+            connection.close(wait=False)
+        except Exception as e:
+            log_error(f"Error closing slow connection {sid}", e)
+        finally:
+            self.evicting.discard(sid)
+
+    def collect(self):
+        """Queue depth of every connection, read at scrape time"""
+        counts = [0] * (len(QUEUE_DEPTH_BUCKETS) + 1)
+        total = 0
+        deepest = 0
+        connections = list(self.socketio.server.eio.sockets.values())
+        for connection in connections:
+            depth = connection.queue.qsize()
+            for i, bound in enumerate(QUEUE_DEPTH_BUCKETS):
+                if depth <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            total += depth
+            deepest = max(deepest, depth)
+        lines = ["# HELP socketio_outbound_queue_depth Packets waiting per connection",
+                 "# TYPE socketio_outbound_queue_depth histogram"]
+        lines.extend(render_histogram('socketio_outbound_queue_depth', (), (), QUEUE_DEPTH_BUCKETS,
+                                      counts, total, len(connections)))
+        lines.append("# HELP socketio_outbound_queue_max Deepest outbound queue of any connection")
+        lines.append("# TYPE socketio_outbound_queue_max gauge")
+        lines.append(f"socketio_outbound_queue_max {deepest}")
+        lines.append("# HELP socketio_outbound_queue_limit Configured OUTBOUND_QUEUE_LIMIT")
+        lines.append("# TYPE socketio_outbound_queue_limit gauge")
+        lines.append(f"socketio_outbound_queue_limit {self.limit}")
+        return lines
+
+
+def init_app(socketio):
+    """Enforce OUTBOUND_QUEUE_LIMIT on every connection of this worker (0 disables it)"""
+    if OUTBOUND_QUEUE_LIMIT <= 0:
+        return None
+    guard = OutboundGuard(socketio)
+    guard.install()
+    return guard
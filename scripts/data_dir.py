@@ -0,0 +1,22 @@
+"""Location of files the server writes for itself and must never serve.
+
+main.py serves its own directory as static files, so the journal, the trace
+file and disk archive segments default to DATA_DIR, outside that tree.
+"""
+import os
+
+DATA_DIR = os.getenv('DATA_DIR') or os.path.join(
+    os.getenv('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state'), 'web101')
+
+
+def data_path(*parts):
+    return os.path.join(DATA_DIR, *parts)
+
+
+def ensure_not_served(setting, path, served_root):
+    """Refuse to start when a private file or directory setting points into the served tree"""
+    root = os.path.realpath(served_root)
+    target = os.path.realpath(path)
+    if os.path.commonpath([root, target]) == root:
+        raise RuntimeError(f"{setting}={path} is inside the served directory {root}; "
+                           f"anyone could download it. Point it outside, e.g. under {DATA_DIR}")
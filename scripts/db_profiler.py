@@ -0,0 +1,569 @@
+import inspect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import wraps
+import bson
+from pymongo import monitoring
+from scripts.tracing import log_error, span, traced
+
+# Latency bucket upper bounds in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+PROFILER_ENABLED = os.getenv('DB_PROFILER_ENABLED', '1') != '0'
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '100'))
+SLOW_QUERY_LOG_SIZE = int(os.getenv('DB_SLOW_QUERY_LOG_SIZE', '200'))
+# BSON-encode the result of one call in N per operation and scale it by N
+SIZE_SAMPLE_EVERY = max(int(os.getenv('DB_SIZE_SAMPLE_EVERY', '16')), 1)
+# Distinct query shapes waiting for explain(); further slow shapes are not explained
+EXPLAIN_QUEUE_SIZE = int(os.getenv('DB_EXPLAIN_QUEUE_SIZE', '32'))
+# Plans are reused for slow queries of the same shape for this long
+EXPLAIN_CACHE_SECONDS = float(os.getenv('DB_EXPLAIN_CACHE_SECONDS', '600'))
+EXPLAIN_CACHE_SIZE = 256
+
+# Commands whose plan can be inspected with explain()
+_EXPLAINABLE = {'find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify'}
+# Driver-added fields that explain() does not accept inside the wrapped command
+_SESSION_FIELDS = {'lsid', '$clusterTime', '$db', 'txnNumber', 'apiVersion',
+                   'apiStrict', 'apiDeprecationErrors', '$readPreference'}
+
+
+class Histogram:
+    """Fixed-bucket latency histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """Approximate percentile as the upper bound of the matching bucket"""
+        if not self.count:
+            return 0.0
+        target = self.count * pct / 100.0
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return float(self.buckets[i]) if i < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self):
+        labels = [f"<={b}ms" for b in self.buckets] + [f">{self.buckets[-1]}ms"]
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'avg_ms': round(self.total / self.count, 3) if self.count else 0.0,
+            'max_ms': round(self.max, 3),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': dict(zip(labels, self.counts))
+        }
+
+
+class _CallStats:
+    """Aggregated stats for one instrumented operation"""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.calls = 0
+        self.documents = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def to_dict(self):
+        return {
+            'latency': self.latency.to_dict(),
+            'documents': self.documents,
+            'bytes': self.bytes,
+            'errors': self.errors
+        }
+
+
+_lock = threading.Lock()
+_method_stats = {}
+_command_stats = {}
+_slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_pool_stats = {}
+
+
+def _stats_for(table, name):
+    stats = table.get(name)
+    if stats is None:
+        stats = table.setdefault(name, _CallStats())
+    return stats
+
+
+def _measure_result(result, sized=True):
+    """Return (document count, BSON bytes) for a MongoDBClient/GridFS return value
+
+    Encoding documents costs as much as the driver decoding them, so unless
+    sized is set only the count is taken and dict results report 0 bytes.
+    """
+    if isinstance(result, dict):
+        return 1, len(bson.encode(result)) if sized else 0
+    if isinstance(result, list):
+        size = 0
+        if sized:
+            for item in result:
+                if isinstance(item, dict):
+                    size += len(bson.encode(item))
+        return len(result), size
+    if isinstance(result, tuple):
+        # e.g. get_nicknames -> (me_nickname, their_nickname)
+        return (1 if any(v is not None for v in result) else 0), 0
+    if isinstance(result, bytes):
+        return 1, len(result)
+    return 0, 0
+
+
+def record_call(name, elapsed_ms, result=None, error=False):
+    """Record one instrumented call; document bytes are sampled every SIZE_SAMPLE_EVERY calls"""
+    with _lock:
+        stats = _stats_for(_method_stats, name)
+        sampled = stats.calls % SIZE_SAMPLE_EVERY == 0
+        stats.calls += 1
+    documents, size = (0, 0) if error else _measure_result(result, sized=sampled)
+    if sampled and not isinstance(result, bytes):
+        size *= SIZE_SAMPLE_EVERY
+    with _lock:
+        stats.latency.observe(elapsed_ms)
+        stats.documents += documents
+        stats.bytes += size
+        if error:
+            stats.errors += 1
+
+
+def record_stream(name, elapsed_ms, documents, size, error=False):
+    """Record one generator call once it is exhausted, closed or fails"""
+    with _lock:
+        stats = _stats_for(_method_stats, name)
+        stats.calls += 1
+        stats.latency.observe(elapsed_ms)
+        stats.documents += documents
+        stats.bytes += size
+        if error:
+            stats.errors += 1
+
+
+def _profiled_stream(name, f):
+    """Wrap a generator method: latency is the time spent producing its items, not the caller's
+    time between them; every SIZE_SAMPLE_EVERY-th document is BSON-encoded and scaled"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        items = f(*args, **kwargs)
+        busy = 0.0
+        documents = size = 0
+        error = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    busy += time.perf_counter() - start
+                if isinstance(item, dict) and documents % SIZE_SAMPLE_EVERY == 0:
+                    size += len(bson.encode(item)) * SIZE_SAMPLE_EVERY
+                documents += 1
+                yield item
+        finally:
+            items.close()
+            record_stream(name, busy * 1000, documents, size, error)
+    return wrapper
+
+
+def profiled(name):
+    """Decorator that records latency, document count and bytes returned for a call, and traces it"""
+    def decorator(f):
+        if inspect.isgeneratorfunction(f):
+            # A span cannot stay current across yields to the caller; the cursor's commands
+            # are still timed by CommandProfiler
+            return _profiled_stream(name, f) if PROFILER_ENABLED else f
+        if not PROFILER_ENABLED:
+            return traced(name, 'client')(f)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with span(name, 'client'):
+                    result = f(*args, **kwargs)
+            except Exception:
+                record_call(name, (time.perf_counter() - start) * 1000, error=True)
+                raise
+            record_call(name, (time.perf_counter() - start) * 1000, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def instrument_methods(cls, prefix):
+    """Wrap every public method of cls with the profiler"""
+    for attr, value in list(vars(cls).items()):
+        if attr.startswith('_') or not callable(value):
+            continue
+        setattr(cls, attr, profiled(f"{prefix}.{attr}")(value))
+    return cls
+
+
+class ProfiledGridFSOut:
+    """GridOut proxy that records bytes read"""
+
+    def __init__(self, grid_out):
+        self._grid_out = grid_out
+
+    def read(self, *args, **kwargs):
+        start = time.perf_counter()
+        with span('gridfs.read', 'client'):
+            data = self._grid_out.read(*args, **kwargs)
+        record_call('gridfs.read', (time.perf_counter() - start) * 1000, data)
+        return data
+
+    def __getattr__(self, attr):
+        return getattr(self._grid_out, attr)
+
+
+class ProfiledGridFS:
+    """GridFS proxy that records latency of every GridFS call"""
+
+    def __init__(self, fs):
+        self._fs = fs
+
+    def put(self, data, **kwargs):
+        start = time.perf_counter()
+        try:
+            with span('gridfs.put', 'client'):
+                file_id = self._fs.put(data, **kwargs)
+        except Exception:
+            record_call('gridfs.put', (time.perf_counter() - start) * 1000, error=True)
+            raise
+        record_call('gridfs.put', (time.perf_counter() - start) * 1000)
+        return file_id
+
+    def get(self, file_id):
+        start = time.perf_counter()
+        try:
+            with span('gridfs.get', 'client'):
+                grid_out = self._fs.get(file_id)
+        except Exception:
+            record_call('gridfs.get', (time.perf_counter() - start) * 1000, error=True)
+            raise
+        record_call('gridfs.get', (time.perf_counter() - start) * 1000)
+        return ProfiledGridFSOut(grid_out) if PROFILER_ENABLED else grid_out
+
+    def __getattr__(self, attr):
+        value = getattr(self._fs, attr)
+        if not callable(value):
+            return value
+        return profiled(f"gridfs.{attr}")(value)
+
+
+def _find_collection_scans(plan):
+    """Return True if any stage of an explain() plan is a COLLSCAN"""
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(_find_collection_scans(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_find_collection_scans(v) for v in plan)
+    return False
+
+
+def _query_shape(value):
+    """Command with every literal replaced, so queries differing only in values share one plan"""
+    if isinstance(value, dict):
+        return {k: _query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(v, (dict, list, tuple)) for v in value):
+            return [_query_shape(v) for v in value]
+        return '?'
+    return '?'
+
+
+class _ExplainWorker:
+    """Runs explain() for slow queries off the driver's monitoring thread, once per query shape"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()  # shape -> (database, command, [entries])
+        self._plans = OrderedDict()    # shape -> (explained at, plan, collection scan)
+        self._event = threading.Event()
+        self._thread = None
+
+    def submit(self, entry, database, command):
+        shape = json.dumps([entry['namespace'], entry['command_name'], _query_shape(command)],
+                           sort_keys=True, default=str)
+        with self._lock:
+            cached = self._plans.get(shape)
+            if cached is not None and time.monotonic() - cached[0] < EXPLAIN_CACHE_SECONDS:
+                entry['plan'], entry['collection_scan'] = cached[1], cached[2]
+                return
+            if shape in self._pending:
+                self._pending[shape][2].append(entry)
+                return
+            if len(self._pending) >= EXPLAIN_QUEUE_SIZE:
+                entry['plan_error'] = 'explain queue full'
+                return
+            self._pending[shape] = (database, command, [entry])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-profiler-explain', daemon=True)
+                self._thread.start()
+        self._event.set()
+
+    def _next(self):
+        with self._lock:
+            return self._pending.popitem(last=False) if self._pending else None
+
+    def _run(self):
+        from scripts.mongo_client import MongoDBClient
+        while True:
+            self._event.wait()
+            self._event.clear()
+            while True:
+                item = self._next()
+                if item is None:
+                    break
+                shape, (database, command, entries) = item
+                try:
+                    plan = MongoDBClient().client[database].command(
+                        {'explain': command, 'verbosity': 'queryPlanner'}
+                    )
+                except Exception as e:
+                    log_error(f"explain() failed for slow query on {entries[0]['namespace']}", e)
+                    for entry in entries:
+                        entry['plan_error'] = str(e)
+                    continue
+                winning_plan = plan.get('queryPlanner', {}).get('winningPlan')
+                collection_scan = _find_collection_scans(winning_plan)
+                with self._lock:
+                    for entry in entries:
+                        entry['plan'], entry['collection_scan'] = winning_plan, collection_scan
+                    self._plans[shape] = (time.monotonic(), winning_plan, collection_scan)
+                    self._plans.move_to_end(shape)
+                    while len(self._plans) > EXPLAIN_CACHE_SIZE:
+                        self._plans.popitem(last=False)
+                if collection_scan:
+                    entry = entries[0]
+                    log_error("Slow query used a collection scan",
+                              f"{entry['namespace']} {entry['command_name']} {entry['duration_ms']}ms")
+
+
+_explain_worker = _ExplainWorker()
+
+
+class CommandProfiler(monitoring.CommandListener):
+    """pymongo command listener feeding per-command histograms and the slow-query log"""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        if event.command_name == 'explain':
+            return
+        if event.command_name in _EXPLAINABLE:
+            collection = event.command.get(event.command_name)
+            self._pending[event.request_id] = (event.database_name, collection, event.command)
+
+    def succeeded(self, event):
+        pending = self._pending.pop(event.request_id, None)
+        if event.command_name == 'explain':
+            return
+        elapsed_ms = event.duration_micros / 1000.0
+        reply = event.reply or {}
+        cursor = reply.get('cursor') or {}
+        documents = len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+        with _lock:
+            stats = _stats_for(_command_stats, event.command_name)
+            stats.latency.observe(elapsed_ms)
+            stats.documents += documents
+        if pending and elapsed_ms >= SLOW_QUERY_MS:
+            self._log_slow_query(pending, event.command_name, elapsed_ms, documents)
+
+    def failed(self, event):
+        self._pending.pop(event.request_id, None)
+        if event.command_name == 'explain':
+            return
+        with _lock:
+            stats = _stats_for(_command_stats, event.command_name)
+            stats.latency.observe(event.duration_micros / 1000.0)
+            stats.errors += 1
+
+    def _log_slow_query(self, pending, command_name, elapsed_ms, documents):
+        database, collection, command = pending
+        explain_command = {k: v for k, v in command.items() if k not in _SESSION_FIELDS}
+        entry = {
+            'timestamp': time.time(),
+            'namespace': f"{database}.{collection}",
+            'command_name': command_name,
+            'duration_ms': round(elapsed_ms, 3),
+            'documents': documents,
+            'filter': sanitize_command(explain_command.get('filter', explain_command.get('query'))),
+            'plan': None,
+            'collection_scan': None
+        }
+        _slow_queries.append(entry)
+        print(f"Slow query ({entry['duration_ms']}ms): {entry['namespace']} {command_name}")
+        _explain_worker.submit(entry, database, explain_command)
+
+
+def sanitize_command(value):
+    """Make a command fragment JSON friendly for the admin endpoint"""
+    if isinstance(value, dict):
+        return {k: sanitize_command(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [sanitize_command(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+class _PoolStats:
+    """Connection pool state for one server address"""
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.open = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.checkouts = 0
+        self.failures = {}
+        self.clears = 0
+        self.wait = Histogram()
+
+    def to_dict(self):
+        return {
+            'max_size': self.max_size,
+            'open': self.open,
+            'checked_out': self.checked_out,
+            'peak_checked_out': self.peak_checked_out,
+            'utilization': round(self.checked_out / self.max_size, 3) if self.max_size else 0.0,
+            'checkouts': self.checkouts,
+            'checkout_failures': dict(self.failures),
+            'clears': self.clears,
+            'checkout_wait': self.wait.to_dict()
+        }
+
+
+class PoolProfiler(monitoring.ConnectionPoolListener):
+    """pymongo pool listener tracking utilization and checkout wait time per server"""
+
+    def _pool(self, address):
+        key = f"{address[0]}:{address[1]}"
+        stats = _pool_stats.get(key)
+        if stats is None:
+            stats = _pool_stats[key] = _PoolStats()
+        return stats
+
+    def pool_created(self, event):
+        with _lock:
+            self._pool(event.address).max_size = event.options.get('maxPoolSize', 0)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with _lock:
+            self._pool(event.address).clears += 1
+
+    def pool_closed(self, event):
+        with _lock:
+            _pool_stats.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        with _lock:
+            self._pool(event.address).open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with _lock:
+            stats = self._pool(event.address)
+            stats.open = max(stats.open - 1, 0)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with _lock:
+            stats = self._pool(event.address)
+            stats.failures[event.reason] = stats.failures.get(event.reason, 0) + 1
+            if event.duration is not None:
+                stats.wait.observe(event.duration * 1000.0)
+
+    def connection_checked_out(self, event):
+        with _lock:
+            stats = self._pool(event.address)
+            stats.checkouts += 1
+            stats.checked_out += 1
+            stats.peak_checked_out = max(stats.peak_checked_out, stats.checked_out)
+            if event.duration is not None:
+                stats.wait.observe(event.duration * 1000.0)
+
+    def connection_checked_in(self, event):
+        with _lock:
+            stats = self._pool(event.address)
+            stats.checked_out = max(stats.checked_out - 1, 0)
+
+
+command_profiler = CommandProfiler()
+pool_profiler = PoolProfiler()
+
+
+def event_listeners():
+    """Listeners to pass to MongoClient(event_listeners=...); pool stats are cheap and always on"""
+    return [command_profiler, pool_profiler] if PROFILER_ENABLED else [pool_profiler]
+
+
+def get_profile_snapshot():
+    """Return a JSON-serializable snapshot of all collected stats"""
+    with _lock:
+        methods = {name: stats.to_dict() for name, stats in _method_stats.items()}
+        commands = {name: stats.to_dict() for name, stats in _command_stats.items()}
+        slow_queries = [sanitize_command(dict(entry)) for entry in _slow_queries]
+        pools = {address: stats.to_dict() for address, stats in _pool_stats.items()}
+    return {
+        'enabled': PROFILER_ENABLED,
+        'slow_query_ms': SLOW_QUERY_MS,
+        'methods': methods,
+        'commands': commands,
+        'slow_queries': slow_queries[::-1],
+        'pools': pools
+    }
+
+
+def reset_profile():
+    """Clear all collected stats"""
+    with _lock:
+        _method_stats.clear()
+        _command_stats.clear()
+        _slow_queries.clear()
+        # Pool gauges (open, checked out) describe live state and are kept
+        for stats in _pool_stats.values():
+            stats.peak_checked_out = stats.checked_out
+            stats.checkouts = 0
+            stats.failures = {}
+            stats.clears = 0
+            stats.wait = Histogram()
@@ -0,0 +1,49 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from scripts.metrics import Counter
+
+SEND_DEDUP_WINDOW = float(os.getenv('SEND_DEDUP_WINDOW', '300'))
+SEND_DEDUP_MAX_ENTRIES = int(os.getenv('SEND_DEDUP_MAX_ENTRIES', '10000'))
+
+_CLIENT_ID = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+duplicate_sends_total = Counter(
+    'socketio_duplicate_sends_total', 'Retried sends answered with the original ack', ['source'])
+
+
+def valid_client_id(client_id):
+    return isinstance(client_id, str) and bool(_CLIENT_ID.match(client_id))
+
+
+class IdempotencyWindow:
+    """Recent acks by (user, client_id), so retries are answered without touching the database"""
+
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        self._acks = OrderedDict()  # key -> (expires_at, ack), oldest first
+
+    def get(self, user, client_id):
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._acks.get((user, client_id))
+        return entry[1] if entry else None
+
+    def put(self, user, client_id, ack):
+        now = time.monotonic()
+        self._acks[(user, client_id)] = (now + self.window, ack)
+        self._acks.move_to_end((user, client_id))
+        while len(self._acks) > self.max_entries:
+            self._acks.popitem(last=False)
+
+    def _expire(self, now):
+        while self._acks:
+            key, (expires_at, _) = next(iter(self._acks.items()))
+            if expires_at > now:
+                return
+            del self._acks[key]
+
+
+send_acks = IdempotencyWindow(SEND_DEDUP_WINDOW, SEND_DEDUP_MAX_ENTRIES)
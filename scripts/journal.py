@@ -0,0 +1,309 @@
+"""Append-only local write-ahead journal for writes accepted while MongoDB is unavailable.
+
+Records are CRC-checked JSON lines in numbered segment files under
+JOURNAL_DIR/worker-<WORKER_ID>-<pid>. Appends are fsynced in groups: callers that
+arrive while an fsync is pending share the next one. A replayer applies
+records in order and checkpoints its position; fully applied segments are
+deleted. After a crash the last few records may be applied again, so apply
+functions must be idempotent. Total size is capped at JOURNAL_MAX_BYTES.
+
+Each process owns its directory through an exclusive flock on owner.lock,
+held until it exits. During a reload the old and new worker with the same
+WORKER_ID run side by side, so a directory is only adopted by another
+process's replayer once that lock is free: its owner has exited and nothing
+is appending to it any more. Adopted directories are replayed in full and
+removed.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+import zlib
+from scripts.data_dir import data_path
+from scripts.metrics import Counter, Gauge, Histogram
+from scripts.tracing import log_error
+
+JOURNAL_ENABLED = os.getenv('JOURNAL_ENABLED', '1') != '0'
+# Holds message bodies: keep it out of the served tree (main.py refuses to start otherwise)
+JOURNAL_DIR = os.getenv('JOURNAL_DIR') or data_path('journal')
+JOURNAL_MAX_BYTES = int(os.getenv('JOURNAL_MAX_BYTES', str(64 * 1024 * 1024)))
+JOURNAL_SEGMENT_BYTES = int(os.getenv('JOURNAL_SEGMENT_BYTES', str(4 * 1024 * 1024)))
+# Wait this long before an fsync so appends arriving meanwhile ride along
+JOURNAL_FSYNC_DELAY_MS = float(os.getenv('JOURNAL_FSYNC_DELAY_MS', '2'))
+JOURNAL_REPLAY_INTERVAL = float(os.getenv('JOURNAL_REPLAY_INTERVAL', '2'))
+JOURNAL_REPLAY_BATCH = int(os.getenv('JOURNAL_REPLAY_BATCH', '200'))
+
+journal_appends_total = Counter('journal_appends_total', 'Records written to the local journal')
+journal_replayed_total = Counter('journal_replayed_total', 'Journal records applied to MongoDB')
+journal_backlog_records = Gauge('journal_backlog_records', 'Journal records waiting to be replayed')
+journal_bytes = Gauge('journal_bytes', 'Disk used by journal segments')
+journal_fsync_batch_size = Histogram(
+    'journal_fsync_batch_size', 'Records made durable by one fsync', buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+
+def _fsync(fd):
+    """fsync without stalling the worker: under eventlet it runs in a native thread"""
+    try:
+        from eventlet import patcher, tpool
+    except ImportError:
+        return os.fsync(fd)
+    # monkey_patch() does not make fsync cooperative; on the hub it would block every connection
+    if patcher.is_monkey_patched('thread'):
+        return tpool.execute(os.fsync, fd)
+    return os.fsync(fd)
+
+
+class JournalFull(Exception):
+    """The journal is at JOURNAL_MAX_BYTES; the record was not accepted"""
+
+
+def _claim(directory, create=False):
+    """Descriptor holding the exclusive flock on directory's owner.lock, or None if it is held"""
+    flags = os.O_RDWR | (os.O_CREAT if create else 0)
+    try:
+        fd = os.open(os.path.join(directory, 'owner.lock'), flags, 0o600)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _create_owned(directory):
+    """Create (or reclaim) a journal directory locked by this process"""
+    if os.path.isdir(directory):
+        fd = _claim(directory, create=True)
+        if fd is None:
+            raise RuntimeError(f"Journal {directory} is in use by another process")
+        return fd
+    # Build it under a hidden name and rename it once locked, so no replayer adopts it half made
+    parent, name = os.path.split(directory)
+    staging = os.path.join(parent, '.' + name)
+    os.makedirs(staging, exist_ok=True)
+    fd = _claim(staging, create=True)
+    os.rename(staging, directory)
+    return fd
+
+
+def _encode(record):
+    payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+
+def _decode(line):
+    """Record from a journal line, or None for a torn or corrupt line"""
+    if len(line) < 10 or not line.endswith(b'\n') or line[8:9] != b' ':
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+class Journal:
+    def __init__(self, directory=None, owner=None):
+        self.directory = directory
+        # Set for a directory adopted from an exited process: replay only, no appends
+        self.adopted = owner is not None
+        self._owner = owner
+        self._orphans = {}
+        self._lock = threading.Lock()       # appends, rotation and replay bookkeeping
+        self._sync_lock = threading.Lock()  # one fsync at a time
+        self._file = None
+        self._segment = 0
+        self._written = 0
+        self._synced = 0
+        self._durable = 0  # bytes of the active segment known to be on disk
+        self._bytes = 0
+        self._checkpoint = (0, 0)  # (segment, offset) of the next record to apply
+        self.backlog = 0
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}.log")
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith('.log') and name[:-4].isdigit())
+
+    def _ensure_open(self):
+        if self._file is not None or (self.adopted and self._segment):
+            return
+        if self.directory is None:
+            self.directory = os.path.join(JOURNAL_DIR, f"worker-{os.getenv('WORKER_ID', '0')}-{os.getpid()}")
+        if self._owner is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.directory)), exist_ok=True)
+            self._owner = _create_owned(self.directory)
+        try:
+            with open(os.path.join(self.directory, 'checkpoint.json')) as f:
+                saved = json.load(f)
+            self._checkpoint = (saved['segment'], saved['offset'])
+        except (OSError, ValueError, KeyError):
+            self._checkpoint = (0, 0)
+        segments = []
+        for segment in self._segments():
+            # Drop segments replayed before the last checkpoint and empty ones from earlier starts
+            if segment < self._checkpoint[0] or os.path.getsize(self._path(segment)) == 0:
+                os.remove(self._path(segment))
+            else:
+                segments.append(segment)
+        self._bytes = sum(os.path.getsize(self._path(s)) for s in segments)
+        for segment in segments:
+            offset = self._checkpoint[1] if segment == self._checkpoint[0] else 0
+            with open(self._path(segment), 'rb') as f:
+                f.seek(offset)
+                self.backlog += sum(1 for line in f if _decode(line) is not None)
+        # Never append after a possibly torn tail: every process start opens a fresh segment
+        # and numbering continues past the checkpoint even when every segment was retired
+        self._segment = max(segments[-1] if segments else 0, self._checkpoint[0]) + 1
+        if self.adopted:
+            # Nothing appends here any more: every existing segment is complete
+            return
+        self._file = open(self._path(self._segment), 'ab')
+        self._durable = 0
+        journal_backlog_records.set(value=self.backlog)
+        journal_bytes.set(value=self._bytes)
+
+    def has_backlog(self):
+        with self._lock:
+            self._ensure_open()
+            return self.backlog > 0
+
+    def append(self, record):
+        """Write a record and return once it is on disk"""
+        line = _encode(record)
+        with self._lock:
+            self._ensure_open()
+            if self._bytes + len(line) > JOURNAL_MAX_BYTES:
+                raise JournalFull(f"journal at {self._bytes} bytes")
+            self._file.write(line)
+            self._bytes += len(line)
+            self.backlog += 1
+            self._written += 1
+            ticket = self._written
+        journal_appends_total.inc()
+        self._sync(ticket)
+
+    def _sync(self, ticket):
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return  # another caller's fsync covered this record
+            if JOURNAL_FSYNC_DELAY_MS > 0:
+                time.sleep(JOURNAL_FSYNC_DELAY_MS / 1000.0)
+            with self._lock:
+                self._file.flush()
+                target, size = self._written, self._file.tell()
+            _fsync(self._file.fileno())
+            journal_fsync_batch_size.observe(target - self._synced)
+            with self._lock:
+                self._synced = target
+                self._durable = size
+                journal_backlog_records.set(value=self.backlog)
+                journal_bytes.set(value=self._bytes)
+                if size >= JOURNAL_SEGMENT_BYTES and self._written == target:
+                    self._file.close()
+                    self._segment += 1
+                    self._file = open(self._path(self._segment), 'ab')
+                    self._durable = 0
+
+    def replay(self, apply, limit=JOURNAL_REPLAY_BATCH):
+        """Apply up to limit durable records in order; returns how many were applied.
+
+        An exception from apply stops the replay at that record, which is retried next time.
+        """
+        with self._lock:
+            self._ensure_open()
+            if not self.backlog:
+                return 0
+            active, durable = self._segment, self._durable
+            segments = [s for s in self._segments() if s >= self._checkpoint[0]]
+        applied = 0
+        segment, offset = self._checkpoint
+        try:
+            for current in segments:
+                if current != segment:
+                    segment, offset = current, 0
+                end = durable if current == active else None
+                with open(self._path(current), 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if end is not None and offset + len(line) > end:
+                            break
+                        record = _decode(line)
+                        if record is not None:
+                            apply(record)
+                            applied += 1
+                        else:
+                            log_error("Skipping corrupt journal record", f"segment {current} at offset {offset}")
+                        offset += len(line)
+                        if applied >= limit:
+                            return applied
+                if current != active:
+                    self._retire(current)
+        finally:
+            self._save_checkpoint(segment, offset, applied)
+        return applied
+
+    def _retire(self, segment):
+        size = os.path.getsize(self._path(segment))
+        os.remove(self._path(segment))
+        with self._lock:
+            self._bytes -= size
+            if not self.adopted:
+                journal_bytes.set(value=self._bytes)
+
+    def _save_checkpoint(self, segment, offset, applied):
+        with self._lock:
+            self._checkpoint = (segment, offset)
+            self.backlog = max(self.backlog - applied, 0)
+            if not self.adopted:
+                journal_backlog_records.set(value=self.backlog)
+        journal_replayed_total.inc(amount=applied)
+        tmp = os.path.join(self.directory, 'checkpoint.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'segment': segment, 'offset': offset}, f)
+        os.replace(tmp, os.path.join(self.directory, 'checkpoint.json'))
+
+    def orphans(self):
+        """Journals of exited processes that this process has adopted for replay"""
+        with self._lock:
+            self._ensure_open()
+        own = os.path.abspath(self.directory)
+        parent = os.path.dirname(own)
+        for name in sorted(os.listdir(parent)):
+            path = os.path.join(parent, name)
+            if not name.startswith('worker-') or path == own or path in self._orphans:
+                continue
+            fd = _claim(path)
+            if fd is None:
+                continue
+            if not os.path.isdir(path):
+                # Removed by the replayer that held it until just now
+                os.close(fd)
+                continue
+            self._orphans[path] = Journal(path, owner=fd)
+        return list(self._orphans.values())
+
+    def release(self, orphan):
+        """Delete a fully replayed adopted journal and drop its lock"""
+        self._orphans.pop(orphan.directory, None)
+        for name in os.listdir(orphan.directory):
+            os.remove(os.path.join(orphan.directory, name))
+        os.rmdir(orphan.directory)
+        os.close(orphan._owner)
+
+    def close(self):
+        """Close the active segment and give up ownership (the process is exiting)"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._owner is not None:
+                os.close(self._owner)
+                self._owner = None
@@ -1,18 +1,37 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import json
-from scripts.mongo_client import MongoDBClient
+import os
+import time
+import pymongo
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, PyMongoError
+from scripts.mongo_client import MongoDBClient, settled_for_secondaries
+from scripts.search_index import index_terms, query_terms, score_message, snippet
+from scripts.archiver import find_cold_anchor, cold_messages_between
+from scripts.single_flight import SingleFlight
+from scripts.tracing import traced, log_error
+from scripts.journal import Journal, JOURNAL_ENABLED, JOURNAL_REPLAY_INTERVAL
 
 mongo_client = MongoDBClient()
+# Reconnect storms ask for the same pages at once; share one read per (room, cursor, limit)
+history_reads = SingleFlight('history')
+# Sends accepted while MongoDB is down or slow wait here until the replayer stores them
+message_journal = Journal()
+# A live message write slower than this goes to the journal instead
+MESSAGE_WRITE_TIMEOUT = float(os.getenv('MESSAGE_WRITE_TIMEOUT_MS', '1500')) / 1000.0
 
+@traced('sanitize_for_json')
 def sanitize_for_json(obj):
     """Convert MongoDB ObjectIds to strings for JSON serialization"""
+    return _sanitize_value(obj)
+
+def _sanitize_value(obj):
     # Check if it's a BSON ObjectId by checking the type string
     if str(type(obj)).find('ObjectId') != -1 or str(type(obj)).startswith("<class 'bson"):
         return str(obj)
     elif isinstance(obj, dict):
-        return {key: sanitize_for_json(value) for key, value in obj.items()}
+        return {key: _sanitize_value(value) for key, value in obj.items()}
     elif isinstance(obj, list):
-        return [sanitize_for_json(item) for item in obj]
+        return [_sanitize_value(item) for item in obj]
     else:
         # For any other non-serializable objects, convert to string
         try:
@@ -21,53 +40,387 @@ def sanitize_for_json(obj):
         except (TypeError, ValueError):
             return str(obj)
 
+_ME = "dtanh"
+PREVIEW_LENGTH = 100
+# Newest matching messages considered for ranking per search
+SEARCH_SCAN_LIMIT = 500
+# Reconnect sync replays edits/deletes from a little before the client's last sync, so a
+# change stamped by a worker with a slightly slow clock is not missed; replays are idempotent
+CHANGE_FEED_OVERLAP = timedelta(seconds=float(os.getenv('CHANGE_FEED_OVERLAP_SECONDS', '5')))
+# Beyond this many changes a client is told to reload the room instead
+CHANGE_FEED_LIMIT = int(os.getenv('CHANGE_FEED_LIMIT', '500'))
+
+def room_query(room):
+    """Filter selecting the messages shown in a room.
+
+    The admin's own room is an aggregate inbox: every message written by
+    another user plus whatever the admin wrote in their own room. It is
+    served by a fan-out-on-read query over the 'inbox' flag instead of
+    mirrored copies.
+    """
+    if room == _ME:
+        return {'inbox': True}
+    return {'room': room}
+
+def belongs_to_inbox(message_data, room):
+    """Whether a message stored in room also shows up in the admin inbox"""
+    return room == _ME or message_data.get('username') != _ME
+
+def present_message(message, room):
+    """Shape a stored message for the room it is displayed in"""
+    if room == _ME and message.get('room') != _ME and not message.get('deleted'):
+        message = dict(message)
+        message['message'] = f"<{message.get('username')}>: {message.get('message', '')}"
+    return message
+
+@traced('cache_message')
 def cache_message(message_data, user_id=None):
     if user_id is None:
         raise ValueError("user_id must be provided to cache messages")
     # Add timestamp to message
     message_data['timestamp'] = datetime.now(timezone.utc).isoformat()
-    result = mongo_client.insert_message(user_id, message_data)
+    if belongs_to_inbox(message_data, user_id):
+        message_data['inbox'] = True
+    message_data['terms'] = index_terms(message_data.get('message'))
+    if not JOURNAL_ENABLED:
+        _store_message(message_data, user_id)
+    elif message_journal.has_backlog():
+        # Older sends are still journaled; keep the order by queueing behind them
+        _journal_message(message_data, user_id)
+    else:
+        try:
+            with pymongo.timeout(MESSAGE_WRITE_TIMEOUT):
+                _store_message(message_data, user_id)
+        except DuplicateKeyError:
+            raise
+        except PyMongoError as e:
+            if not (isinstance(e, ConnectionFailure) or e.timeout):
+                raise
+            log_error(f"MongoDB write failed, journaling message {message_data.get('id')}", e)
+            _journal_message(message_data, user_id)
+    # Terms are stored for the search index only, not sent to clients
+    message_data.pop('terms', None)
     return True
 
-def get_message_collection(user_id):
-    return mongo_client.get_message_collection(user_id)
+def _store_message(message_data, user_id):
+    mongo_client.insert_message(user_id, message_data)
+    mongo_client.record_room_message(
+        user_id,
+        room_summary(message_data),
+        room_readers(user_id, message_data.get('username'))
+    )
+
+def _journal_message(message_data, user_id):
+    # insert_one may have added an ObjectId before failing; the replayed insert makes its own
+    message_data.pop('_id', None)
+    message_data['room'] = user_id
+    message_journal.append({'room': user_id, 'message': message_data})
+
+def _replay_message(record):
+    """Store one journaled message; replaying it twice leaves a single copy"""
+    room, message_data = record['room'], record['message']
+    try:
+        inserted = mongo_client.insert_message_once(room, message_data)
+    except DuplicateKeyError:
+        # A retry of the same send was stored under another id while this one waited
+        return
+    # Not inserted: a replay after a crash, or a live send whose message write landed but
+    # whose room summary write failed; record the summary unless the room already has it
+    mongo_client.record_room_message(room, room_summary(message_data),
+                                     room_readers(room, message_data.get('username')),
+                                     if_missing=not inserted)
+    if inserted:
+        # Live sends from other workers may already be newer: older history pages gained it
+        mongo_client.bump_history_version(history_views(message_data))
+
+def replay_journal_forever(sleep=time.sleep):
+    """Background loop writing journaled messages to MongoDB, oldest first"""
+    while True:
+        try:
+            while message_journal.replay(_replay_message):
+                pass
+            # Journals left by exited workers, e.g. the previous generation after a reload
+            for orphan in message_journal.orphans():
+                while orphan.replay(_replay_message):
+                    pass
+                if not orphan.backlog:
+                    message_journal.release(orphan)
+        except Exception as e:
+            log_error(f"Journal replay paused ({message_journal.backlog} pending)", e)
+        sleep(JOURNAL_REPLAY_INTERVAL)
+
+def find_sent_message(username, client_id):
+    """The message a client already sent under this idempotency key, if any"""
+    return mongo_client.find_message({'username': username, 'client_id': client_id})
+
+def sync_time():
+    """Server clock reading handed to clients as the 'since' of their next change-feed read"""
+    return datetime.now(timezone.utc).isoformat()
+
+def message_change(message):
+    """Compact edit/delete notification; clients apply it only if version is newer than theirs"""
+    change = {
+        'id': message.get('id'),
+        'room': message.get('room'),
+        'version': message.get('version', 1),
+        'message': message.get('message', ''),
+        'edited_at': message.get('edited_at')
+    }
+    if message.get('deleted'):
+        change['deleted'] = True
+    return change
+
+def edit_message(room, message_id, username, text, expected_version=None):
+    """Replace the text of one of username's messages; returns (message, error)"""
+    now = sync_time()
+    return _change_message(room, message_id, username, expected_version, {
+        'message': text,
+        'terms': index_terms(text),
+        'edited_at': now,
+        'changed_at': now
+    })
+
+def delete_message(room, message_id, username, expected_version=None):
+    """Turn a message into a tombstone so synced clients learn it is gone; returns (message, error)"""
+    now = sync_time()
+    return _change_message(room, message_id, username, expected_version, {
+        'message': '',
+        'terms': [],
+        'deleted': True,
+        'deleted_at': now,
+        'changed_at': now
+    })
+
+def _change_message(room, message_id, username, expected_version, update):
+    message = mongo_client.find_message({'$and': [room_query(room), {'id': message_id}]})
+    if message is None:
+        if find_cold_anchor(_segment_query(room), message_id) is not None:
+            return None, 'Archived messages cannot be changed'
+        return None, 'Message not found'
+    # Authors edit and delete their own messages; the admin may also delete anyone's
+    if message.get('username') != username and not (update.get('deleted') and username == _ME):
+        return None, 'You can only change your own messages'
+    if message.get('deleted'):
+        return None, 'Message was deleted'
+    version = message.get('version', 1)
+    if expected_version is not None and expected_version != version:
+        return None, 'Message was changed elsewhere, reload to see the latest version'
+
+    # Compare-and-set on the version so concurrent edits cannot overwrite each other;
+    # messages start without the field, which reads as version 1
+    query = {'room': message['room'], 'id': message_id, 'version': version if version > 1 else {'$in': [None, 1]}}
+    update['version'] = version + 1
+    if not mongo_client.update_message(query, update):
+        return None, 'Message was changed elsewhere, reload to see the latest version'
+    update.pop('terms', None)
+    message.update(update)
+    mongo_client.update_room_preview(message['room'], message_id, room_summary(message)['last_message'])
+    mongo_client.bump_history_version(history_views(message))
+    return message, None
+
+def get_changes_since(user_id, since, limit=CHANGE_FEED_LIMIT):
+    """Edits and deletions in a room after since, oldest first; returns (changes, complete) or None"""
+    try:
+        cutoff = (datetime.fromisoformat(since) - CHANGE_FEED_OVERLAP).isoformat()
+    except (TypeError, ValueError):
+        return None
+    changed = mongo_client.find_messages(
+        {'$and': [room_query(user_id), {'changed_at': {'$gt': cutoff}}]},
+        sort=[('changed_at', 1)], limit=limit + 1
+    )
+    changes = [message_change(present_message(message, user_id)) for message in changed[:limit]]
+    return changes, len(changed) <= limit
+
+def history_views(message):
+    """Rooms whose history shows message: its own room, and the admin inbox if flagged"""
+    rooms = [message['room']]
+    if message.get('inbox') and message['room'] != _ME:
+        rooms.append(_ME)
+    return rooms
+
+def get_history_version(user_id):
+    """Counter bumped whenever history already written in the room changes"""
+    return mongo_client.get_history_version(user_id)
+
+def room_summary(message_data):
+    """Denormalized last-message preview stored on the room document"""
+    return {
+        'last_message': str(message_data.get('message', ''))[:PREVIEW_LENGTH],
+        'last_message_id': message_data.get('id'),
+        'last_username': message_data.get('username'),
+        'last_timestamp': message_data.get('timestamp', '')
+    }
+
+def room_readers(room, sender):
+    """Participants of room who have not seen a message from sender yet"""
+    participants = {room, _ME}
+    participants.discard(sender)
+    return sorted(participants)
+
+def mark_room_read(room, reader):
+    return mongo_client.reset_unread(room, reader)
+
+def get_unread_counts(reader):
+    return mongo_client.get_unread_counts(reader)
+
+def get_rooms_page(reader, cursor=None, limit=20):
+    """One page of the room list, most recently active first.
+
+    cursor is the opaque "<last_timestamp>|<room>" string returned with the
+    previous page; usernames cannot contain '|'.
+    """
+    after = tuple(cursor.rsplit('|', 1)) if cursor and '|' in cursor else None
+    rooms = mongo_client.find_rooms(after, limit)
+    for room in rooms:
+        room['unread'] = room.get('unread', {}).get(reader, 0)
+    next_cursor = None
+    if len(rooms) == limit:
+        next_cursor = f"{rooms[-1].get('last_timestamp', '')}|{rooms[-1]['room']}"
+    return rooms, next_cursor
+
+def get_all_rooms():
+    """Every chat room; each user owns the room named after them"""
+    rooms = [user['username'] for user in mongo_client.user_collection.find({}, {'username': 1}) if user.get('username')]
+    if _ME not in rooms:
+        rooms.append(_ME)
+    return rooms
+
+def get_message_collection():
+    return mongo_client.get_message_collection()
 
 def get_messages(user_id, query):
-    return mongo_client.find_messages(user_id, query)
+    return mongo_client.find_messages({'$and': [room_query(user_id), query]})
 
 def get_recent_messages(user_id, limit=30):
-    messages = mongo_client.find_messages(user_id, {})
-    # Sort by timestamp and return most recent
-    sorted_messages = sorted(messages, key=lambda x: x.get('timestamp', ''), reverse=True)
-    return sorted_messages[:limit][::-1]  # Reverse to show oldest first
+    """Newest messages, oldest first; the list may be shared with concurrent callers"""
+    return history_reads.do((user_id, None, limit), lambda: _load_recent_messages(user_id, limit))
+
+def _load_recent_messages(user_id, limit):
+    messages = _messages_older_than(user_id, None, limit)
+    # Reverse to show oldest first
+    return [present_message(msg, user_id) for msg in reversed(messages)]
 
 def get_messages_before(user_id, before_message_id, limit=10):
     """Get messages before a specific message ID"""
-    all_messages = mongo_client.find_messages(user_id, {})
-    # Sort by timestamp (newest first)
-    sorted_messages = sorted(all_messages, key=lambda x: x.get('timestamp', ''), reverse=True)
-    
-    # Find the index of the message with the given ID
-    before_index = None
-    for i, msg in enumerate(sorted_messages):
-        if msg.get('id') == before_message_id:
-            before_index = i
-            break
-    
-    if before_index is None:
-        return []
+    messages = get_history_page(user_id, before_message_id, limit)
+    return messages if messages is not None else []
+
+def get_history_page(user_id, before_message_id, limit=50):
+    """Messages older than before_message_id, or None if that message is not in the room"""
+    return history_reads.do((user_id, before_message_id, limit),
+                            lambda: _load_history_page(user_id, before_message_id, limit))
+
+def find_room_message(user_id, message_id):
+    """A message shown in the room, from the hot or cold tier, or None"""
+    message = mongo_client.find_message({'$and': [room_query(user_id), {'id': message_id}]})
+    if message is None:
+        message = find_cold_anchor(_segment_query(user_id), message_id)
+    if message is None or not _in_room(message, user_id):
+        return None
+    return message
+
+def _load_history_page(user_id, before_message_id, limit):
+    anchor = find_room_message(user_id, before_message_id)
+    if anchor is None:
+        return None
     
-    # Get messages that are older (higher index in the reverse-sorted array)
-    older_messages = sorted_messages[before_index + 1:before_index + 1 + limit]
+    # Get messages that are older than the anchor, newest first
+    older_messages = _messages_older_than(user_id, anchor.get('timestamp', ''), limit)
     # Return in chronological order (oldest first)
-    return older_messages[::-1]
+    return [present_message(msg, user_id) for msg in reversed(older_messages)]
+
+def _segment_query(user_id):
+    """Archive segments that can hold messages of a room (the inbox spans every room)"""
+    return {} if user_id == _ME else {'room': user_id}
+
+def _in_room(message, user_id):
+    return bool(message.get('inbox')) if user_id == _ME else True
+
+def _messages_older_than(user_id, timestamp, limit):
+    """Newest-first page older than timestamp (None for the newest page), across hot and cold tiers"""
+    if timestamp is None:
+        hot = mongo_client.find_messages(room_query(user_id), sort=[('timestamp', -1)], limit=limit)
+    elif settled_for_secondaries(timestamp):
+        # Anchored further in the past than any selectable secondary lags: safe to serve from one
+        hot = mongo_client.find_history({'$and': [room_query(user_id), {'timestamp': {'$lt': timestamp}}]},
+                                        sort=[('timestamp', -1)], limit=limit)
+    else:
+        # A recent anchor: a lagging secondary could still be missing messages just before it
+        hot = mongo_client.find_messages({'$and': [room_query(user_id), {'timestamp': {'$lt': timestamp}}]},
+                                         sort=[('timestamp', -1)], limit=limit)
+    # Archival seals the oldest messages of a room first, so with a full hot page only
+    # segments overlapping it (other rooms, in the inbox) can contribute
+    boundary = hot[-1].get('timestamp', '') if len(hot) >= limit else ''
+    cold = cold_messages_between(
+        _segment_query(user_id), lambda m: _in_room(m, user_id),
+        boundary, timestamp if timestamp is not None else '\uffff', limit
+    )
+    if not cold:
+        return hot
+    # A message can briefly exist in both tiers while a segment is being sealed
+    archived_ids = {message.get('id') for message in cold}
+    merged = [message for message in hot if message.get('id') not in archived_ids] + cold
+    merged.sort(key=lambda m: m.get('timestamp', ''), reverse=True)
+    return merged[:limit]
+
+def _rarest_first(user_id, folded_terms):
+    """Distinct terms by ascending frequency in the room; counts stop at SEARCH_SCAN_LIMIT"""
+    folded_terms = list(dict.fromkeys(folded_terms))
+    if len(folded_terms) < 2:
+        return folded_terms
+    # Each count is an index-only scan of one term's keys, capped like the search itself
+    counts = {term: mongo_client.count_messages({'$and': [room_query(user_id), {'terms': term}]},
+                                                limit=SEARCH_SCAN_LIMIT + 1)
+              for term in folded_terms}
+    return sorted(folded_terms, key=lambda term: counts[term])
+
+def search_messages(user_id, query, page=1, page_size=20):
+    """Ranked, paginated full-text search within a room.
+
+    Candidates come from the (room, terms, timestamp) multikey index, newest
+    first and capped at SEARCH_SCAN_LIMIT, then are ranked in memory. Only
+    the hot tier is searched: archived messages are not found.
+
+    The index bounds the scan by the first term of $all only; the others are
+    checked on each fetched document. Terms are therefore ordered rarest
+    first, so the scan covers the messages of the least common term.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return [], False
+    folded_terms = _rarest_first(user_id, [folded for _, folded in terms])
+    candidates = mongo_client.find_messages(
+        {'$and': [room_query(user_id), {'terms': {'$all': folded_terms}}]},
+        sort=[('timestamp', -1)],
+        limit=SEARCH_SCAN_LIMIT
+    )
+    ranked = []
+    for message in candidates:
+        score, hit_start, spans = score_message(message.get('message', ''), terms)
+        ranked.append((score, message.get('timestamp', ''), message, hit_start, spans))
+    ranked.sort(key=lambda hit: (hit[0], hit[1]), reverse=True)
+    
+    start = (page - 1) * page_size
+    results = []
+    for score, _, message, hit_start, spans in ranked[start:start + page_size]:
+        text, highlights = snippet(message.get('message', ''), hit_start, spans)
+        results.append({
+            'id': message.get('id'),
+            'username': message.get('username'),
+            'room': message.get('room'),
+            'timestamp': message.get('timestamp'),
+            'snippet': text,
+            'highlights': highlights,
+            'score': score
+        })
+    return results, start + page_size < len(ranked)
 
+@traced('get_room')
 def get_room(user_id):
-    _ME = "dtanh"
     if user_id == _ME:
         # Get user's current room from MongoDB
         user_doc = mongo_client.find_user({'username': _ME})
         if user_doc:
             return user_doc.get('room', _ME)
         return _ME
-    return user_id
\ No newline at end of file
+    return user_id
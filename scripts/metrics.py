@@ -0,0 +1,399 @@
+import hmac
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from flask import Response, g, request
+from scripts.db_profiler import get_profile_snapshot, LATENCY_BUCKETS_MS
+from scripts import tracing
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Without a token /metrics only answers direct requests from the local host
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+_LOOPBACK = {'127.0.0.1', '::1'}
+
+_registry = []
+_collectors = []
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class for a labelled metric family"""
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        """Return the child for the given label values (cache it on the hot path)"""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, *values, amount=1):
+        self.labels(*values).inc(amount)
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"]
+
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, *values, value=0):
+        self.labels(*values).set(value)
+
+    def replace(self, values_by_labels):
+        """Atomically replace every child, e.g. from a scrape-time collector"""
+        children = {}
+        for key, value in values_by_labels.items():
+            child = _GaugeChild()
+            child.value = value
+            children[tuple(str(v) for v in key)] = child
+        self._children = children
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Non-cumulative bucket counts; cumulated at render time
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value, *values):
+        self.labels(*values).observe(value)
+
+    def _render_child(self, key, child):
+        return render_histogram(self.name, self.labelnames, key, self.buckets,
+                                child.counts, child.sum, child.count)
+
+
+def render_histogram(name, labelnames, key, buckets, counts, total, count):
+    """Render one histogram series from non-cumulative bucket counts"""
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(list(buckets) + [float('inf')], counts):
+        cumulative += bucket_count
+        labels = _format_labels(labelnames, key, ('le', _format_value(float(bound))))
+        lines.append(f"{name}_bucket{labels} {cumulative}")
+    labels = _format_labels(labelnames, key)
+    lines.append(f"{name}_sum{labels} {_format_value(float(total))}")
+    lines.append(f"{name}_count{labels} {count}")
+    return lines
+
+
+def register_collector(collector):
+    """Register a callable run at scrape time that returns extra exposition lines"""
+    _collectors.append(collector)
+
+
+# Socket.IO metrics
+socketio_events_total = Counter(
+    'socketio_events_total', 'Socket.IO events handled', ['event'])
+socketio_event_errors_total = Counter(
+    'socketio_event_errors_total', 'Socket.IO handlers that raised', ['event'])
+socketio_event_duration_seconds = Histogram(
+    'socketio_event_duration_seconds', 'Socket.IO handler latency', ['event'])
+socketio_emits_total = Counter(
+    'socketio_emits_total', 'Socket.IO events emitted by the server', ['event'])
+socketio_broadcast_fanout = Histogram(
+    'socketio_broadcast_fanout', 'Number of sockets reached by a room broadcast', ['event'],
+    buckets=FANOUT_BUCKETS)
+socketio_events_in_flight = Gauge(
+    'socketio_events_in_flight', 'Socket.IO handlers currently running', ['event'])
+# Aggregates only: room names are usernames and must not leak through labels
+socketio_connected_clients = Gauge(
+    'socketio_connected_clients', 'Connected Socket.IO clients in chat rooms')
+socketio_active_rooms = Gauge(
+    'socketio_active_rooms', 'Chat rooms with at least one connected client')
+
+# HTTP metrics
+http_requests_total = Counter(
+    'http_requests_total', 'HTTP requests handled', ['endpoint', 'method', 'status'])
+http_request_duration_seconds = Histogram(
+    'http_request_duration_seconds', 'HTTP route latency', ['endpoint'])
+
+
+def track_event(event):
+    """Decorator that counts, times and traces a Socket.IO event handler"""
+    calls = socketio_events_total.labels(event)
+    errors = socketio_event_errors_total.labels(event)
+    duration = socketio_event_duration_seconds.labels(event)
+    in_flight = socketio_events_in_flight.labels(event)
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            in_flight.inc()
+            try:
+                with tracing.root_span(f"socketio {event}", attributes={'socketio.event': event}):
+                    return f(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                in_flight.dec()
+                duration.observe(time.perf_counter() - start)
+                calls.inc()
+        return wrapper
+    return decorator
+
+
+def events_in_flight():
+    """Socket.IO handlers currently running, e.g. for draining a worker"""
+    return sum(child.value for child in list(socketio_events_in_flight._children.values()))
+
+
+def _room_participants(socketio, room):
+    try:
+        rooms = socketio.server.manager.rooms['/']
+    except (AttributeError, KeyError):
+        return None
+    if isinstance(room, (list, tuple, set)):
+        participants = set()
+        for name in room:
+            participants.update(rooms.get(name, ()))
+        return participants
+    return rooms.get(room)
+
+
+def instrument_socketio(socketio):
+    """Count emits and record the fan-out size of room broadcasts"""
+    original_emit = socketio.emit
+
+    @wraps(original_emit)
+    def emit(event, *args, **kwargs):
+        socketio_emits_total.labels(event).inc()
+        to = kwargs.get('to') or kwargs.get('room')
+        if to is not None:
+            participants = _room_participants(socketio, to)
+            # Emits addressed to a single sid are not broadcasts
+            if participants is not None and (isinstance(to, (list, tuple, set)) or to not in participants):
+                socketio_broadcast_fanout.labels(event).observe(len(participants))
+        with tracing.span(f"emit {event}", 'producer', {'socketio.room': str(to)} if to is not None else None):
+            return original_emit(event, *args, **kwargs)
+
+    socketio.emit = emit
+
+    def collect_rooms():
+        # Derived from the room table at scrape time so connect/disconnect cost nothing extra
+        try:
+            rooms = socketio.server.manager.rooms.get('/', {})
+        except AttributeError:
+            return []
+        clients = set()
+        active = 0
+        for room, participants in list(rooms.items()):
+            # Every socket is also in a private room named after its sid
+            if room is None or room in participants or not participants:
+                continue
+            # The admin socket joins every room: count each client once
+            clients.update(participants)
+            active += 1
+        socketio_connected_clients.set(value=len(clients))
+        socketio_active_rooms.set(value=active)
+        return []
+
+    register_collector(collect_rooms)
+
+
+def collect_mongo_calls():
+    """Expose the MongoDB profiler histograms in Prometheus format"""
+    snapshot = get_profile_snapshot()
+    buckets = tuple(b / 1000.0 for b in LATENCY_BUCKETS_MS)
+    lines = ["# HELP mongo_call_duration_seconds MongoDBClient and GridFS call latency",
+             "# TYPE mongo_call_duration_seconds histogram"]
+    for method, stats in snapshot['methods'].items():
+        latency = stats['latency']
+        lines.extend(render_histogram('mongo_call_duration_seconds', ('method',), (method,), buckets,
+                                      list(latency['buckets'].values()),
+                                      latency['total_ms'] / 1000.0, latency['count']))
+    lines.append("# HELP mongo_call_documents_total Documents returned by MongoDBClient and GridFS calls")
+    lines.append("# TYPE mongo_call_documents_total counter")
+    for method, stats in snapshot['methods'].items():
+        lines.append(f"mongo_call_documents_total{_format_labels(('method',), (method,))} {stats['documents']}")
+    return lines
+
+
+register_collector(collect_mongo_calls)
+
+
+def collect_mongo_pools():
+    """Expose connection pool utilization and checkout wait time per server"""
+    pools = get_profile_snapshot()['pools']
+    buckets = tuple(b / 1000.0 for b in LATENCY_BUCKETS_MS)
+    lines = ["# HELP mongo_pool_max_size Configured maxPoolSize",
+             "# TYPE mongo_pool_max_size gauge"]
+    for address, stats in pools.items():
+        lines.append(f"mongo_pool_max_size{_format_labels(('address',), (address,))} {stats['max_size']}")
+    lines.append("# HELP mongo_pool_connections Pooled connections by state")
+    lines.append("# TYPE mongo_pool_connections gauge")
+    for address, stats in pools.items():
+        for state in ('open', 'checked_out'):
+            lines.append(f"mongo_pool_connections{_format_labels(('address', 'state'), (address, state))} {stats[state]}")
+    lines.append("# HELP mongo_pool_checkout_failures_total Failed connection checkouts by reason")
+    lines.append("# TYPE mongo_pool_checkout_failures_total counter")
+    for address, stats in pools.items():
+        for reason, count in stats['checkout_failures'].items():
+            lines.append(f"mongo_pool_checkout_failures_total{_format_labels(('address', 'reason'), (address, reason))} {count}")
+    lines.append("# HELP mongo_pool_checkout_wait_seconds Time spent waiting for a pooled connection")
+    lines.append("# TYPE mongo_pool_checkout_wait_seconds histogram")
+    for address, stats in pools.items():
+        wait = stats['checkout_wait']
+        lines.extend(render_histogram('mongo_pool_checkout_wait_seconds', ('address',), (address,), buckets,
+                                      list(wait['buckets'].values()), wait['total_ms'] / 1000.0, wait['count']))
+    return lines
+
+
+register_collector(collect_mongo_pools)
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text exposition format"""
+    extra = []
+    for collector in _collectors:
+        try:
+            extra.extend(collector())
+        except Exception as e:
+            print(f"Metrics collector error: {e}")
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.extend(extra)
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics_allowed():
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}")
+    # A reverse proxy on the same host adds X-Forwarded-For; those requests came from outside
+    return request.remote_addr in _LOOPBACK and 'X-Forwarded-For' not in request.headers
+
+
+def metrics_view():
+    """Serve /metrics to bearers of METRICS_TOKEN, or to the local host when no token is set"""
+    if not _metrics_allowed():
+        return Response("Not authorized\n", status=403, mimetype='text/plain')
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app, socketio):
+    """Install HTTP timing hooks, Socket.IO emit instrumentation and the /metrics route"""
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            http_request_duration_seconds.labels(endpoint).observe(time.perf_counter() - start)
+            http_requests_total.labels(endpoint, request.method, response.status_code).inc()
+        return response
+
+    instrument_socketio(socketio)
+    app.add_url_rule('/metrics', 'metrics', metrics_view, methods=['GET'])
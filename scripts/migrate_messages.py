@@ -0,0 +1,114 @@
+"""Copy legacy messages_<room> collections into the unified message store.
+
+Usage: python -m scripts.migrate_messages [--dry-run] [--reindex-search]
+
+Admin mirror copies ("<user>: text" documents in messages_dtanh) are
+skipped because the admin inbox is now served from the original
+documents. Re-running is safe: documents are upserted by (room, id).
+Afterwards the per-room summary documents (last message, count) are
+rebuilt from the unified store, every user gets a room entry and
+messages written before search existed get their index terms.
+--reindex-search recomputes the terms of every message, for messages
+indexed before decomposed (NFD) text was normalized.
+"""
+import sys
+from pymongo import UpdateOne
+from scripts.mongo_client import MongoDBClient
+from scripts.message_handler import _ME, belongs_to_inbox, room_summary
+from scripts.search_index import index_terms
+
+BATCH_SIZE = 1000
+LEGACY_PREFIX = "messages_"
+
+
+def is_admin_mirror(room, message):
+    """Return True for the prefixed copies handle_send_message used to write to the admin room"""
+    username = message.get('username')
+    if room != _ME or username == _ME:
+        return False
+    return str(message.get('message', '')).startswith(f"<{username}>: ")
+
+
+def migrate_room(mongo_client, room, dry_run=False):
+    """Migrate one legacy room collection, returning (copied, skipped_mirrors)"""
+    legacy = mongo_client.get_legacy_message_collection(room)
+    target = mongo_client.get_message_collection()
+    copied = skipped = 0
+    batch = []
+    for message in legacy.find({}, batch_size=BATCH_SIZE):
+        if is_admin_mirror(room, message):
+            skipped += 1
+            continue
+        message.pop('_id', None)
+        message['room'] = room
+        if belongs_to_inbox(message, room):
+            message['inbox'] = True
+        message['terms'] = index_terms(message.get('message'))
+        batch.append(UpdateOne({'room': room, 'id': message.get('id')}, {'$setOnInsert': message}, upsert=True))
+        copied += 1
+        if len(batch) >= BATCH_SIZE:
+            if not dry_run:
+                target.bulk_write(batch, ordered=False)
+            batch = []
+    if batch and not dry_run:
+        target.bulk_write(batch, ordered=False)
+    return copied, skipped
+
+
+def rebuild_room_index(mongo_client, dry_run=False):
+    """Recompute message_count and the last-message summary of every room"""
+    pipeline = [
+        {'$sort': {'timestamp': 1}},
+        {'$group': {'_id': '$room', 'count': {'$sum': 1}, 'last': {'$last': '$$ROOT'}}}
+    ]
+    rebuilt = 0
+    for group in mongo_client.get_message_collection().aggregate(pipeline, allowDiskUse=True):
+        summary = room_summary(group['last'])
+        summary['message_count'] = group['count']
+        if not dry_run:
+            mongo_client.rooms_collection.update_one({'room': group['_id']}, {'$set': summary}, upsert=True)
+        rebuilt += 1
+    for user in mongo_client.user_collection.find({}, {'username': 1}):
+        if user.get('username') and not dry_run:
+            mongo_client.ensure_room(user['username'])
+    return rebuilt
+
+
+def backfill_search_terms(mongo_client, dry_run=False, reindex=False):
+    """Add search terms to messages stored before the search index existed (or fix them all)"""
+    collection = mongo_client.get_message_collection()
+    query = {} if reindex else {'terms': {'$exists': False}}
+    updated = 0
+    batch = []
+    for message in collection.find(query, {'message': 1, 'terms': 1}, batch_size=BATCH_SIZE):
+        terms = index_terms(message.get('message'))
+        if terms == message.get('terms'):
+            continue
+        batch.append(UpdateOne({'_id': message['_id']}, {'$set': {'terms': terms}}))
+        if len(batch) >= BATCH_SIZE:
+            if not dry_run:
+                collection.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch and not dry_run:
+        collection.bulk_write(batch, ordered=False)
+    return updated + len(batch)
+
+
+def main(argv):
+    dry_run = '--dry-run' in argv
+    mongo_client = MongoDBClient()
+    names = sorted(n for n in mongo_client.message_db.list_collection_names() if n.startswith(LEGACY_PREFIX))
+    for name in names:
+        room = name[len(LEGACY_PREFIX):]
+        copied, skipped = migrate_room(mongo_client, room, dry_run)
+        print(f"{name}: {copied} messages copied, {skipped} admin mirror copies skipped")
+    print(f"{rebuild_room_index(mongo_client, dry_run)} room summaries rebuilt")
+    reindex = '--reindex-search' in argv
+    print(f"{backfill_search_terms(mongo_client, dry_run, reindex)} messages given search terms")
+    if dry_run:
+        print("Dry run, nothing was written")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,23 +1,104 @@
-
+from datetime import datetime, timedelta, timezone
+from functools import cached_property
+import importlib.util
+import threading
+from pymongo import UpdateOne
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.write_concern import WriteConcern
+from gridfs import GridFS
 import os
 from dotenv import load_dotenv
+from scripts.db_profiler import event_listeners, instrument_methods, ProfiledGridFS
 
 load_dotenv()
 
-username = os.getenv('MONGODB_USERNAME')
-password = os.getenv('MONGODB_PASSWORD')
-cluster = os.getenv('MONGODB_CLUSTER')
-appname = os.getenv('MONGODB_APPNAME')
+# Search terms are index material only; keep them out of history reads
+MESSAGE_PROJECTION = {'terms': 0}
+READY_TIMEOUT_MS = int(os.getenv('MONGODB_READY_TIMEOUT_MS', '2000'))
+
+# Production pool and timeout presets as (env var, default); every value can be overridden
+POOL_OPTIONS = {
+    'maxPoolSize': ('MONGODB_MAX_POOL_SIZE', 50),
+    'minPoolSize': ('MONGODB_MIN_POOL_SIZE', 5),
+    'maxConnecting': ('MONGODB_MAX_CONNECTING', 2),
+    'maxIdleTimeMS': ('MONGODB_MAX_IDLE_TIME_MS', 300000),
+    'waitQueueTimeoutMS': ('MONGODB_WAIT_QUEUE_TIMEOUT_MS', 2000),
+    'connectTimeoutMS': ('MONGODB_CONNECT_TIMEOUT_MS', 5000),
+    'serverSelectionTimeoutMS': ('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 5000),
+    'socketTimeoutMS': ('MONGODB_SOCKET_TIMEOUT_MS', 20000),
+}
+# Wire compression in preference order; the server picks the first one it supports
+COMPRESSORS = os.getenv('MONGODB_COMPRESSORS', 'zstd,snappy,zlib')
+ZLIB_LEVEL = int(os.getenv('MONGODB_ZLIB_LEVEL', '6'))
+# Older history pages tolerate slightly stale reads and can be served by secondaries
+HISTORY_READ_PREFERENCE = os.getenv('MONGODB_HISTORY_READ_PREFERENCE', 'secondaryPreferred')
+HISTORY_MAX_STALENESS_S = int(os.getenv('MONGODB_HISTORY_MAX_STALENESS_S', '90'))
+# Driver default heartbeatFrequencyMS; staleness is only measured this often
+HEARTBEAT_S = 10
+# Login history is an audit trail; losing a row on failover is acceptable
+LOGIN_HISTORY_W = os.getenv('MONGODB_LOGIN_HISTORY_W', '1')
+
+_COMPRESSOR_MODULES = {'zstd': 'zstandard', 'snappy': 'snappy'}
+_READ_PREFERENCES = {
+    'primaryPreferred': PrimaryPreferred,
+    'secondary': Secondary,
+    'secondaryPreferred': SecondaryPreferred,
+    'nearest': Nearest,
+}
+
+
+def build_uri():
+    """Connection string from MONGODB_URI, or assembled from the Atlas credentials"""
+    if os.getenv('MONGODB_URI'):
+        return os.getenv('MONGODB_URI')
+    username = os.getenv('MONGODB_USERNAME')
+    password = os.getenv('MONGODB_PASSWORD')
+    cluster = os.getenv('MONGODB_CLUSTER')
+    appname = os.getenv('MONGODB_APPNAME')
+    if not username or not password:
+        raise ValueError("MONGODB_USERNAME and MONGODB_PASSWORD must be set in environment variables")
+    return f"mongodb+srv://{username}:{password}@{cluster}.mongodb.net/?retryWrites=true&w=majority&appName={appname}"
+
+def available_compressors(names=COMPRESSORS):
+    """Configured compressors whose Python module is installed (zlib always is)"""
+    available = []
+    for name in (n.strip() for n in names.split(',')):
+        module = _COMPRESSOR_MODULES.get(name)
+        if name and (module is None or importlib.util.find_spec(module) is not None):
+            available.append(name)
+    return available
 
-if not username or not password:
-    raise ValueError("MONGODB_USERNAME and MONGODB_PASSWORD must be set in environment variables")
+def client_options():
+    """MongoClient keyword arguments from the environment"""
+    options = {name: int(os.getenv(env, default)) for name, (env, default) in POOL_OPTIONS.items()}
+    compressors = available_compressors()
+    if compressors:
+        options['compressors'] = ','.join(compressors)
+        options['zlibCompressionLevel'] = ZLIB_LEVEL
+    return options
 
-uri = f"mongodb+srv://{username}:{password}@{cluster}.mongodb.net/?retryWrites=true&w=majority&appName={appname}"
+def history_read_preference():
+    mode = _READ_PREFERENCES.get(HISTORY_READ_PREFERENCE)
+    return mode(max_staleness=HISTORY_MAX_STALENESS_S) if mode else Primary()
+
+def settled_for_secondaries(timestamp):
+    """Whether history older than timestamp can be read from a secondary without missing messages.
+
+    A selected secondary may lag by up to HISTORY_MAX_STALENESS_S plus one
+    heartbeat, so pages anchored on more recent messages go to the primary.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=HISTORY_MAX_STALENESS_S + HEARTBEAT_S)
+    return timestamp < cutoff.isoformat()
 
 class MongoDBClient:
-    """Singleton MongoDB client - only one instance per application"""
+    """Singleton MongoDB client - only one instance per application.
+
+    Nothing touches the network at import: the driver client, databases,
+    collections and GridFS buckets are created on first use, and the
+    connectivity check and index creation run from ensure_ready().
+    """
     _instance = None
     _initialized = False
     
@@ -31,20 +112,86 @@ class MongoDBClient:
         if MongoDBClient._initialized:
             return
         
-        self.client = MongoClient(uri, server_api=ServerApi('1'))
-        try:
-            self.client.admin.command('ping')
-            print("Pinged your deployment. You successfully connected to MongoDB!")
-        except Exception as e:
-            print(f"Error connecting to MongoDB: {e}")
-        self.user_db = self.client["userdata"]
-        self.user_collection = self.user_db["data"]
-        self.sessions_collection = self.user_db["sessions"]
-        self.login_history_collection = self.user_db["login_history"]
-        self.message_db = self.client["messages"]
-        
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._gridfs = {}
+        self._ready = False
         MongoDBClient._initialized = True
 
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    # The driver connects in the background; this does not block on the cluster
+                    self._client = MongoClient(build_uri(), server_api=ServerApi('1'),
+                                               event_listeners=event_listeners(), **client_options())
+        return self._client
+
+    @cached_property
+    def user_db(self):
+        return self.client["userdata"]
+
+    @cached_property
+    def user_collection(self):
+        return self.user_db["data"]
+
+    @cached_property
+    def sessions_collection(self):
+        return self.user_db["sessions"]
+
+    @cached_property
+    def login_history_collection(self):
+        w = int(LOGIN_HISTORY_W) if LOGIN_HISTORY_W.isdigit() else LOGIN_HISTORY_W
+        return self.user_db["login_history"].with_options(write_concern=WriteConcern(w=w))
+
+    @cached_property
+    def message_db(self):
+        return self.client["messages"]
+
+    @cached_property
+    def messages_collection(self):
+        return self.message_db["messages"]
+
+    @cached_property
+    def history_collection(self):
+        """Messages collection for reads of older history pages"""
+        return self.messages_collection.with_options(read_preference=history_read_preference())
+
+    @cached_property
+    def rooms_collection(self):
+        return self.message_db["rooms"]
+
+    @cached_property
+    def archive_segments_collection(self):
+        return self.message_db["archive_segments"]
+
+    @cached_property
+    def import_checkpoints_collection(self):
+        return self.message_db["import_checkpoints"]
+
+    def get_gridfs(self, collection='fs'):
+        """GridFS bucket in the file_storage database, created on first use"""
+        fs = self._gridfs.get(collection)
+        if fs is None:
+            fs = self._gridfs[collection] = ProfiledGridFS(GridFS(self.client["file_storage"], collection=collection))
+        return fs
+
+    def ping(self, timeout_ms=READY_TIMEOUT_MS):
+        self.client.admin.command('ping', maxTimeMS=timeout_ms)
+
+    def ensure_ready(self):
+        """Connectivity check for the readiness probe; creates indexes on the first success"""
+        self.ping()
+        if not self._ready:
+            try:
+                self.ensure_message_indexes()
+            except Exception as e:
+                print(f"Error creating message indexes: {e}")
+            else:
+                print("Connected to MongoDB, indexes ensured")
+                self._ready = True
+
     def insert_user(self, user_data):
         result = self.user_collection.insert_one(user_data)
         return result.inserted_id
@@ -121,29 +268,259 @@ class MongoDBClient:
                 record['_id'] = str(record['_id'])
         return history
 
-    def get_message_collection(self, user_id):
+    def get_message_collection(self):
+        """Single message store shared by every room; documents carry a 'room' field"""
+        return self.messages_collection
+
+    def get_legacy_message_collection(self, user_id):
+        """Pre-unification per-room collection, only read by the migration script"""
         return self.message_db[f"messages_{user_id}"]
-    
-    def insert_message(self, user_id, message_data):
-        collection = self.get_message_collection(user_id)
-        result = collection.insert_one(message_data)
+
+    def ensure_message_indexes(self):
+        self.messages_collection.create_index([('room', 1), ('timestamp', -1)])
+        # Serves the admin inbox; only documents flagged for the inbox are indexed
+        self.messages_collection.create_index(
+            [('inbox', 1), ('timestamp', -1)],
+            partialFilterExpression={'inbox': True}
+        )
+        self.messages_collection.create_index([('id', 1)])
+        # Change feed for reconnect sync: only edited or deleted messages carry changed_at
+        self.messages_collection.create_index(
+            [('room', 1), ('changed_at', 1)],
+            partialFilterExpression={'changed_at': {'$exists': True}}
+        )
+        self.messages_collection.create_index(
+            [('inbox', 1), ('changed_at', 1)],
+            partialFilterExpression={'inbox': True, 'changed_at': {'$exists': True}}
+        )
+        # Idempotent sends: one stored message per client-generated key
+        self.messages_collection.create_index(
+            [('username', 1), ('client_id', 1)],
+            unique=True,
+            partialFilterExpression={'client_id': {'$exists': True}}
+        )
+        # Inverted index for search: multikey over the folded terms of each message
+        self.messages_collection.create_index([('room', 1), ('terms', 1), ('timestamp', -1)])
+        self.messages_collection.create_index(
+            [('inbox', 1), ('terms', 1), ('timestamp', -1)],
+            partialFilterExpression={'inbox': True}
+        )
+        self.rooms_collection.create_index([('room', 1)], unique=True)
+        # Recency-sorted, keyset-paginated room list
+        self.rooms_collection.create_index([('last_timestamp', -1), ('room', 1)])
+        # Cold tier: segments by time range, and by message id to resolve history cursors
+        self.archive_segments_collection.create_index([('room', 1), ('last_timestamp', -1)])
+        self.archive_segments_collection.create_index([('last_timestamp', -1)])
+        self.archive_segments_collection.create_index([('ids', 1)])
+        self.import_checkpoints_collection.create_index([('import_id', 1)], unique=True)
+
+    def insert_message(self, room, message_data):
+        message_data['room'] = room
+        result = self.messages_collection.insert_one(message_data)
         return str(result.inserted_id)
-    
-    def find_messages(self, user_id, query):
-        collection = self.get_message_collection(user_id)
-        messages = list(collection.find(query))
+
+    def insert_message_once(self, room, message_data):
+        """Insert keyed on (room, id) so a replay cannot duplicate; True if the message was new"""
+        message_data['room'] = room
+        result = self.messages_collection.update_one(
+            {'room': room, 'id': message_data['id']},
+            {'$setOnInsert': message_data},
+            upsert=True
+        )
+        return result.upserted_id is not None
+
+    def find_message(self, query):
+        message = self.messages_collection.find_one(query, MESSAGE_PROJECTION)
+        if message and '_id' in message:
+            message['_id'] = str(message['_id'])
+        return message
+
+    def find_messages(self, query, sort=None, limit=0, projection=MESSAGE_PROJECTION):
+        cursor = self.messages_collection.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        messages = list(cursor)
         # Convert ObjectId to string for JSON serialization
         for message in messages:
             if '_id' in message:
                 message['_id'] = str(message['_id'])
         return messages
-    
-    def update_message(self, user_id, query, update_data):
-        collection = self.get_message_collection(user_id)
-        result = collection.update_one(query, {'$set': update_data})
+
+    def count_messages(self, query, limit=0):
+        options = {'limit': limit} if limit else {}
+        return self.messages_collection.count_documents(query, **options)
+
+    def find_history(self, query, sort=None, limit=0):
+        """find_messages for pages anchored in the past, honouring the history read preference"""
+        cursor = self.history_collection.find(query, MESSAGE_PROJECTION)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        messages = list(cursor)
+        for message in messages:
+            if '_id' in message:
+                message['_id'] = str(message['_id'])
+        return messages
+
+    def iter_messages(self, query, sort=None, batch_size=1000, projection=MESSAGE_PROJECTION):
+        """Stream matching messages through cursor batches instead of materializing them"""
+        cursor = self.messages_collection.find(query, projection, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        for message in cursor:
+            if '_id' in message:
+                message['_id'] = str(message['_id'])
+            yield message
+
+    def insert_messages(self, messages):
+        """Ordered bulk insert: on failure everything before the bad document is kept"""
+        result = self.messages_collection.insert_many(messages, ordered=True)
+        return len(result.inserted_ids)
+
+    def update_message(self, query, update_data):
+        result = self.messages_collection.update_one(query, {'$set': update_data})
         return result.modified_count
-    
-    def delete_message(self, user_id, query):
-        collection = self.get_message_collection(user_id)
-        result = collection.delete_one(query)
-        return result.deleted_count
\ No newline at end of file
+
+    def delete_message(self, query):
+        result = self.messages_collection.delete_one(query)
+        return result.deleted_count
+
+    def delete_messages(self, query):
+        result = self.messages_collection.delete_many(query)
+        return result.deleted_count
+
+    def insert_archive_segment(self, segment_data):
+        result = self.archive_segments_collection.insert_one(segment_data)
+        return str(result.inserted_id)
+
+    def has_archive_segments(self):
+        return self.archive_segments_collection.find_one({}, {'_id': 1}) is not None
+
+    def find_archive_segment(self, query):
+        return self.archive_segments_collection.find_one(query, {'_id': 0, 'ids': 0})
+
+    def find_archive_segments(self, query, sort=None):
+        """Stream segment index documents, without their id lists; callers may stop early"""
+        cursor = self.archive_segments_collection.find(query, {'_id': 0, 'ids': 0})
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def get_import_checkpoint(self, import_id):
+        return self.import_checkpoints_collection.find_one({'import_id': import_id}, {'_id': 0})
+
+    def save_import_checkpoint(self, import_id, room, lines_done):
+        self.import_checkpoints_collection.update_one(
+            {'import_id': import_id},
+            {'$set': {'room': room, 'lines_done': lines_done}},
+            upsert=True
+        )
+
+    def delete_import_checkpoint(self, import_id):
+        self.import_checkpoints_collection.delete_one({'import_id': import_id})
+
+    def ensure_room(self, room):
+        result = self.rooms_collection.update_one(
+            {'room': room},
+            {'$setOnInsert': {'message_count': 0, 'last_timestamp': ''}},
+            upsert=True
+        )
+        return result.upserted_id is not None
+
+    def record_room_message(self, room, summary, readers, if_missing=False):
+        """Fold a new message into the room's summary and unread counters in one write.
+
+        With if_missing the write is skipped when the room already shows this
+        message or a later one, so a summary whose write was lost can be
+        recorded again without counting the message twice.
+        """
+        increments = {f'unread.{reader}': 1 for reader in readers}
+        increments['message_count'] = 1
+        query = {'room': room}
+        if if_missing:
+            query['last_timestamp'] = {'$not': {'$gte': summary['last_timestamp']}}
+        result = self.rooms_collection.update_one(
+            query,
+            {'$set': summary, '$inc': increments},
+            upsert=not if_missing
+        )
+        return result.modified_count
+
+    def update_room_preview(self, room, message_id, preview):
+        """Rewrite the room's last-message preview if it still shows message_id"""
+        result = self.rooms_collection.update_one(
+            {'room': room, 'last_message_id': message_id},
+            {'$set': {'last_message': preview}}
+        )
+        return result.modified_count
+
+    def bump_history_version(self, rooms):
+        """Count a change to already-written history in each room (edits, deletes, late inserts)"""
+        for room in rooms:
+            self.rooms_collection.update_one(
+                {'room': room},
+                {'$inc': {'history_version': 1}, '$setOnInsert': {'message_count': 0, 'last_timestamp': ''}},
+                upsert=True
+            )
+
+    def get_history_version(self, room):
+        doc = self.rooms_collection.find_one({'room': room}, {'_id': 0, 'history_version': 1}) or {}
+        return doc.get('history_version', 0)
+
+    def find_rooms(self, after=None, limit=20):
+        """Rooms by most recent activity; after is the (last_timestamp, room) of the previous page"""
+        query = {}
+        if after:
+            last_timestamp, room = after
+            query = {'$or': [
+                {'last_timestamp': {'$lt': last_timestamp}},
+                {'last_timestamp': last_timestamp, 'room': {'$gt': room}}
+            ]}
+        cursor = self.rooms_collection.find(query, {'_id': 0}).sort([('last_timestamp', -1), ('room', 1)]).limit(limit)
+        return list(cursor)
+
+    def reset_unread(self, room, reader):
+        # Matching on a non-zero counter keeps repeated reads from issuing writes
+        result = self.rooms_collection.update_one(
+            {'room': room, f'unread.{reader}': {'$gt': 0}},
+            {'$set': {f'unread.{reader}': 0}}
+        )
+        return result.modified_count
+
+    def save_receipts(self, receipts):
+        """Advance cumulative receipt markers in one bulk write.
+
+        receipts maps (room, user) to {kind: {'timestamp', 'id'}}. Markers are
+        stored as "<timestamp> <id>" strings so $max, comparing the timestamp
+        first, never moves them back. A read marker also clears the user's
+        unread counter for the room.
+        """
+        operations = []
+        for (room, user), markers in receipts.items():
+            update = {'$max': {f'receipts.{user}.{kind}': f"{marker['timestamp']} {marker['id']}"
+                               for kind, marker in markers.items()}}
+            if 'read' in markers:
+                update['$set'] = {f'unread.{user}': 0}
+            operations.append(UpdateOne({'room': room}, update))
+        if not operations:
+            return 0
+        return self.rooms_collection.bulk_write(operations, ordered=False).modified_count
+
+    def get_receipts(self, room):
+        """{user: {kind: message id}} for a room"""
+        doc = self.rooms_collection.find_one({'room': room}, {'_id': 0, 'receipts': 1}) or {}
+        return {user: {kind: marker.rpartition(' ')[2] for kind, marker in markers.items()}
+                for user, markers in doc.get('receipts', {}).items()}
+
+    def get_unread_counts(self, reader):
+        rooms = self.rooms_collection.find({f'unread.{reader}': {'$gt': 0}}, {'room': 1, f'unread.{reader}': 1})
+        return {room['room']: room['unread'][reader] for room in rooms}
+
+# Record latency, documents and bytes returned for every public method
+instrument_methods(MongoDBClient, 'mongo')
@@ -0,0 +1,85 @@
+import os
+import time
+
+TYPING_INTERVAL = float(os.getenv('TYPING_INTERVAL', '2'))
+
+
+class PresenceRegistry:
+    """Who is connected to which room, counting every open tab of a user"""
+
+    def __init__(self):
+        self._rooms = {}      # room -> {user: set(sid)}
+        self._sessions = {}   # sid -> (user, set(room))
+
+    def join(self, room, user, sid):
+        """Register sid in room; return True if this is the user's first tab there"""
+        users = self._rooms.setdefault(room, {})
+        sids = users.get(user)
+        came_online = not sids
+        if came_online:
+            sids = users[user] = set()
+        sids.add(sid)
+        self._sessions.setdefault(sid, (user, set()))[1].add(room)
+        return came_online
+
+    def leave(self, room, user, sid):
+        """Remove sid from room; return True if it was the user's last tab there"""
+        users = self._rooms.get(room)
+        if not users or user not in users:
+            return False
+        sids = users[user]
+        sids.discard(sid)
+        session = self._sessions.get(sid)
+        if session:
+            session[1].discard(room)
+        if sids:
+            return False
+        del users[user]
+        if not users:
+            del self._rooms[room]
+        return True
+
+    def leave_all(self, sid):
+        """Remove sid everywhere; return the rooms where its user went offline"""
+        session = self._sessions.pop(sid, None)
+        if session is None:
+            return []
+        user, rooms = session
+        return [room for room in list(rooms) if self.leave(room, user, sid)]
+
+    def user_for(self, sid):
+        session = self._sessions.get(sid)
+        return session[0] if session else None
+
+    def online_count(self, room):
+        return len(self._rooms.get(room, ()))
+
+    def online_users(self, room):
+        return sorted(self._rooms.get(room, ()))
+
+    def is_online(self, room, user):
+        return user in self._rooms.get(room, ())
+
+
+class TypingThrottle:
+    """Coalesce typing events into at most one broadcast per interval per user and room"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = {}
+
+    def should_broadcast(self, room, user):
+        now = time.monotonic()
+        last = self._last.get((room, user))
+        if last is not None and now - last < self.interval:
+            return False
+        self._last[(room, user)] = now
+        return True
+
+    def clear(self, room, user):
+        """Forget the user's last broadcast, e.g. once the message was sent"""
+        self._last.pop((room, user), None)
+
+
+presence = PresenceRegistry()
+typing_throttle = TypingThrottle(TYPING_INTERVAL)
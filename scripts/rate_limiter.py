@@ -0,0 +1,81 @@
+import os
+import time
+from scripts.metrics import Counter
+
+# Sustained messages per second and burst size; a rate of 0 disables that scope
+SESSION_RATE = float(os.getenv('SEND_RATE_PER_SESSION', '2'))
+SESSION_BURST = float(os.getenv('SEND_BURST_PER_SESSION', '8'))
+ROOM_RATE = float(os.getenv('SEND_RATE_PER_ROOM', '5'))
+ROOM_BURST = float(os.getenv('SEND_BURST_PER_ROOM', '20'))
+
+rate_limited_total = Counter(
+    'socketio_rate_limited_total', 'Events rejected by the token-bucket limiter', ['scope'])
+
+
+class TokenBucket:
+    """Token bucket refilled lazily on each check"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def consume(self, now, amount=1.0):
+        """Take amount tokens; return 0 on success or the seconds until enough are available"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def refund(self, amount=1.0):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Per-session and per-room token buckets held in memory, O(1) per event"""
+
+    def __init__(self, session_rate, session_burst, room_rate, room_burst):
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self._sessions = {}
+        self._rooms = {}
+
+    def _bucket(self, table, key, rate, burst, now):
+        bucket = table.get(key)
+        if bucket is None:
+            bucket = table[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def check(self, sid, room):
+        """Return (allowed, retry_after_seconds, scope)"""
+        now = time.monotonic()
+        session_bucket = None
+        if self.session_rate > 0:
+            session_bucket = self._bucket(self._sessions, sid, self.session_rate, self.session_burst, now)
+            retry_after = session_bucket.consume(now)
+            if retry_after:
+                rate_limited_total.labels('session').inc()
+                return False, retry_after, 'session'
+        if self.room_rate > 0:
+            room_bucket = self._bucket(self._rooms, room, self.room_rate, self.room_burst, now)
+            retry_after = room_bucket.consume(now)
+            if retry_after:
+                # The sender was not at fault, so give back its session token
+                if session_bucket is not None:
+                    session_bucket.refund()
+                rate_limited_total.labels('room').inc()
+                return False, retry_after, 'room'
+        return True, 0.0, None
+
+    def forget(self, sid):
+        """Drop a disconnected session's bucket"""
+        self._sessions.pop(sid, None)
+
+
+send_limiter = RateLimiter(SESSION_RATE, SESSION_BURST, ROOM_RATE, ROOM_BURST)
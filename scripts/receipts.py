@@ -0,0 +1,115 @@
+"""Read and delivered receipts as cumulative "up to" markers per user and room.
+
+Clients report the newest message they have received or read. The marker's
+position is the stored timestamp of that message, never one sent by the
+client, so a receipt cannot jump ahead of the room's history. Markers are
+merged in memory and flushed every RECEIPT_FLUSH_INTERVAL seconds as one bulk
+write, so each user costs at most one write per room per interval. Each
+room then gets a single compact 'receipts' broadcast with the markers that moved.
+"""
+import os
+import threading
+from scripts.mongo_client import MongoDBClient
+from scripts.metrics import Counter
+from scripts.tracing import log_error
+
+RECEIPT_FLUSH_INTERVAL = float(os.getenv('RECEIPT_FLUSH_INTERVAL', '2'))
+RECEIPT_KINDS = ('delivered', 'read')
+
+receipt_updates_total = Counter(
+    'receipt_updates_total', 'Receipt markers reported by clients, by whether they moved forward', ['kind', 'result'])
+receipt_writes_total = Counter('receipt_writes_total', 'Room/user receipt states written to MongoDB')
+
+mongo_client = MongoDBClient()
+
+
+def valid_marker(message_id):
+    return isinstance(message_id, str) and 0 < len(message_id) <= 64
+
+
+class ReceiptBuffer:
+    """Pending receipt markers, coalesced per (room, user) until the next flush"""
+
+    def __init__(self):
+        self._pending = {}   # (room, user) -> {kind: marker}
+        self._flushed = {}   # (room, user) -> {kind: timestamp} already written
+        self._lock = threading.Lock()
+
+    def update(self, room, user, kind, marker):
+        """Merge a marker; returns False if it does not move the user's position forward"""
+        # Having read a message implies having received it
+        kinds = RECEIPT_KINDS if kind == 'read' else (kind,)
+        moved = False
+        with self._lock:
+            pending = self._pending.get((room, user), {})
+            flushed = self._flushed.get((room, user), {})
+            for k in kinds:
+                current = pending.get(k, {}).get('timestamp') or flushed.get(k, '')
+                if marker['timestamp'] > current:
+                    pending[k] = marker
+                    moved = True
+            if moved:
+                self._pending[(room, user)] = pending
+        receipt_updates_total.labels(kind, 'moved' if moved else 'stale').inc()
+        return moved
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        """Put back markers whose write failed; newer markers reported meanwhile win"""
+        for (room, user), markers in pending.items():
+            for kind, marker in markers.items():
+                self.update(room, user, kind, marker)
+
+    def mark_flushed(self, pending):
+        with self._lock:
+            for key, markers in pending.items():
+                flushed = self._flushed.setdefault(key, {})
+                for kind, marker in markers.items():
+                    flushed[kind] = max(flushed.get(kind, ''), marker['timestamp'])
+
+    def forget(self, room, user):
+        """Drop the flushed positions of a user who left, so the table stays bounded"""
+        with self._lock:
+            self._flushed.pop((room, user), None)
+
+
+receipts = ReceiptBuffer()
+
+
+def get_receipts(room):
+    """Stored markers of a room, for clients loading it"""
+    return mongo_client.get_receipts(room)
+
+
+def flush(socketio):
+    """Write pending markers and broadcast them, one event per room"""
+    pending = receipts.drain()
+    if not pending:
+        return
+    try:
+        mongo_client.save_receipts(pending)
+    except Exception as e:
+        log_error("Receipt flush failed, retrying next interval", e)
+        receipts.restore(pending)
+        return
+    receipts.mark_flushed(pending)
+    receipt_writes_total.inc(amount=len(pending))
+    by_room = {}
+    for (room, user), markers in pending.items():
+        by_room.setdefault(room, {})[user] = {kind: marker['id'] for kind, marker in markers.items()}
+    for room, users in by_room.items():
+        socketio.emit('receipts', {'room': room, 'receipts': users}, room=room)
+
+
+def run_forever(socketio):
+    """Background flush loop"""
+    while True:
+        socketio.sleep(RECEIPT_FLUSH_INTERVAL)
+        try:
+            flush(socketio)
+        except Exception as e:
+            log_error("Receipt flush error", e)
@@ -0,0 +1,142 @@
+"""Stream a room's history out as gzip-compressed NDJSON and bulk-load it back.
+
+Usage:
+    python -m scripts.room_transfer export <room> <file.ndjson.gz>
+    python -m scripts.room_transfer import <room> <file.ndjson.gz> [--import-id ID]
+
+Exports read archived segments first and then the hot collection through
+cursor batches, one JSON message per line, so memory stays flat however
+large the room is. Imports insert ordered batches and store a checkpoint
+(lines consumed) after each one; re-running with the same import id skips
+what was already loaded. A line that is not a JSON object stops the
+import; batches before it stay loaded and checkpointed.
+"""
+import gzip
+import json
+import os
+import sys
+import zlib
+from scripts.mongo_client import MongoDBClient
+from scripts.message_handler import _ME, belongs_to_inbox, room_summary
+from scripts.archiver import read_segment
+from scripts.search_index import index_terms
+
+BATCH_SIZE = int(os.getenv('TRANSFER_BATCH_SIZE', '1000'))
+GZIP_LEVEL = 6
+
+mongo_client = MongoDBClient()
+
+
+class InvalidImportLine(ValueError):
+    """A line of an import file that is not a JSON object"""
+
+    def __init__(self, line, reason):
+        super().__init__(f"line {line}: {reason}")
+        self.line = line
+
+
+def iter_room_messages(room):
+    """Every message of a room, oldest first: cold segments, then the hot collection"""
+    segments = mongo_client.find_archive_segments({'room': room}, sort=[('first_timestamp', 1)])
+    for segment in segments:
+        yield from read_segment(segment)
+    for message in mongo_client.iter_messages({'room': room}, sort=[('timestamp', 1)], batch_size=BATCH_SIZE):
+        yield message
+
+
+def export_room(room):
+    """Yield gzip-compressed NDJSON chunks of a room's history"""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for message in iter_room_messages(room):
+        message.pop('_id', None)
+        line = json.dumps(message, ensure_ascii=False, separators=(',', ':')) + '\n'
+        chunk = compressor.compress(line.encode('utf-8'))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def _prepare(message, room):
+    message.pop('_id', None)
+    # Idempotency keys are unique per sender and only matter for live retries
+    message.pop('client_id', None)
+    message['room'] = room
+    if belongs_to_inbox(message, room):
+        message['inbox'] = True
+    else:
+        message.pop('inbox', None)
+    message['terms'] = index_terms(message.get('message'))
+    return message
+
+
+def _insert_batch(batch, resumed):
+    if resumed:
+        # The batch after a checkpoint may already be stored if we died before saving the checkpoint
+        present = {m['id'] for m in mongo_client.find_messages(
+            {'room': batch[0]['room'], 'id': {'$in': [m.get('id') for m in batch]}}, projection={'id': 1})}
+        batch = [m for m in batch if m.get('id') not in present]
+    return mongo_client.insert_messages(batch) if batch else 0
+
+
+def refresh_room_summary(room):
+    """Point the room document at the newest stored message and recount it"""
+    mongo_client.ensure_room(room)
+    newest = mongo_client.find_messages({'room': room}, sort=[('timestamp', -1)], limit=1)
+    update = {'message_count': mongo_client.messages_collection.count_documents({'room': room})}
+    if newest:
+        update.update(room_summary(newest[0]))
+    mongo_client.rooms_collection.update_one({'room': room}, {'$set': update})
+
+
+def import_room(room, fileobj, import_id):
+    """Load gzip NDJSON from fileobj into room; returns (inserted, lines_read)"""
+    checkpoint = mongo_client.get_import_checkpoint(import_id)
+    skip = checkpoint['lines_done'] if checkpoint else 0
+    resumed = skip > 0
+    lines = inserted = 0
+    batch = []
+    with gzip.GzipFile(fileobj=fileobj, mode='rb') as stream:
+        for raw in stream:
+            lines += 1
+            if lines <= skip or not raw.strip():
+                continue
+            try:
+                message = json.loads(raw)
+            except ValueError:
+                raise InvalidImportLine(lines, "not valid JSON") from None
+            if not isinstance(message, dict):
+                raise InvalidImportLine(lines, "not a JSON object")
+            batch.append(_prepare(message, room))
+            if len(batch) >= BATCH_SIZE:
+                inserted += _insert_batch(batch, resumed)
+                mongo_client.save_import_checkpoint(import_id, room, lines)
+                resumed = False
+                batch = []
+    if batch:
+        inserted += _insert_batch(batch, resumed)
+    mongo_client.delete_import_checkpoint(import_id)
+    refresh_room_summary(room)
+    # Imported messages land among older history, which browsers may hold cached
+    mongo_client.bump_history_version([room, _ME])
+    return inserted, lines
+
+
+def main(argv):
+    if len(argv) < 3 or argv[0] not in ('export', 'import'):
+        print(__doc__)
+        return
+    command, room, path = argv[:3]
+    if command == 'export':
+        with open(path, 'wb') as f:
+            for chunk in export_room(room):
+                f.write(chunk)
+        print(f"Exported room {room} to {path}")
+        return
+    import_id = argv[argv.index('--import-id') + 1] if '--import-id' in argv else f"{room}:{os.path.abspath(path)}"
+    with open(path, 'rb') as f:
+        inserted, lines = import_room(room, f, import_id)
+    print(f"Imported {inserted} messages ({lines} lines) into room {room}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,87 @@
+import re
+import unicodedata
+
+# Markdown images ("![alt](url) caption") are indexed by alt text and caption only
+_IMAGE_MARKDOWN = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+MAX_QUERY_TERMS = 8
+SNIPPET_RADIUS = 40
+
+
+def fold(text):
+    """Lowercase and strip Vietnamese diacritics: 'Đường phố' -> 'duong pho'"""
+    text = text.lower().replace('đ', 'd')
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(c for c in decomposed if unicodedata.category(c) != 'Mn')
+
+
+def _normalized(text):
+    # Compose first: the combining marks of NFD input (macOS/iOS) are not \w and would split words
+    return unicodedata.normalize('NFC', text or '')
+
+
+def _searchable_text(text):
+    return _IMAGE_MARKDOWN.sub(r' \1 ', _normalized(text))
+
+
+def tokenize(text):
+    """Yield (start, end, exact_token, folded_token) for each word in NFC-normalized text"""
+    for match in _TOKEN.finditer(text):
+        token = match.group().lower()
+        yield match.start(), match.end(), token, fold(token)
+
+
+def index_terms(text):
+    """Sorted, de-duplicated folded terms stored on a message for the multikey index"""
+    return sorted({folded for _, _, _, folded in tokenize(_searchable_text(text))})
+
+
+def query_terms(query):
+    """(exact, folded) pairs for a search query, in order, capped to MAX_QUERY_TERMS"""
+    seen = set()
+    terms = []
+    for _, _, exact, folded in tokenize(_normalized(query)):
+        if folded not in seen:
+            seen.add(folded)
+            terms.append((exact, folded))
+    return terms[:MAX_QUERY_TERMS]
+
+
+def score_message(text, terms):
+    """Rank a candidate: exact-diacritic hits count double, adjacent query terms add a phrase bonus.
+
+    Returns (score, first_hit_start, hit_spans).
+    """
+    text = _searchable_text(text)
+    wanted = {folded: exact for exact, folded in terms}
+    score = 0
+    spans = []
+    previous_index = None
+    phrase_bonus = 0
+    order = [folded for _, folded in terms]
+    for start, end, exact, folded in tokenize(text):
+        if folded not in wanted:
+            previous_index = None
+            continue
+        score += 2 if exact == wanted[folded] else 1
+        spans.append((start, end))
+        index = order.index(folded)
+        if previous_index is not None and index == previous_index + 1:
+            phrase_bonus += 3
+        previous_index = index
+    return score + phrase_bonus, (spans[0][0] if spans else 0), spans
+
+
+def snippet(text, hit_start, spans):
+    """Text surrounding the first hit, with highlight offsets relative to the snippet"""
+    text = _searchable_text(text)
+    begin = max(0, hit_start - SNIPPET_RADIUS)
+    end = min(len(text), hit_start + SNIPPET_RADIUS * 2)
+    prefix = '…' if begin > 0 else ''
+    suffix = '…' if end < len(text) else ''
+    highlights = [
+        [s - begin + len(prefix), e - begin + len(prefix)]
+        for s, e in spans if s >= begin and e <= end
+    ]
+    return prefix + text[begin:end] + suffix, highlights
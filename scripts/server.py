@@ -0,0 +1,227 @@
+"""Production launcher: supervised eventlet workers with graceful draining.
+
+Usage: python -m scripts.server [--workers N] [--host 0.0.0.0] [--port 13882]
+
+The supervisor binds the listening socket once and forks WEB_CONCURRENCY
+eventlet workers that share it. A worker that dies is restarted after an
+exponential, jittered backoff (reset once a worker stays up for a while).
+
+SIGTERM/SIGINT drain every worker and exit; SIGHUP replaces the workers
+one generation at a time (new ones start accepting before old ones drain).
+A draining worker stops accepting, tells its clients to reconnect after a
+random delay, waits for in-flight handlers and connections to finish, and
+disconnects whatever is left after GRACEFUL_TIMEOUT.
+
+More than one worker needs SOCKETIO_MESSAGE_QUEUE so emits reach clients on
+other workers; clients are then told to use the websocket transport only,
+since long-polling requests are not sticky to a worker. Presence, typing
+and rate-limit state stay per worker.
+"""
+import argparse
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+WORKERS = int(os.getenv('WEB_CONCURRENCY', '1'))
+BACKLOG = int(os.getenv('LISTEN_BACKLOG', '1024'))
+GRACEFUL_TIMEOUT = float(os.getenv('GRACEFUL_TIMEOUT', '30'))
+RECONNECT_JITTER_MS = int(os.getenv('RECONNECT_JITTER_MS', '5000'))
+RESTART_BACKOFF_BASE = float(os.getenv('RESTART_BACKOFF_BASE', '0.5'))
+RESTART_BACKOFF_MAX = float(os.getenv('RESTART_BACKOFF_MAX', '30'))
+# A worker that stayed up this long is considered healthy again
+RESTART_BACKOFF_RESET = float(os.getenv('RESTART_BACKOFF_RESET', '60'))
+
+
+def backoff_delay(failures):
+    """Seconds to wait before restart number `failures`: exponential with equal jitter"""
+    ceiling = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** max(failures - 1, 0))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class _Drainer:
+    """Graceful shutdown of one worker"""
+
+    def __init__(self, socketio, listener):
+        self.socketio = socketio
+        self.listener = listener
+        self.started = False
+
+    def start(self, *_):
+        if not self.started:
+            self.started = True
+            import eventlet
+            eventlet.spawn_n(self._drain)
+
+    def _busy(self):
+        from scripts.metrics import events_in_flight
+        return len(self.socketio.server.eio.sockets) + events_in_flight()
+
+    def _drain(self):
+        print(f"Worker {os.getpid()} draining")
+        # Closing our copy of the shared socket stops accepting; the other workers keep serving
+        self.listener.close()
+        # Only this worker's clients: through the message queue it would reach every worker
+        self.socketio.emit('server_draining', {'reconnect_jitter_ms': RECONNECT_JITTER_MS}, ignore_queue=True)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self._busy() and time.monotonic() < deadline:
+            self.socketio.sleep(0.2)
+        if self.socketio.server.eio.sockets:
+            print(f"Worker {os.getpid()} disconnecting {len(self.socketio.server.eio.sockets)} remaining clients")
+            self.socketio.server.eio.disconnect()
+
+
+def run_worker(sock, worker_id):
+    """Worker process body: monkey-patch, import the app and serve until drained"""
+    import eventlet
+    eventlet.monkey_patch()
+    from eventlet import wsgi, greenio
+
+    os.environ['WORKER_ID'] = str(worker_id)
+    import main
+    main.start_background_tasks(primary=worker_id == 0)
+
+    listener = greenio.GreenSocket(sock)
+    drainer = _Drainer(main.socketio, listener)
+    signal.signal(signal.SIGTERM, drainer.start)
+    signal.signal(signal.SIGINT, drainer.start)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    print(f"Worker {worker_id} (pid {os.getpid()}) serving")
+    try:
+        wsgi.server(listener, main.app, log_output=False)
+    except OSError:
+        # accept() fails once the drainer closes the listener; in-flight requests were awaited
+        if not drainer.started:
+            raise
+    finally:
+        # The worker leaves through os._exit, so queued spans are written out here
+        from scripts import tracing
+        tracing.flush()
+    return 0
+
+
+class Supervisor:
+    """Fork, watch and restart workers"""
+
+    def __init__(self, sock, workers):
+        self.sock = sock
+        self.slots = [{'pid': None, 'started': 0.0, 'failures': 0, 'restart_at': 0.0} for _ in range(workers)]
+        self.retiring = set()
+        self.stopping = False
+        self.stop_deadline = None
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # Drop the supervisor's handlers until the worker installs its own
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+                    signal.signal(sig, signal.SIG_DFL)
+                code = run_worker(self.sock, index)
+            except Exception as e:
+                print(f"Worker {index} crashed: {e}")
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        slot = self.slots[index]
+        slot['pid'] = pid
+        slot['started'] = time.monotonic()
+
+    def stop(self, *_):
+        if not self.stopping:
+            print("Shutting down, draining workers...")
+            self.stopping = True
+            self.stop_deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+            self._signal_all(signal.SIGTERM)
+
+    def reload(self, *_):
+        """Start a fresh generation of workers, then drain the old one"""
+        print("Reloading workers")
+        old = [slot['pid'] for slot in self.slots if slot['pid']]
+        for index in range(len(self.slots)):
+            self.spawn(index)
+        for pid in old:
+            self.retiring.add(pid)
+            self._kill(pid, signal.SIGTERM)
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _signal_all(self, sig):
+        for pid in [slot['pid'] for slot in self.slots if slot['pid']] + list(self.retiring):
+            self._kill(pid, sig)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            for index, slot in enumerate(self.slots):
+                if slot['pid'] != pid:
+                    continue
+                slot['pid'] = None
+                if self.stopping:
+                    break
+                now = time.monotonic()
+                if now - slot['started'] > RESTART_BACKOFF_RESET:
+                    slot['failures'] = 0
+                slot['failures'] += 1
+                delay = backoff_delay(slot['failures'])
+                slot['restart_at'] = now + delay
+                print(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, "
+                      f"restarting in {delay:.1f}s")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for index in range(len(self.slots)):
+            self.spawn(index)
+        while True:
+            self._reap()
+            now = time.monotonic()
+            alive = [slot for slot in self.slots if slot['pid']]
+            if self.stopping:
+                if not alive and not self.retiring:
+                    return
+                if now > self.stop_deadline:
+                    print("Workers did not drain in time, killing them")
+                    self._signal_all(signal.SIGKILL)
+            else:
+                for index, slot in enumerate(self.slots):
+                    if slot['pid'] is None and now >= slot['restart_at']:
+                        self.spawn(index)
+            time.sleep(0.2)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '13882')))
+    args = parser.parse_args(argv)
+    if args.workers > 1 and not os.getenv('SOCKETIO_MESSAGE_QUEUE'):
+        print("Running more than one worker needs SOCKETIO_MESSAGE_QUEUE (e.g. redis://...)")
+        return 1
+    # Workers read this to pick the client transport (see main.socket_config)
+    os.environ['WEB_CONCURRENCY'] = str(args.workers)
+    sock = socket.create_server((args.host, args.port), backlog=BACKLOG)
+    print(f"Listening on {args.host}:{args.port} with {args.workers} worker(s)")
+    Supervisor(sock, args.workers).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
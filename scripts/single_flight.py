@@ -0,0 +1,68 @@
+import os
+import threading
+from scripts.metrics import Counter, Histogram
+
+SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', '1') != '0'
+
+singleflight_calls_total = Counter(
+    'singleflight_calls_total', 'Coalesced reads by role: leader hit the database, follower shared its result',
+    ['name', 'role'])
+singleflight_group_size = Histogram(
+    'singleflight_group_size', 'Callers served by one database read', ['name'],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesce identical in-flight calls: the first caller runs fn, concurrent callers share its result.
+
+    Shared results must be treated as read-only by every caller.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._leaders = singleflight_calls_total.labels(name, 'leader')
+        self._followers = singleflight_calls_total.labels(name, 'follower')
+        self._group_size = singleflight_group_size.labels(name)
+
+    def do(self, key, fn):
+        if not SINGLE_FLIGHT_ENABLED:
+            return fn()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            self._followers.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        self._leaders.inc()
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            # Later callers start a fresh read; only those already waiting share this one
+            with self._lock:
+                del self._calls[key]
+            self._group_size.observe(call.waiters + 1)
+            call.done.set()
@@ -1,36 +1,95 @@
+import os
 import secrets
-from datetime import datetime, timezone
-from flask import session
+from flask import session, request
 from flask_socketio import emit, join_room, leave_room
+from pymongo.errors import DuplicateKeyError
 from scripts.auth import require_login, is_logged_in
 from scripts.message_handler import (cache_message, get_recent_messages, get_messages_before, 
-                           get_room, sanitize_for_json)
+                           get_room, sanitize_for_json, present_message, mark_room_read,
+                           get_unread_counts, get_all_rooms, find_sent_message,
+                           edit_message, delete_message, message_change, get_changes_since, sync_time,
+                           find_room_message, get_history_version)
+from scripts.rate_limiter import send_limiter
+from scripts.idempotency import send_acks, valid_client_id, duplicate_sends_total
+from scripts.presence import presence, typing_throttle
+from scripts.receipts import receipts, valid_marker, get_receipts, RECEIPT_KINDS
+from scripts.server import RECONNECT_JITTER_MS
+from scripts.tracing import log_error
 
 _ME = "dtanh"
+# Window over which reconnecting clients spread their history catch-up
+SYNC_JITTER_MS = int(os.getenv('RECONNECT_SYNC_JITTER_MS', '1500'))
 
-def handle_connect(request, socketio):
+def _current_room():
+    """Room the client is viewing; admin sockets switch views per connection without a reload"""
+    user_id = session.get('user_id')
+    if user_id == _ME and session.get('view_room'):
+        return session['view_room']
+    return get_room(user_id)
+
+def _presence_payload(room, user, online):
+    return {'room': room, 'user': user, 'online': online, 'count': presence.online_count(room)}
+
+def _join(room, user, socketio):
+    """Join a Socket.IO room and announce the user if this is their first tab there"""
+    join_room(room)
+    if presence.join(room, user, request.sid):
+        socketio.emit('presence', _presence_payload(room, user, True), room=room)
+
+def handle_connect(request, socketio, auth=None):
     """Handle client connection"""
     try:
         user_id = session.get('user_id')
         room_id = get_room(user_id)
-        join_room(room_id)
+        status_data = {'room': room_id}
+        if user_id == _ME:
+            # Admin sockets subscribe to every room and keep their view in the socket session
+            if isinstance(auth, dict) and auth.get('room'):
+                room_id = str(auth['room'])
+            session['view_room'] = room_id
+            rooms = get_all_rooms()
+            for room in rooms:
+                _join(room, user_id, socketio)
+            status_data = {
+                'room': room_id,
+                'inbox': _ME,
+                'rooms': rooms,
+                'unread': get_unread_counts(_ME)
+            }
+        _join(room_id, user_id, socketio)
+        status_data['online'] = presence.online_users(room_id)
+        # Clients spread their catch-up reads and future reconnects over these windows
+        status_data['reconnect'] = {'jitter_ms': RECONNECT_JITTER_MS, 'sync_jitter_ms': SYNC_JITTER_MS}
         emit('status', {
             'type': 'connected',
             'message': 'Connected',
-            'data': {'room': room_id}
+            'data': status_data
         })
     except Exception as e:
         emit('error', {'message': 'Failed to join room'})
 
-def handle_disconnect(request):
+def handle_disconnect(request, socketio):
     """Handle client disconnection"""
     try:
-        user_id = session.get('user_id')
-        room_id = get_room(user_id)
+        send_limiter.forget(request.sid)
+        user_id = presence.user_for(request.sid)
+        for room in presence.leave_all(request.sid):
+            typing_throttle.clear(room, user_id)
+            receipts.forget(room, user_id)
+            socketio.emit('presence', _presence_payload(room, user_id, False), room=room)
+        room_id = _current_room()
         leave_room(room_id)
     except Exception as e:
         emit('error', {'message': 'Failed to leave room'})
 
+def _send_ack(message_data, client_id):
+    return {
+        'success': True,
+        'message_id': message_data['id'],
+        'client_id': client_id,
+        'timestamp': message_data.get('timestamp')
+    }
+
 def handle_send_message(data, socketio):
     """Handle real-time message sending via Socket.IO"""
     try:
@@ -46,8 +105,29 @@ def handle_send_message(data, socketio):
             emit('error', {'message': 'Message cannot be empty'})
             return
         
+        # A retry of a send we already stored gets the original ack and nothing else
         username = session.get('user_id')
-        timestamp = datetime.now(timezone.utc).isoformat()
+        client_id = data.get('client_id')
+        if client_id is not None and not valid_client_id(client_id):
+            emit('error', {'message': 'Invalid client_id'})
+            return
+        if client_id:
+            ack = send_acks.get(username, client_id)
+            if ack is not None:
+                duplicate_sends_total.labels('window').inc()
+                emit('message_sent', dict(ack, duplicate=True))
+                return
+        
+        # Enforce the send rate before any database work
+        room = _current_room()
+        allowed, retry_after, scope = send_limiter.check(request.sid, room)
+        if not allowed:
+            emit('rate_limited', {
+                'event': 'send_message',
+                'scope': scope,
+                'retry_after': round(retry_after, 3)
+            })
+            return
         
         # Create message object
         message_data = {
@@ -55,31 +135,39 @@ def handle_send_message(data, socketio):
             "username": username,
             "message": message_text
         }
+        if client_id:
+            message_data['client_id'] = client_id
         
-        # Cache message
-        room = get_room(session.get('user_id'))
-        cache_message(message_data, room)
+        # Cache message; the unique (username, client_id) index catches retries outside the window
+        try:
+            cache_message(message_data, room)
+        except DuplicateKeyError:
+            original = find_sent_message(username, client_id)
+            if original is None:
+                raise
+            ack = _send_ack(original, client_id)
+            send_acks.put(username, client_id, ack)
+            duplicate_sends_total.labels('index').inc()
+            emit('message_sent', dict(ack, duplicate=True))
+            return
+        typing_throttle.clear(room, username)
         
-        # Broadcast message to all clients in the room
-        socketio.emit('new_message', sanitize_for_json(message_data), room=room)
+        # Broadcast message to all clients in the room; 'view' tells multi-room
+        # admin sockets which conversation the payload is formatted for
+        socketio.emit('new_message', sanitize_for_json(dict(message_data, view=room)), room=room)
         
+        # The admin inbox reads the same document, so only the live update is sent there
         if username != _ME:
-            message_data_me = {
-                "id": secrets.token_hex(8),
-                "username": username,
-                "message": f"<{username}>: {message_text}"
-            }
-            cache_message(message_data_me, _ME)
-            socketio.emit('new_message', sanitize_for_json(message_data_me), room=_ME)
+            inbox_message = dict(present_message(message_data, _ME), view=_ME)
+            socketio.emit('new_message', sanitize_for_json(inbox_message), room=_ME)
         
         # Send confirmation to sender
-        emit('message_sent', {
-            'success': True,
-            'message_id': message_data['id'],
-            'timestamp': timestamp
-        })
+        ack = _send_ack(message_data, client_id)
+        if client_id:
+            send_acks.put(username, client_id, ack)
+        emit('message_sent', ack)
     except Exception as e:
-        print(f"Socket.IO message error: {e}")
+        log_error("Socket.IO message error", e)
         emit('error', {'message': 'Failed to send message'})
 
 def handle_get_older_messages(data):
@@ -90,7 +178,7 @@ def handle_get_older_messages(data):
             emit('error', {'message': 'before_message_id required'})
             return
         
-        room = get_room(session.get('user_id'))
+        room = _current_room()
         older_messages = get_messages_before(room, before_message_id, 50)
         
         emit('older_messages', {
@@ -99,21 +187,27 @@ def handle_get_older_messages(data):
         })
     
     except Exception as e:
-        print(f"Socket.IO load older messages error: {e}")
+        log_error("Socket.IO load older messages error", e)
         emit('error', {'message': 'Failed to load older messages'})
 
 def handle_get_recent_messages():
     """Get recent messages"""
     try:
-        room = get_room(session.get('user_id'))
+        room = _current_room()
+        # Read before the messages so changes made meanwhile show up in the next sync
+        server_time = sync_time()
+        history_version = get_history_version(room)
         recent_messages = get_recent_messages(room, 30)
         emit('recent_messages', {
             'messages': sanitize_for_json(recent_messages),
-            'count': 30 if len(recent_messages) > 30 else len(recent_messages)
+            'count': 30 if len(recent_messages) > 30 else len(recent_messages),
+            'server_time': server_time,
+            'history_version': history_version,
+            'receipts': get_receipts(room)
         })
     
     except Exception as e:
-        print(f"Error getting recent messages: {e}")
+        log_error("Error getting recent messages", e)
         emit('error', {'message': 'Failed to get recent messages'})
 
 def handle_get_messages_since_reconnect(data):
@@ -124,27 +218,105 @@ def handle_get_messages_since_reconnect(data):
             emit('error', {'message': 'last_message_id required'})
             return
         
-        room = get_room(session.get('user_id'))
+        room = _current_room()
+        server_time = sync_time()
         recent_messages = get_recent_messages(room, 100)
 
         # Find index of the message with the given ID
         index = next((i for i, msg in enumerate(recent_messages) if msg['id'] == last_message_id), None)
         if index is None:
-            emit('error', {'message': 'Message ID not found'})
+            # The client is further behind than one page (e.g. evicted as a slow consumer):
+            # it cannot be caught up incrementally, so have it reload the room
+            emit('messages_since_reconnect', {
+                'messages': [],
+                'count': 0,
+                'changes': [],
+                'changes_complete': False,
+                'server_time': server_time
+            })
             return
 
         # Get messages since that ID
         new_messages = recent_messages[index + 1:] if index + 1 < len(recent_messages) else []
         
+        # Edits and deletions of messages the client already shows, since its last sync
+        feed = get_changes_since(room, data.get('since')) if data.get('since') else None
+        changes, complete = feed if feed is not None else ([], False)
+        
         emit('messages_since_reconnect', {
             'messages': sanitize_for_json(new_messages),
-            'count': len(new_messages)
+            'count': len(new_messages),
+            'changes': sanitize_for_json(changes),
+            # False: too many changes, no usable 'since' or a gap; the client should reload the room
+            'changes_complete': complete,
+            'server_time': server_time
         })
     
     except Exception as e:
-        print(f"Socket.IO get messages since reconnect error: {e}")
+        log_error("Socket.IO get messages since reconnect error", e)
         emit('error', {'message': 'Failed to get messages since reconnect'})
         
+def _broadcast_change(message, socketio):
+    """Tell the room, and the admin inbox if it shows the message, about an edit or delete"""
+    room = message['room']
+    socketio.emit('message_changed', sanitize_for_json(dict(message_change(message), view=room)), room=room)
+    if message.get('inbox') and room != _ME:
+        inbox_change = dict(message_change(present_message(message, _ME)), view=_ME)
+        socketio.emit('message_changed', sanitize_for_json(inbox_change), room=_ME)
+
+def _check_change_request(data):
+    """Validate the common edit/delete fields; returns the message id or None after emitting an error"""
+    if not data or not data.get('message_id'):
+        emit('error', {'message': 'message_id required'})
+        return None
+    version = data.get('version')
+    if version is not None and (not isinstance(version, int) or isinstance(version, bool)):
+        emit('error', {'message': 'Invalid version'})
+        return None
+    allowed, retry_after, scope = send_limiter.check(request.sid, _current_room())
+    if not allowed:
+        emit('rate_limited', {'event': 'change_message', 'scope': scope, 'retry_after': round(retry_after, 3)})
+        return None
+    return data['message_id']
+
+def handle_edit_message(data, socketio):
+    """Edit one of the sender's messages and broadcast the new version"""
+    try:
+        message_text = str((data or {}).get('message', '')).strip()
+        if not message_text:
+            emit('error', {'message': 'Message cannot be empty'})
+            return
+        if len(message_text) > 1000:
+            emit('error', {'message': 'Message too long (>1000 characters) this will not be sent'})
+            return
+        message_id = _check_change_request(data)
+        if message_id is None:
+            return
+        message, error = edit_message(_current_room(), message_id, session.get('user_id'),
+                                      message_text, data.get('version'))
+        if error:
+            emit('error', {'message': error})
+            return
+        _broadcast_change(message, socketio)
+    except Exception as e:
+        log_error("Socket.IO edit message error", e)
+        emit('error', {'message': 'Failed to edit message'})
+
+def handle_delete_message(data, socketio):
+    """Replace a message with a tombstone and broadcast it"""
+    try:
+        message_id = _check_change_request(data)
+        if message_id is None:
+            return
+        message, error = delete_message(_current_room(), message_id, session.get('user_id'), data.get('version'))
+        if error:
+            emit('error', {'message': error})
+            return
+        _broadcast_change(message, socketio)
+    except Exception as e:
+        log_error("Socket.IO delete message error", e)
+        emit('error', {'message': 'Failed to delete message'})
+
 def handle_join_room(data):
     """Handle user joining a new room"""
     try:
@@ -177,9 +349,64 @@ def handle_join_room(data):
         })
         
     except Exception as e:
-        print(f"Socket.IO join room error: {e}")
+        log_error("Socket.IO join room error", e)
         emit('error', {'message': 'Failed to join room'})
 
+def handle_typing(data, socketio):
+    """Relay a typing indicator, coalesced to one broadcast per interval per user"""
+    try:
+        username = session.get('user_id')
+        room = _current_room()
+        if typing_throttle.should_broadcast(room, username):
+            socketio.emit('typing', {'room': room, 'user': username}, room=room, skip_sid=request.sid)
+    except Exception as e:
+        log_error("Socket.IO typing error", e)
+
+def handle_switch_room(data, socketio):
+    """Switch the admin socket's view to another room without a page reload"""
+    try:
+        room = data.get('room') if data else None
+        if not room or not isinstance(room, str):
+            emit('error', {'message': 'Room name required'})
+            return
+        
+        # Rooms created after this socket connected are joined on demand
+        _join(room, _ME, socketio)
+        session['view_room'] = room
+        mark_room_read(room, _ME)
+        
+        emit('room_switched', {'room': room, 'online': presence.online_users(room)})
+    
+    except Exception as e:
+        log_error("Socket.IO switch room error", e)
+        emit('error', {'message': 'Failed to switch room'})
+
+def handle_mark_read(data):
+    """Reset the caller's unread counter for the room they are viewing"""
+    try:
+        mark_room_read(_current_room(), session.get('user_id'))
+    except Exception as e:
+        log_error("Socket.IO mark read error", e)
+
+def handle_receipt(data):
+    """Record a cumulative read/delivered marker; the receipts flusher writes and broadcasts it"""
+    try:
+        data = data or {}
+        kind = data.get('kind')
+        if kind not in RECEIPT_KINDS or not valid_marker(data.get('up_to')):
+            emit('error', {'message': 'Invalid receipt'})
+            return
+        room = _current_room()
+        # Position the marker by the stored message so it cannot be pushed past real history
+        message = find_room_message(room, data['up_to'])
+        if message is None:
+            emit('error', {'message': 'Invalid receipt'})
+            return
+        receipts.update(room, session.get('user_id'), kind,
+                        {'id': message['id'], 'timestamp': message.get('timestamp', '')})
+    except Exception as e:
+        log_error("Socket.IO receipt error", e)
+
 def handle_nickname_changed_notify(data, socketio):
     """Broadcast nickname change notification to all clients in the room"""
     try:
@@ -187,7 +414,7 @@ def handle_nickname_changed_notify(data, socketio):
         their_nickname = data.get('their_nickname', '').strip()
         
         username = session.get('user_id')
-        room = get_room(username)
+        room = _current_room()
         
         # Prepare notification data
         nickname_data = {
@@ -211,5 +438,5 @@ def handle_nickname_changed_notify(data, socketio):
         })
         
     except Exception as e:
-        print(f"Socket.IO broadcast nickname error: {e}")
+        log_error("Socket.IO broadcast nickname error", e)
         emit('error', {'message': 'Failed to broadcast nickname change'})
@@ -0,0 +1,98 @@
+"""Startup-time profile: import and initialization cost per module.
+
+Enabled with STARTUP_PROFILE=1 (main.py installs it before importing
+anything else), or run standalone:
+
+    python -m scripts.startup_profile [module]   # default: main
+
+Each module's import is timed inclusively and exclusively (minus the
+modules it imported); main.py adds named init phases such as route
+registration. The report lists the slowest entries.
+"""
+import importlib
+import sys
+import time
+from contextlib import contextmanager
+
+REPORT_LIMIT = 25
+
+_imports = {}   # module -> [inclusive seconds, self seconds]
+_phases = []    # (name, seconds)
+_stack = []
+_installed = False
+
+
+class _TimedLoader:
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        _stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = _stack.pop()
+            if _stack:
+                _stack[-1] += elapsed
+            _imports[module.__name__] = [elapsed, elapsed - children]
+
+
+class _TimingFinder:
+    """Meta path finder that wraps every other finder's loader with a timer"""
+
+    @classmethod
+    def find_spec(cls, fullname, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is cls or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+def install():
+    global _installed
+    if not _installed:
+        sys.meta_path.insert(0, _TimingFinder)
+        _installed = True
+
+
+@contextmanager
+def phase(name):
+    """Time a named initialization step"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
+
+
+def report(limit=REPORT_LIMIT):
+    lines = [f"Startup profile ({len(_imports)} modules imported)"]
+    lines.append(f"{'self ms':>10}{'total ms':>10}  module")
+    for name, (inclusive, own) in sorted(_imports.items(), key=lambda item: item[1][1], reverse=True)[:limit]:
+        lines.append(f"{own * 1000:>10.1f}{inclusive * 1000:>10.1f}  {name}")
+    if _phases:
+        lines.append(f"{'ms':>10}  init phase")
+        for name, seconds in _phases:
+            lines.append(f"{seconds * 1000:>10.1f}  {name}")
+    print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    install()
+    target = sys.argv[1] if len(sys.argv) > 1 else 'main'
+    with phase(f"import {target}"):
+        importlib.import_module(target)
+    report()
@@ -0,0 +1,315 @@
+"""Lightweight tracing: a root span per Socket.IO event and HTTP request, with child
+spans for MongoDBClient/GridFS calls, emits and selected handler steps.
+
+A root span's children are only recorded when the trace is sampled
+(TRACE_SAMPLE_RATE, or the sampled flag of an incoming W3C traceparent).
+Any client can set that flag, so it is honoured for at most
+TRACE_HEADER_SAMPLE_LIMIT traces per second; beyond that, requests carrying
+it are sampled at TRACE_SAMPLE_RATE like the rest.
+Roots that end in an error are always exported, so the trace id printed by
+log_error() can be looked up. Spans are exported in OTLP JSON form, either
+appended to TRACE_FILE (one span per line) or posted to an OTLP/HTTP
+collector at TRACE_OTLP_ENDPOINT.
+"""
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from scripts.data_dir import data_path
+
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_HEADER_SAMPLE_LIMIT = int(os.getenv('TRACE_HEADER_SAMPLE_LIMIT', '10'))
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'file')  # file | otlp | none
+# Routes, room names and error text: keep it out of the served tree (checked by main.py)
+TRACE_FILE = os.getenv('TRACE_FILE') or data_path('traces.ndjson')
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', str(50 * 1024 * 1024)))
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'web101')
+TRACE_EXPORT_INTERVAL = float(os.getenv('TRACE_EXPORT_INTERVAL', '5'))
+TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', '10000'))
+# Children kept per trace; a runaway loop should not hold a request's spans in memory
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', '256'))
+
+_KINDS = {'internal': 1, 'server': 2, 'client': 3, 'producer': 4}
+
+_local = threading.local()
+_header_samples = {'second': 0, 'count': 0}
+_header_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns',
+                 'attributes', 'error', 'sampled', 'root', 'children', 'dropped', 'previous')
+
+    def __init__(self, name, kind, trace_id, parent_id, sampled, root=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.error = None
+        self.sampled = sampled
+        self.root = root or self
+        self.children = []
+        self.dropped = 0
+        self.previous = None
+
+    def set_error(self, error):
+        self.error = f"{type(error).__name__}: {error}" if isinstance(error, BaseException) else str(error)
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': _KINDS.get(self.kind, 1),
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or self.start_ns),
+            'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def parse_traceparent(header):
+    """(trace_id, parent_span_id, sampled) from a W3C traceparent header, or None"""
+    parts = (header or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[1] == '0' * 32:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1].lower(), parts[2].lower(), bool(flags & 1)
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+def current_trace_id():
+    span = current_span()
+    return span.trace_id if span else None
+
+
+def traceparent():
+    """W3C traceparent for the active span, for responses and outgoing calls"""
+    span = current_span()
+    if span is None:
+        return None
+    return f"00-{span.trace_id}-{span.span_id}-{'01' if span.sampled else '00'}"
+
+
+def _header_sample_allowed():
+    """Take one of this second's TRACE_HEADER_SAMPLE_LIMIT externally requested samples"""
+    second = int(time.monotonic())
+    with _header_lock:
+        if _header_samples['second'] != second:
+            _header_samples['second'] = second
+            _header_samples['count'] = 0
+        if _header_samples['count'] >= TRACE_HEADER_SAMPLE_LIMIT:
+            return False
+        _header_samples['count'] += 1
+        return True
+
+
+def start_root(name, kind='server', parent=None, attributes=None):
+    """Open a root span and make it current; parent is an incoming traceparent header"""
+    context = parse_traceparent(parent) if parent else None
+    if context:
+        trace_id, parent_id, requested = context
+        sampled = (requested and _header_sample_allowed()) or random.random() < TRACE_SAMPLE_RATE
+    else:
+        trace_id, parent_id, sampled = os.urandom(16).hex(), None, random.random() < TRACE_SAMPLE_RATE
+    span = Span(name, kind, trace_id, parent_id, sampled, attributes=attributes)
+    span.previous = current_span()
+    _local.span = span
+    return span
+
+
+def end_root(span, error=None):
+    """Close a root span, restore the previous context and hand the trace to the exporter"""
+    span.end_ns = time.time_ns()
+    if error is not None:
+        span.set_error(error)
+    _local.span = span.previous
+    if span.sampled or span.error:
+        if span.dropped:
+            span.attributes['trace.dropped_spans'] = span.dropped
+        _exporter.submit([span] + span.children)
+
+
+@contextmanager
+def root_span(name, kind='server', parent=None, attributes=None):
+    span = start_root(name, kind, parent, attributes)
+    try:
+        yield span
+    except BaseException as e:
+        end_root(span, e)
+        raise
+    end_root(span)
+
+
+@contextmanager
+def span(name, kind='internal', attributes=None):
+    """Child span of the active trace; a no-op outside sampled traces"""
+    parent = current_span()
+    if parent is None or not parent.sampled:
+        yield None
+        return
+    root = parent.root
+    child = Span(name, kind, parent.trace_id, parent.span_id, True, root, attributes)
+    child.previous = parent
+    _local.span = child
+    try:
+        yield child
+    except BaseException as e:
+        child.set_error(e)
+        raise
+    finally:
+        child.end_ns = time.time_ns()
+        _local.span = parent
+        if len(root.children) < TRACE_MAX_SPANS:
+            root.children.append(child)
+        else:
+            root.dropped += 1
+
+
+def traced(name, kind='internal'):
+    """Decorator recording each call as a child span"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def log_error(message, error):
+    """Print an error with the active trace id and mark the span as failed"""
+    active = current_span()
+    if active is None:
+        print(f"{message}: {error}")
+        return
+    active.set_error(error)
+    # Errors inside a child surface on the root, which is what an unsampled trace keeps
+    if active.root is not active and active.root.error is None:
+        active.root.set_error(error)
+    print(f"{message}: {error} [trace_id={active.trace_id}]")
+
+
+class _Exporter:
+    """Batches finished traces and writes them from a background thread"""
+
+    def __init__(self):
+        self._queue = deque(maxlen=TRACE_QUEUE_SIZE)
+        self._thread = None
+        self.dropped = 0
+
+    def submit(self, spans):
+        if TRACE_EXPORTER == 'none':
+            return
+        if len(self._queue) + len(spans) > TRACE_QUEUE_SIZE:
+            # The exporter is behind; shed whole traces rather than block requests
+            self.dropped += len(spans)
+            return
+        self._queue.extend(spans)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(TRACE_EXPORT_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        spans = []
+        while self._queue:
+            spans.append(self._queue.popleft().to_otlp())
+        if not spans:
+            return
+        try:
+            if TRACE_EXPORTER == 'otlp':
+                self._post(spans)
+            else:
+                self._append(spans)
+        except Exception as e:
+            self.dropped += len(spans)
+            print(f"Trace export error: {e}")
+
+    def _append(self, spans):
+        os.makedirs(os.path.dirname(os.path.abspath(TRACE_FILE)), exist_ok=True)
+        if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+            os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+        lines = [json.dumps(dict(s, service=TRACE_SERVICE_NAME), separators=(',', ':')) for s in spans]
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _post(self, spans):
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': TRACE_SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': 'scripts.tracing'}, 'spans': spans}]
+        }]}
+        request = urllib.request.Request(TRACE_OTLP_ENDPOINT, data=json.dumps(body).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+
+_exporter = _Exporter()
+
+
+def flush():
+    """Export queued spans now, e.g. before a worker exits"""
+    _exporter.flush()
+
+
+def init_app(app):
+    """Open a root span per HTTP request and return its traceparent to the caller"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_trace():
+        rule = request.url_rule.rule if request.url_rule else 'unmatched'
+        g._trace = start_root(f"HTTP {request.method} {rule}", 'server', request.headers.get('traceparent'),
+                              {'http.method': request.method, 'http.route': rule})
+
+    @app.after_request
+    def _trace_response(response):
+        trace = g.get('_trace')
+        if trace is not None:
+            trace.attributes['http.status_code'] = response.status_code
+            if response.status_code >= 500 and trace.error is None:
+                trace.set_error(f"HTTP {response.status_code}")
+            response.headers['traceparent'] = f"00-{trace.trace_id}-{trace.span_id}-{'01' if trace.sampled else '00'}"
+        return response
+
+    @app.teardown_request
+    def _end_trace(error=None):
+        trace = g.pop('_trace', None)
+        if trace is not None:
+            end_root(trace, error)
@@ -66,4 +66,6 @@ def save_user(username, user_data):
     result = mongo_client.update_user({'username': username}, user_doc)
     if result == 0:  # No document was updated, insert new
         user_doc['created_at'] = datetime.now(timezone.utc).isoformat()
-        mongo_client.insert_user(user_doc)
\ No newline at end of file
+        mongo_client.insert_user(user_doc)
+        # New users show up in the room list before their first message
+        mongo_client.ensure_room(username)
\ No newline at end of file
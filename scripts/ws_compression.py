@@ -0,0 +1,66 @@
+"""permessage-deflate on the websocket transport, for messages above a size threshold.
+
+Engine.IO's http_compression only covers long-polling responses; with more
+than one worker clients are websocket-only, so history pages would go out
+uncompressed. Eventlet's websocket server negotiates permessage-deflate
+(RFC 7692) but then deflates every frame, including pings, typing
+indicators and acks, where zlib costs CPU and saves nothing. Here frames
+shorter than SOCKETIO_COMPRESSION_THRESHOLD bytes are sent uncompressed,
+which RFC 7692 allows per message, and larger ones (older_messages,
+recent_messages, search results) are deflated with the connection's
+shared window. The same threshold applies to long-polling responses.
+"""
+import os
+from scripts.metrics import Counter
+
+SOCKETIO_COMPRESSION = os.getenv('SOCKETIO_COMPRESSION', '1') != '0'
+SOCKETIO_COMPRESSION_THRESHOLD = int(os.getenv('SOCKETIO_COMPRESSION_THRESHOLD', '1024'))
+
+websocket_frames_deflated_total = Counter(
+    'socketio_websocket_frames_deflated_total', 'Websocket messages sent with permessage-deflate')
+
+
+def _websocket_classes():
+    from eventlet.websocket import RFC6455WebSocket
+    from engineio.async_drivers.eventlet import WebSocketWSGI
+
+    class ThresholdDeflateWebSocket(RFC6455WebSocket):
+        """Skips the negotiated deflate for messages below the threshold"""
+        _deflate_this = True
+
+        def _pack_message(self, message, *args, **kwargs):
+            self._deflate_this = len(message) >= SOCKETIO_COMPRESSION_THRESHOLD
+            return super()._pack_message(message, *args, **kwargs)
+
+        def _get_permessage_deflate_enc(self):
+            if not self._deflate_this:
+                return None
+            compressor = super()._get_permessage_deflate_enc()
+            if compressor is not None:
+                websocket_frames_deflated_total.inc()
+            return compressor
+
+    class DeflateWebSocketWSGI(WebSocketWSGI):
+        """Engine.IO's eventlet websocket app, handing out ThresholdDeflateWebSocket"""
+
+        def _negotiate_permessage_deflate(self, extensions):
+            if not SOCKETIO_COMPRESSION:
+                return None
+            return super()._negotiate_permessage_deflate(extensions)
+
+        def _handle_hybi_request(self, environ):
+            ws = super()._handle_hybi_request(environ)
+            # Built by eventlet itself; the subclass only overrides how frames are packed
+            ws.__class__ = ThresholdDeflateWebSocket
+            return ws
+
+    return ThresholdDeflateWebSocket, DeflateWebSocketWSGI
+
+
+def init_app(socketio):
+    """Install the thresholded websocket under the eventlet server (other async modes are left as they are)"""
+    eio = socketio.server.eio
+    if eio.async_mode != 'eventlet':
+        return False
+    eio._async = dict(eio._async, websocket=_websocket_classes()[1])
+    return True
@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+def _accept_unsorted_bulk_updates(mongomock):
+    """pymongo 4.11+ passes sort=None to every bulk update, which mongomock 4.3 does not take"""
+    builder = mongomock.collection.BulkOperationBuilder
+    add_update = builder.add_update
+    if getattr(add_update, 'drops_sort', False):
+        return
+
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        if sort is not None:
+            raise NotImplementedError('mongomock cannot sort bulk updates')
+        return add_update(self, *args, **kwargs)
+    add_update_without_sort.drops_sort = True
+    builder.add_update = add_update_without_sort
+
+
+@pytest.fixture
+def mongo():
+    """The MongoDBClient singleton backed by an in-memory mongomock client, emptied after each test"""
+    mongomock = pytest.importorskip('mongomock')
+    from scripts.mongo_client import MongoDBClient
+    _accept_unsorted_bulk_updates(mongomock)
+    client = MongoDBClient()
+    if client._client is None:
+        client._client = mongomock.MongoClient()
+    yield client
+    for name in client._client.list_database_names():
+        client._client.drop_database(name)
@@ -0,0 +1,28 @@
+from flask import Flask
+
+from scripts import assets
+
+
+def negotiate(tmp_path, header, variants=('.br', '.gz')):
+    path = tmp_path / 'script.js'
+    path.write_text('x')
+    for suffix in variants:
+        (tmp_path / f'script.js{suffix}').write_bytes(b'x')
+    with Flask(__name__).test_request_context(headers={'Accept-Encoding': header}):
+        return assets._negotiate(str(path))[1]
+
+
+def test_negotiate_prefers_brotli(tmp_path):
+    assert negotiate(tmp_path, 'gzip, deflate, br') == 'br'
+
+
+def test_negotiate_honours_q_values(tmp_path):
+    assert negotiate(tmp_path, 'br;q=0, gzip') == 'gzip'
+    assert negotiate(tmp_path, 'br;q=0.4, gzip;q=0.5') == 'gzip'
+    assert negotiate(tmp_path, 'gzip;q=0, *;q=0') is None
+    assert negotiate(tmp_path, '*') == 'br'
+
+
+def test_negotiate_falls_back_to_available_variant(tmp_path):
+    assert negotiate(tmp_path, 'br, gzip', variants=('.gz',)) == 'gzip'
+    assert negotiate(tmp_path, 'identity') is None
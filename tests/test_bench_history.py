@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+from pymongo import MongoClient
+
+from benchmarks.bench_history import QueryRecorder
+
+
+def test_query_recorder_is_accepted_by_pymongo():
+    recorder = QueryRecorder()
+    # Only through this client: monitoring.register() would record every later test's commands
+    client = MongoClient('mongodb://localhost:27017', connect=False, event_listeners=[recorder])
+    client.close()
+
+
+def test_query_recorder_keeps_only_reads_while_recording():
+    recorder = QueryRecorder()
+    find = SimpleNamespace(command_name='find', database_name='messages',
+                           command={'find': 'messages', 'filter': {'room': 'bench'}, 'lsid': {}, '$db': 'messages'})
+    insert = SimpleNamespace(command_name='insert', database_name='messages', command={'insert': 'messages'})
+    recorder.started(find)
+    assert recorder.commands == []
+    recorder.recording = True
+    recorder.started(find)
+    recorder.started(insert)
+    recorder.succeeded(SimpleNamespace())
+    recorder.failed(SimpleNamespace())
+    assert recorder.commands == [('messages', {'find': 'messages', 'filter': {'room': 'bench'}})]
@@ -0,0 +1,59 @@
+from unittest import mock
+
+import bson
+
+from scripts import db_profiler
+
+
+def test_record_call_encodes_one_result_in_n_and_scales_it(monkeypatch):
+    monkeypatch.setattr(db_profiler, 'SIZE_SAMPLE_EVERY', 4)
+    monkeypatch.setattr(db_profiler, '_method_stats', {})
+    docs = [{'message': 'hello', 'room': 'general'}] * 3
+    with mock.patch.object(db_profiler.bson, 'encode', wraps=bson.encode) as encode:
+        for _ in range(8):
+            db_profiler.record_call('find_messages', 1.0, docs)
+    stats = db_profiler._method_stats['find_messages']
+    assert encode.call_count == 2 * len(docs)
+    assert stats.documents == 8 * len(docs)
+    assert stats.bytes == 8 * len(docs) * len(bson.encode(docs[0]))
+
+
+def test_record_call_counts_raw_bytes_exactly(monkeypatch):
+    monkeypatch.setattr(db_profiler, 'SIZE_SAMPLE_EVERY', 4)
+    monkeypatch.setattr(db_profiler, '_method_stats', {})
+    for _ in range(3):
+        db_profiler.record_call('gridfs.read', 1.0, b'x' * 10)
+    assert db_profiler._method_stats['gridfs.read'].bytes == 30
+
+
+def test_generator_methods_are_timed_over_their_iteration(mongo, monkeypatch):
+    monkeypatch.setattr(db_profiler, '_method_stats', {})
+    mongo.messages_collection.insert_many([{'room': 'alice', 'id': f"m{i}", 'timestamp': str(i)} for i in range(5)])
+    stream = mongo.iter_messages({'room': 'alice'})
+    assert 'mongo.iter_messages' not in db_profiler._method_stats
+    assert len(list(stream)) == 5
+    stats = db_profiler._method_stats['mongo.iter_messages']
+    assert (stats.calls, stats.documents) == (1, 5)
+
+    for _ in mongo.iter_messages({'room': 'alice'}):
+        break
+    assert (stats.calls, stats.documents) == (2, 6)
+
+
+def test_slow_queries_of_one_shape_are_explained_once(monkeypatch):
+    worker = db_profiler._ExplainWorker()
+    monkeypatch.setattr(worker, '_event', mock.Mock())
+    monkeypatch.setattr(db_profiler, 'EXPLAIN_QUEUE_SIZE', 2)
+    worker._thread = object()  # keep the explain thread from starting
+    entries = []
+    for i, room in enumerate(['alice', 'bob', 'carol']):
+        entries.append({'namespace': 'messages.messages', 'command_name': 'find'})
+        worker.submit(entries[-1], 'messages', {'find': 'messages', 'filter': {'room': room}, 'limit': i})
+    assert len(worker._pending) == 1
+    _, (_, _, waiting) = worker._next()
+    assert waiting == entries
+
+    for collection in ('a', 'b', 'c'):
+        entry = {'namespace': f"messages.{collection}", 'command_name': 'find'}
+        worker.submit(entry, 'messages', {'find': collection, 'filter': {}})
+    assert entry['plan_error'] == 'explain queue full'
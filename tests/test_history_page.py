@@ -0,0 +1,54 @@
+import pytest
+
+from scripts import api_routes, message_handler
+
+
+@pytest.fixture
+def client(mongo, monkeypatch):
+    main = pytest.importorskip('main')
+    monkeypatch.setattr(message_handler, 'JOURNAL_ENABLED', False)
+    monkeypatch.setitem(main.app.config, 'SECRET_KEY', 'test')
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'alice'
+        session['session_token'] = 'token'
+    return client
+
+
+def send(text):
+    message = {'id': text, 'username': 'alice', 'message': text}
+    message_handler.cache_message(message, 'alice')
+    return message
+
+
+def test_cursor_pages_at_the_current_version_are_cached_and_revalidated_without_a_read(client, mongo, monkeypatch):
+    for i in range(12):
+        send(f"m{i}")
+    page = client.get('/api/history/alice?before=m11&limit=10')
+    assert page.headers['Cache-Control'] == 'private, no-cache'
+    version = page.json['data']['history_version']
+
+    url = f'/api/history/alice?before=m11&limit=10&v={version}'
+    cached = client.get(url)
+    assert cached.headers['Cache-Control'].startswith('private, max-age=')
+    assert [m['id'] for m in cached.json['data']['messages']] == [f"m{i}" for i in range(1, 11)]
+
+    reads = []
+    monkeypatch.setattr(api_routes, 'get_history_page', lambda *args: reads.append(args))
+    revalidated = client.get(url, headers={'If-None-Match': cached.headers['ETag']})
+    assert revalidated.status_code == 304
+    assert reads == []
+
+
+def test_an_edit_moves_older_pages_to_a_new_version(client, mongo):
+    for i in range(12):
+        send(f"m{i}")
+    version = client.get('/api/history/alice?before=m11&limit=10').json['data']['history_version']
+    message, error = message_handler.edit_message('alice', 'm5', 'alice', 'edited')
+    assert error is None
+
+    stale = client.get(f'/api/history/alice?before=m11&limit=10&v={version}')
+    assert stale.headers['Cache-Control'] == 'private, no-cache'
+    data = stale.json['data']
+    assert data['history_version'] == version + 1
+    assert 'edited' in [m['message'] for m in data['messages']]
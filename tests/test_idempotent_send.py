@@ -0,0 +1,61 @@
+import pytest
+
+from scripts import idempotency, message_handler, socket_handlers
+
+
+@pytest.fixture
+def sio(mongo, monkeypatch):
+    main = pytest.importorskip('main')
+    mongo.ensure_message_indexes()
+    monkeypatch.setattr(message_handler, 'JOURNAL_ENABLED', False)
+    monkeypatch.setattr(socket_handlers, 'send_acks', idempotency.IdempotencyWindow(300, 100))
+    monkeypatch.setitem(main.app.config, 'SECRET_KEY', 'test')
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 'alice'
+        session['session_token'] = 'token'
+    sio = main.socketio.test_client(main.app, flask_test_client=client)
+    sio.get_received()
+    yield sio
+    sio.disconnect()
+
+
+def acks(sio):
+    return [event['args'][0] for event in sio.get_received() if event['name'] == 'message_sent']
+
+
+def stored(mongo):
+    return list(mongo.get_message_collection().find({'room': 'alice'}))
+
+
+def test_a_retried_send_gets_the_original_ack_and_stores_nothing(sio, mongo):
+    sio.emit('send_message', {'message': 'hello', 'client_id': 'retry-0001'})
+    [original] = acks(sio)
+    assert 'duplicate' not in original
+
+    sio.emit('send_message', {'message': 'hello', 'client_id': 'retry-0001'})
+    [retry] = acks(sio)
+    assert retry['duplicate'] is True
+    assert retry['message_id'] == original['message_id']
+    assert retry['timestamp'] == original['timestamp']
+    assert [m['id'] for m in stored(mongo)] == [original['message_id']]
+
+
+def test_a_retry_after_the_window_forgot_it_is_caught_by_the_unique_index(sio, mongo, monkeypatch):
+    sio.emit('send_message', {'message': 'hello', 'client_id': 'retry-0002'})
+    [original] = acks(sio)
+
+    # Another worker, or this one after a restart: no ack in memory
+    monkeypatch.setattr(socket_handlers, 'send_acks', idempotency.IdempotencyWindow(300, 100))
+    sio.emit('send_message', {'message': 'hello again', 'client_id': 'retry-0002'})
+    [retry] = acks(sio)
+    assert retry['duplicate'] is True
+    assert retry['message_id'] == original['message_id']
+    assert [m['message'] for m in stored(mongo)] == ['hello']
+
+
+def test_sends_without_a_client_id_are_not_deduplicated(sio, mongo):
+    sio.emit('send_message', {'message': 'hello'})
+    sio.emit('send_message', {'message': 'hello'})
+    assert len({ack['message_id'] for ack in acks(sio)}) == 2
+    assert len(stored(mongo)) == 2
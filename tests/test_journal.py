@@ -0,0 +1,110 @@
+import os
+import shutil
+
+import pytest
+
+from scripts.data_dir import ensure_not_served
+from scripts.journal import Journal, JOURNAL_DIR
+
+
+@pytest.fixture
+def app():
+    main = pytest.importorskip('main')
+    return main.app
+
+
+def test_default_journal_is_not_served(app):
+    directory = os.path.join(JOURNAL_DIR, 'worker-0')
+    journal = Journal(directory)
+    try:
+        journal.append({'room': 'alice', 'message': {'id': 'm1', 'message': 'private'}})
+        segment = journal._path(journal._segment)
+        client = app.test_client()
+        assert client.get('/journal/worker-0/' + os.path.basename(segment)).status_code == 404
+        assert client.get('/' + os.path.relpath(segment, app.static_folder)).status_code == 404
+    finally:
+        journal.close()
+        shutil.rmtree(directory)
+
+
+def test_journal_dir_inside_the_served_root_is_refused(app):
+    with pytest.raises(RuntimeError):
+        ensure_not_served('JOURNAL_DIR', os.path.join(app.static_folder, 'journal'), app.static_folder)
+    with pytest.raises(RuntimeError):
+        ensure_not_served('JOURNAL_DIR', os.path.join(app.static_folder, 'files', 'j'), app.static_folder)
+    ensure_not_served('JOURNAL_DIR', JOURNAL_DIR, app.static_folder)
+
+
+def _record(n):
+    return {'room': 'alice', 'message': {'id': f"m{n}", 'message': f"hello {n}"}}
+
+
+def test_live_journal_of_a_draining_worker_is_not_adopted(tmp_path):
+    # Reload: the old and new generation of worker 0 run side by side
+    old = Journal(str(tmp_path / 'worker-0-100'))
+    new = Journal(str(tmp_path / 'worker-0-200'))
+    old.append(_record(1))
+    old.append(_record(2))
+    # The old worker is halfway through writing its next record
+    old._file.write(b'0000abcd {"room":"al')
+    old._file.flush()
+    segment = old._path(old._segment)
+
+    assert new.orphans() == []
+    assert os.path.exists(segment)
+    assert old.replay(lambda record: None) == 2
+
+    old._file.write(b'ice"}\n')
+    old.append(_record(3))
+    old.close()
+
+    applied = []
+    orphans = new.orphans()
+    assert [orphan.directory for orphan in orphans] == [old.directory]
+    while orphans[0].replay(applied.append):
+        pass
+    assert [record['message']['id'] for record in applied] == ['m3']
+    new.release(orphans[0])
+    assert not os.path.exists(old.directory)
+    assert new.orphans() == []
+    new.close()
+
+
+def test_replay_after_a_crash_with_a_torn_last_line_stores_each_record_once(tmp_path, mongo):
+    from scripts.message_handler import _replay_message
+
+    crashed = Journal(str(tmp_path / 'worker-0-100'))
+    for n in range(1, 4):
+        record = _record(n)
+        record['message'].update(username='alice', timestamp=f"2026-10-19T10:00:0{n}+00:00")
+        crashed.append(record)
+    # Killed mid-write: the last record never got its newline
+    crashed._file.write(b'0000abcd {"room":"alice","message":{"id":"m4"')
+    crashed._file.flush()
+    # ...and after applying two records, before their checkpoint reached disk
+    assert crashed.replay(_replay_message, limit=2) == 2
+    os.remove(os.path.join(crashed.directory, 'checkpoint.json'))
+    crashed.close()
+
+    survivor = Journal(str(tmp_path / 'worker-0-200'))
+    [orphan] = survivor.orphans()
+    assert orphan.has_backlog() and orphan.backlog == 3
+    applied = []
+
+    def apply(record):
+        _replay_message(record)
+        applied.append(record)
+    while orphan.replay(apply):
+        pass
+    assert [record['message']['id'] for record in applied] == ['m1', 'm2', 'm3']
+    survivor.release(orphan)
+    survivor.close()
+    # Once more, as if this checkpoint had been lost too
+    for record in applied:
+        _replay_message(record)
+
+    stored = mongo.get_message_collection().find({'room': 'alice'}, {'_id': 0, 'id': 1})
+    assert sorted(message['id'] for message in stored) == ['m1', 'm2', 'm3']
+    room = mongo.rooms_collection.find_one({'room': 'alice'})
+    assert room['message_count'] == 3
+    assert room['last_message_id'] == 'm3'
@@ -0,0 +1,78 @@
+from unicodedata import normalize
+
+import pytest
+
+from scripts import archiver, message_handler
+from scripts.search_index import index_terms
+
+
+def send(room, username, text):
+    message = {'id': f"{text}-{username}".replace(' ', '-'), 'username': username, 'message': text}
+    message_handler.cache_message(message, room)
+    return message
+
+
+@pytest.fixture
+def disk_archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(archiver, 'ARCHIVE_STORAGE', 'disk')
+    monkeypatch.setattr(archiver, 'ARCHIVE_DIR', str(tmp_path))
+    monkeypatch.setattr(archiver, 'ARCHIVE_AFTER_DAYS', 1)
+
+
+def test_archived_messages_stay_in_history_but_leave_search(mongo, monkeypatch, disk_archive):
+    monkeypatch.setattr(message_handler, 'JOURNAL_ENABLED', False)
+    old = send('alice', 'alice', 'old phở recipe')
+    send('alice', 'alice', 'new phở place')
+    archiver.seal_segment('alice', mongo.find_messages({'id': old['id']}))
+
+    history = [m['message'] for m in message_handler.get_recent_messages('alice', 10)]
+    assert history == ['old phở recipe', 'new phở place']
+    results, _ = message_handler.search_messages('alice', 'pho')
+    assert [r['id'] for r in results] == ['new-phở-place-alice']
+
+
+def test_history_skips_the_cold_tier_until_segments_exist(mongo, monkeypatch):
+    monkeypatch.setattr(message_handler, 'JOURNAL_ENABLED', False)
+    monkeypatch.setattr(archiver, 'ARCHIVE_AFTER_DAYS', 0)
+    monkeypatch.setitem(archiver._probe, 'checked', None)
+    monkeypatch.setitem(archiver._probe, 'found', False)
+    lookups = []
+    monkeypatch.setattr(mongo, 'find_archive_segments', lambda *a, **k: lookups.append(a) or [])
+    send('alice', 'alice', 'hello')
+    message_handler.get_recent_messages('alice', 10)
+    message_handler.get_recent_messages('alice', 10)
+    assert lookups == []
+
+
+def test_search_ranks_matches_of_every_term(mongo, monkeypatch):
+    monkeypatch.setattr(message_handler, 'JOURNAL_ENABLED', False)
+    send('alice', 'alice', 'phở bò ngon')
+    send('alice', 'alice', 'phở gà')
+    send('alice', 'alice', 'bò kho')
+    results, has_more = message_handler.search_messages('alice', 'pho bo')
+    assert [r['id'] for r in results] == ['phở-bò-ngon-alice']
+    assert has_more is False
+
+
+def test_search_scan_is_driven_by_the_rarest_term(mongo, monkeypatch):
+    monkeypatch.setattr(message_handler, 'JOURNAL_ENABLED', False)
+    for i in range(5):
+        send('alice', 'alice', f'ok {i}')
+    send('alice', 'alice', 'ok phở')
+    queries = []
+    find_messages = mongo.find_messages
+    monkeypatch.setattr(mongo, 'find_messages', lambda query, **kwargs: queries.append(query) or find_messages(query, **kwargs))
+    results, _ = message_handler.search_messages('alice', 'ok pho')
+    assert [r['id'] for r in results] == ['ok-phở-alice']
+    assert queries[-1]['$and'][1] == {'terms': {'$all': ['pho', 'ok']}}
+
+
+def test_decomposed_text_is_indexed_and_found(mongo, monkeypatch):
+    monkeypatch.setattr(message_handler, 'JOURNAL_ENABLED', False)
+    text = normalize('NFD', 'Đường phố Hà Nội')
+    assert index_terms(text) == ['duong', 'ha', 'noi', 'pho']
+    send('alice', 'alice', text)
+    results, _ = message_handler.search_messages('alice', normalize('NFD', 'Hà Nội'))
+    assert len(results) == 1
+    assert results[0]['snippet'] == 'Đường phố Hà Nội'
+    assert results[0]['highlights'] == [[10, 12], [13, 16]]
@@ -0,0 +1,71 @@
+import pytest
+
+from scripts import receipts as receipts_module
+from scripts.receipts import ReceiptBuffer, flush
+
+
+class Broadcasts:
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event, data, room=None):
+        self.events.append((event, data, room))
+
+
+@pytest.fixture
+def buffer(mongo, monkeypatch):
+    mongo.rooms_collection.insert_one({'room': 'alice', 'unread': {'bob': 3}})
+    buffer = ReceiptBuffer()
+    monkeypatch.setattr(receipts_module, 'receipts', buffer)
+    return buffer
+
+
+def marker(n):
+    return {'id': f"m{n}", 'timestamp': f"2026-10-19T10:00:{n:02d}+00:00"}
+
+
+def test_an_older_receipt_after_a_flush_is_stale_and_writes_nothing(buffer, mongo):
+    socketio = Broadcasts()
+    assert buffer.update('alice', 'bob', 'read', marker(5))
+    flush(socketio)
+    assert mongo.get_receipts('alice') == {'bob': {'delivered': 'm5', 'read': 'm5'}}
+    assert mongo.get_unread_counts('bob') == {}
+
+    assert not buffer.update('alice', 'bob', 'read', marker(3))
+    assert not buffer.update('alice', 'bob', 'delivered', marker(4))
+    flush(socketio)
+    assert mongo.get_receipts('alice') == {'bob': {'delivered': 'm5', 'read': 'm5'}}
+    assert [event for event, _, _ in socketio.events] == ['receipts']
+
+
+def test_the_stored_marker_does_not_move_back_when_another_worker_flushes_an_older_one(buffer, mongo):
+    buffer.update('alice', 'bob', 'read', marker(5))
+    flush(Broadcasts())
+
+    # A worker that has not seen the newer marker has nothing to compare against but the database
+    other_worker = ReceiptBuffer()
+    assert other_worker.update('alice', 'bob', 'read', marker(3))
+    mongo.save_receipts(other_worker.drain())
+    assert mongo.get_receipts('alice') == {'bob': {'delivered': 'm5', 'read': 'm5'}}
+
+    other_worker.update('alice', 'bob', 'delivered', marker(7))
+    mongo.save_receipts(other_worker.drain())
+    assert mongo.get_receipts('alice') == {'bob': {'delivered': 'm7', 'read': 'm5'}}
+
+
+def test_a_failed_flush_is_retried_without_overwriting_a_newer_marker(buffer, mongo, monkeypatch):
+    buffer.update('alice', 'bob', 'read', marker(5))
+    save_receipts = mongo.save_receipts
+
+    def unavailable(pending):
+        raise RuntimeError('primary unavailable')
+    monkeypatch.setattr(mongo, 'save_receipts', unavailable)
+    flush(Broadcasts())
+    assert mongo.get_receipts('alice') == {}
+    buffer.update('alice', 'bob', 'read', marker(8))
+    monkeypatch.setattr(mongo, 'save_receipts', save_receipts)
+
+    socketio = Broadcasts()
+    flush(socketio)
+    assert mongo.get_receipts('alice') == {'bob': {'delivered': 'm8', 'read': 'm8'}}
+    assert socketio.events == [('receipts', {'room': 'alice', 'receipts': {'bob': {'delivered': 'm8', 'read': 'm8'}}}, 'alice')]
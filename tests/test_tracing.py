@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from scripts import tracing
+from scripts.data_dir import ensure_not_served
+
+TRACEPARENT = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+
+
+def test_header_sampling_is_capped_per_second(monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_HEADER_SAMPLE_LIMIT', 3)
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 0)
+    monkeypatch.setattr(tracing, '_header_samples', {'second': 0, 'count': 0})
+    monkeypatch.setattr(tracing.time, 'monotonic', lambda: 100.5)
+    sampled = []
+    for _ in range(5):
+        span = tracing.start_root('http.request', parent=TRACEPARENT)
+        tracing._local.span = span.previous
+        assert span.trace_id == '4bf92f3577b34da6a3ce929d0e0e4736'
+        assert span.parent_id == '00f067aa0ba902b7'
+        sampled.append(span.sampled)
+    assert sampled == [True, True, True, False, False]
+
+    monkeypatch.setattr(tracing.time, 'monotonic', lambda: 101.5)
+    span = tracing.start_root('http.request', parent=TRACEPARENT)
+    tracing._local.span = span.previous
+    assert span.sampled
+
+
+def test_unsampled_header_does_not_use_the_budget(monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 0)
+    monkeypatch.setattr(tracing, '_header_samples', {'second': 0, 'count': 0})
+    span = tracing.start_root('http.request', parent=TRACEPARENT[:-2] + '00')
+    tracing._local.span = span.previous
+    assert not span.sampled
+    assert tracing._header_samples['count'] == 0
+
+
+
+def test_default_trace_file_is_outside_the_served_root():
+    main = pytest.importorskip('main')
+    root = main.app.static_folder
+    ensure_not_served('TRACE_FILE', tracing.TRACE_FILE, root)
+    with pytest.raises(RuntimeError):
+        ensure_not_served('TRACE_FILE', os.path.join(root, 'traces.ndjson'), root)
+    assert main.app.test_client().get('/traces.ndjson').status_code == 404
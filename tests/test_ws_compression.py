@@ -0,0 +1,28 @@
+import zlib
+
+import pytest
+
+pytest.importorskip('eventlet')
+
+from scripts import ws_compression
+
+
+def _websocket():
+    websocket_class, _ = ws_compression._websocket_classes()
+    return websocket_class(None, {}, extensions={'permessage-deflate': {}})
+
+
+def test_small_frames_skip_deflate_and_large_ones_use_it(monkeypatch):
+    monkeypatch.setattr(ws_compression, 'SOCKETIO_COMPRESSION_THRESHOLD', 1024)
+    ws = _websocket()
+    small = ws._pack_message('42["typing",{"user":"alice"}]')
+    assert not small[0] & 0x40
+    payload = '42["older_messages",' + '{"message":"Tối nay đi ăn phở không?"},' * 100 + '{}]'
+    large = ws._pack_message(payload)
+    assert large[0] & 0x40
+    length, start = large[1] & 0x7f, 2
+    if length == 126:
+        length, start = int.from_bytes(large[2:4], 'big'), 4
+    assert length < len(payload.encode()) // 4
+    body = zlib.decompressobj(-zlib.MAX_WBITS).decompress(large[start:start + length] + b'\x00\x00\xff\xff')
+    assert body.decode() == payload